@@ -0,0 +1,450 @@
+"""Micro-benchmarks for the noise simulation code, run on CPU by default:
+
+python benchmark.py --bench fused_sigmas,noise_sampling,quantize,calibration,augment,compact,triangle_lr,grad_penalty,sequential_eval,faults
+"""
+import argparse
+import numpy as np
+import random
+import time
+
+import torch
+import torch.nn.functional as F
+
+from torch.distributions.normal import Normal
+from torch.distributions.uniform import Uniform
+
+from fault_injection import WeightFaults
+from hardware_model import fused_conv_sigmas, NoiseSampler, UniformQuantize
+from quant import HistogramQuantile
+from utils import random_crop_flip, BatchSampler, CompactImages, TriangleLR, BinomialCI, evaluate
+
+
+def timeit(fn, reps=20, warmup=3):
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(reps):
+        fn()
+    return (time.perf_counter() - start) / reps
+
+
+def allocations(fn, reps=10):
+    """Average number of tensor allocations and allocated bytes per call of fn (CPU)"""
+    fn()
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        for _ in range(reps):
+            fn()
+    events = prof.events()
+    count = sum(1 for e in events if e.name in ['aten::empty', 'aten::empty_like', 'aten::empty_strided'])
+    allocated = sum(max(e.self_cpu_memory_usage, 0) for e in events)
+    return count / reps, allocated / reps
+
+
+def noisynet_layers(args):
+    """Shapes of the default noisynet.py architecture (65/120/390): (name, layer type, input, weight)"""
+    bs = args.batch_size
+    fs = 5
+    return [
+        ('conv1', 'conv', torch.rand(bs, 3, 32, 32), torch.randn(65, 3, fs, fs) * 0.1),
+        ('conv2', 'conv', torch.rand(bs, 65, 14, 14), torch.randn(120, 65, fs, fs) * 0.1),
+        ('linear1', 'linear', torch.rand(bs, 120 * fs * fs), torch.randn(390, 120 * fs * fs) * 0.1),
+        ('linear2', 'linear', torch.rand(bs, 390), torch.randn(10, 390) * 0.1)]
+
+
+def bench_fused_sigmas(args):
+    print('\nSignal + sigma convolutions, batch size {}: separate calls vs fused (ms)\n'.format(args.batch_size))
+    total_separate = 0
+    total_fused = 0
+    with torch.no_grad():
+        for name, layer_type, input, weight in noisynet_layers(args):
+            input = input.to(args.device)
+            weight = weight.to(args.device)
+            abs_weights = torch.abs(weight)
+            abs_w_squared = abs_weights.pow(2) + abs_weights
+            for merged_dac in [True, False]:
+                filters = [abs_weights] if merged_dac else [abs_w_squared, abs_weights]
+                layer = F.conv2d if layer_type == 'conv' else F.linear
+
+                def separate():
+                    return [layer(input, weight)] + [layer(input, f) for f in filters]
+
+                def fused():
+                    return fused_conv_sigmas(input, weight, filters, layer_type=layer_type)
+
+                out, sigmas = fused()
+                diff = max((a - b).abs().max().item() for a, b in zip(separate(), [out] + sigmas))
+                t_separate = timeit(separate, reps=args.reps) * 1000
+                t_fused = timeit(fused, reps=args.reps) * 1000
+                total_separate += t_separate
+                total_fused += t_fused if layer_type == 'conv' else t_separate  # only conv layers use the fused call
+                print('{:<8} {:<13} separate {:8.3f}  fused {:8.3f}  speedup {:.2f}x  max diff {:.2e}'.format(
+                    name, 'merged DAC' if merged_dac else 'external DAC', t_separate, t_fused, t_separate / t_fused, diff))
+    print('\ntotal             separate {:8.3f}  fused conv {:8.3f}  speedup {:.2f}x\n'.format(total_separate, total_fused, total_separate / total_fused))
+
+
+def bench_noise_sampling(args):
+    print('\nNoise sampling for a {} conv2 output: torch.distributions vs NoiseSampler\n'.format([args.batch_size, 120, 10, 10]))
+    output = torch.randn(args.batch_size, 120, 10, 10, device=args.device)
+    sigmas = torch.rand_like(output)
+    a = 0.1
+    sampler = NoiseSampler(reuse_buffers=False)
+    buffered = NoiseSampler(reuse_buffers=True)
+    seeded = NoiseSampler(reuse_buffers=True, seed=0)
+
+    modes = {
+        'uniform_ind': (
+            lambda: Uniform(-torch.ones_like(output) * a * torch.max(torch.abs(output)), torch.ones_like(output) * a * torch.max(torch.abs(output))).sample(),
+            lambda s, **kw: s.uniform(output, -a * torch.max(torch.abs(output)), a * torch.max(torch.abs(output)), **kw)),
+        'uniform_dep': (
+            lambda: Uniform(torch.ones_like(output) * a, torch.ones_like(output) / a).sample(),
+            lambda s, **kw: s.uniform(output, a, 1. / a, **kw)),
+        'normal_ind': (
+            lambda: Normal(loc=0, scale=torch.ones_like(output) * a * torch.max(torch.abs(output))).sample(),
+            lambda s, **kw: s.normal(output, a * torch.max(torch.abs(output)), **kw)),
+        'normal_dep': (
+            lambda: Normal(loc=0, scale=(a * output).abs()).sample(),
+            lambda s, **kw: s.normal(output, a * output, **kw)),
+        'current': (
+            lambda: Normal(loc=0, scale=torch.sqrt(0.1 * (1. / 10.) * sigmas)).sample(),
+            lambda s, **kw: s.normal(output, sigmas.mul(0.1 / 10.).sqrt_(), **kw)),
+    }
+
+    with torch.no_grad():
+        for mode, (distribution, reparameterized) in modes.items():
+            print(mode)
+            for name, fn in [('distributions', distribution), ('sampler', lambda: reparameterized(sampler)),
+                             ('sampler+buffer', lambda: reparameterized(buffered, reuse=True)),
+                             ('sampler+buffer+seed', lambda: reparameterized(seeded, reuse=True))]:
+                t = timeit(fn, reps=args.reps) * 1000
+                count, allocated = allocations(fn) if args.device == 'cpu' else (float('nan'), float('nan'))
+                print('    {:<20} {:8.3f}ms  {:4.1f} allocations  {:8.1f}KB allocated'.format(name, t, count, allocated / 1024.))
+    print()
+
+
+def reference_quantize(input, num_bits, min_value, max_value):
+    """The original clone + step by step UniformQuantize forward (stochastic=0), and its saturation masking in backward"""
+    output = input.clone()
+    qmin = 0.
+    qmax = 2. ** num_bits - 1.
+    scale = max((max_value - min_value) / (qmax - qmin), 1e-6)
+    output.add_(-min_value).div_(scale).add_(qmin)
+    output.clamp_(qmin, qmax).round_()
+    output.add_(-qmin).mul_(scale).add_(min_value)
+    grad = torch.ones_like(input)
+    grad[input > max_value] = 0
+    grad[input < min_value] = 0
+    return output, grad
+
+
+def bench_quantize(args):
+    print('\nUniformQuantize forward + backward: original vs fused (ms), and bytes saved for backward\n')
+    for name, _, input, _ in noisynet_layers(args):
+        input = (input * 2).to(args.device).requires_grad_()
+        for num_bits in [2, 4, 8]:
+            max_value = float(input.max()) * 0.9
+            ref_out, ref_grad = reference_quantize(input.detach(), num_bits, 0., max_value)
+            out = UniformQuantize().apply(input, num_bits, 0., max_value, 0, False, False)
+            out.backward(torch.ones_like(out))
+            assert torch.equal(out, ref_out) and torch.equal(input.grad, ref_grad), 'quantize mismatch in {} {} bits'.format(name, num_bits)
+            input.grad = None
+
+            t_ref = timeit(lambda: reference_quantize(input.detach(), num_bits, 0., max_value), reps=args.reps) * 1000
+            t_new = timeit(lambda: UniformQuantize().apply(input, num_bits, 0., max_value, 0, False, False).sum().backward(), reps=args.reps) * 1000
+            print('{:<8} {:d} bits  original {:8.3f}  fused {:8.3f}  saved for backward {:7.1f}KB -> {:7.1f}KB  (outputs and gradients match)'.format(
+                name, num_bits, t_ref, t_new, input.numel() * input.element_size() / 1024., input.numel() / 1024.))
+    print()
+
+
+def bench_calibration(args, pctl=99.98, num_batches=20):
+    print('\n{:.2f} percentile of {} ReLU activation batches: per batch kthvalue vs HistogramQuantile (time per batch in ms)\n'.format(pctl, num_batches))
+    for name, layer_type, input, weight in noisynet_layers(args):
+        batches = []
+        for _ in range(num_batches):
+            x = torch.rand_like(input).to(args.device)
+            batches.append(F.relu(F.conv2d(x, weight) if layer_type == 'conv' else F.linear(x, weight)))
+        all_values = torch.cat([b.flatten() for b in batches])
+        exact = torch.kthvalue(all_values, int(all_values.numel() * pctl / 100.))[0].item()
+        del all_values
+
+        def kthvalue():
+            return [torch.kthvalue(b.flatten(), int(b.numel() * pctl / 100.))[0] for b in batches]
+
+        sketch = HistogramQuantile()
+
+        def histogram():
+            sketch.reset()
+            for b in batches:
+                sketch.update(b)
+
+        running_list = kthvalue()
+        histogram()
+        t_kth = timeit(kthvalue, reps=max(args.reps // 5, 1)) * 1000 / num_batches
+        t_hist = timeit(histogram, reps=max(args.reps // 5, 1)) * 1000 / num_batches
+        print('{:<8} exact {:.4f}  kthvalue (mean of first 5) {:.4f}  kthvalue (mean of all) {:.4f}  histogram {:.4f}  |  kthvalue {:.3f}  histogram {:.3f}'.format(
+            name, exact, torch.stack(running_list[:5]).mean().item(), torch.stack(running_list).mean().item(), sketch.quantile(pctl / 100.).item(), t_kth, t_hist))
+    print()
+
+
+def bench_augment(args, num_checked=16):
+    print('\nRandom crop + flip of a padded {} batch: one draw per batch (python) vs per sample (gather), in ms\n'.format([args.batch_size, 3, 40, 40]))
+    padded = F.pad(torch.randn(args.batch_size, 3, 32, 32, device=args.device), (4, 4, 4, 4))
+
+    def per_batch():
+        k = random.randint(0, 8)
+        j = random.randint(0, 8)
+        input = padded[:, :, k:k + 32, j:j + 32]
+        if random.random() < 0.5:
+            input = torch.flip(input, [3])
+        return input.contiguous()
+
+    def per_sample():
+        return random_crop_flip(padded)
+
+    output = per_sample()
+    for n in range(min(num_checked, args.batch_size)):
+        candidates = [padded[n, :, k:k + 32, j:j + 32] for k in range(9) for j in range(9)]
+        assert any(torch.equal(output[n], c) or torch.equal(output[n], c.flip(2)) for c in candidates), 'sample {} is not a crop of its input'.format(n)
+
+    t_batch = timeit(per_batch, reps=args.reps) * 1000
+    t_sample = timeit(per_sample, reps=args.reps) * 1000
+    print('per batch {:8.3f}  per sample {:8.3f}  (every checked sample is a valid crop/flip of its own input)\n'.format(t_batch, t_sample))
+
+
+def bench_compact(args, num_samples=10000):
+    print('\nWhitened, padded 4 bit images ({} samples): float tensor vs uint8 CompactImages, batch gather time in ms\n'.format(num_samples))
+    images = (np.random.randint(0, 16, (num_samples, 3, 32, 32)) * 17).astype(np.uint8)
+    mean = np.asarray((0.4914, 0.4822, 0.4465)).astype(np.float32)
+    std = np.asarray((0.2023, 0.1994, 0.2010)).astype(np.float32)
+
+    dense = torch.from_numpy(images.astype(np.float32)).to(args.device)
+    dense = dense.sub_(torch.from_numpy(mean.reshape(1, 3, 1, 1)).to(args.device)).div_(torch.from_numpy(std.reshape(1, 3, 1, 1)).to(args.device))
+    dense = F.pad(dense, (4, 4, 4, 4))
+    compact = CompactImages.from_numpy(images, np.float32, mean, std, pad=4).to(args.device)
+    labels = torch.zeros(num_samples, dtype=torch.long, device=args.device)
+
+    index = torch.randperm(num_samples, device=args.device)
+    assert torch.equal(dense.index_select(0, index), compact.index_select(0, index)), 'decoded images differ'
+    assert torch.equal(dense[:args.batch_size], compact[:args.batch_size]), 'decoded images differ'
+
+    for name, inputs, nbytes in [('float32', dense, dense.numel() * 4), ('uint8 codes', compact, compact.codes.numel() + compact.lut.numel() * 4)]:
+        sampler = BatchSampler(inputs, labels, args.batch_size)
+        t = timeit(lambda: next(iter(sampler)), reps=args.reps) * 1000
+        print('{:<12} {:8.1f}MB  batch {:8.3f}'.format(name, nbytes / 2 ** 20, t))
+    print('(decoded batches are identical)\n')
+
+
+def reference_triangle(LR, momentum, nepochs, max_epoch, finetune_epochs, iters_per_epoch):
+    """The original incremental triangle schedule of noisynet.py: (lr, momentum) before every batch"""
+    lr_increment = LR / ((max_epoch + 1) * iters_per_epoch)
+    mom_decrement = momentum / ((max_epoch + 1) * iters_per_epoch)
+    lr_decrement = (LR - 0.05 * LR) / ((nepochs - max_epoch - finetune_epochs) * iters_per_epoch)
+    lr_decrement2 = (0.05 * LR) / (finetune_epochs * iters_per_epoch)
+    mom_increment = (LR - 0.05 * LR) / ((nepochs - max_epoch - finetune_epochs) * iters_per_epoch)
+    mom_increment2 = (0.05 * LR) / (finetune_epochs * iters_per_epoch)
+    lr = 0
+    mom = momentum
+    values = []
+    for epoch in range(nepochs):
+        for i in range(iters_per_epoch):
+            if epoch <= max_epoch:
+                lr += lr_increment
+                mom -= mom_decrement
+            elif epoch <= nepochs - finetune_epochs:
+                lr -= lr_decrement
+                mom += mom_increment
+            else:
+                lr -= lr_decrement2
+                mom += mom_increment2
+            values.append((lr, mom))
+    return values
+
+
+def bench_triangle_lr(args, nepochs=250, max_epoch=10, finetune_epochs=20, iters_per_epoch=781):
+    print('\nTriangle LR schedule, {} epochs x {} iterations: incremental loop vs TriangleLR\n'.format(nepochs, iters_per_epoch))
+    model = torch.nn.Linear(4, 4)
+    reference = reference_triangle(0.1, 0.9, nepochs, max_epoch, finetune_epochs, iters_per_epoch)
+
+    def param_groups():  # new dicts for every optimizer: they add their defaults (e.g. SGD momentum) to the groups
+        return [{'params': [model.weight]}, {'params': [model.bias]}]
+
+    for name, optimizer in [('SGD', torch.optim.SGD(param_groups(), lr=0.1, momentum=0.9)), ('AdamW', torch.optim.AdamW(param_groups(), lr=0.1))]:
+        scheduler = TriangleLR(optimizer, 0.1, 0.9, nepochs, max_epoch, finetune_epochs, iters_per_epoch, batch_size=args.batch_size)
+        for t, (lr, mom) in enumerate(reference):
+            assert scheduler.step() == (lr, mom), 'schedule differs at iteration {}'.format(t)
+            assert optimizer.param_groups[1]['lr'] == lr / args.batch_size
+        assert ('momentum' in optimizer.param_groups[0]) == (name == 'SGD'), 'momentum written into {} param groups'.format(name)
+
+        resumed = TriangleLR(optimizer, 0.1, 0.9, nepochs, max_epoch, finetune_epochs, iters_per_epoch, batch_size=args.batch_size)
+        resumed.load_state_dict({'iteration': 12345})
+        assert resumed.step() == reference[12345], 'resumed schedule differs'
+
+    t_ref = timeit(lambda: reference_triangle(0.1, 0.9, nepochs, max_epoch, finetune_epochs, iters_per_epoch), reps=max(args.reps // 5, 1)) * 1000
+    t_new = timeit(lambda: TriangleLR.schedule(0.1, 0.9, nepochs, max_epoch, finetune_epochs, iters_per_epoch), reps=max(args.reps // 5, 1)) * 1000
+    print('whole schedule: incremental {:8.3f}ms  precomputed {:8.3f}ms  (all {} values identical, also after resuming)\n'.format(t_ref, t_new, len(reference)))
+
+
+class SmallNet(torch.nn.Module):
+    """The default noisynet.py architecture without noise, quantization and BN, keeping the activations it penalizes"""
+
+    def __init__(self):
+        super(SmallNet, self).__init__()
+        self.conv1 = torch.nn.Conv2d(3, 65, 5, bias=False)
+        self.conv2 = torch.nn.Conv2d(65, 120, 5, bias=False)
+        self.linear1 = torch.nn.Linear(120 * 5 * 5, 390, bias=False)
+        self.linear2 = torch.nn.Linear(390, 10, bias=False)
+
+    def forward(self, x):
+        self.conv1_ = self.conv1(x)
+        self.conv2_ = self.conv2(F.max_pool2d(F.relu(self.conv1_), 2))
+        self.linear1_ = self.linear1(F.max_pool2d(F.relu(self.conv2_), 2).flatten(1))
+        self.linear2_ = self.linear2(F.relu(self.linear1_))
+        return self.linear2_
+
+
+def bench_grad_penalty(args, L3=0.01, L3_act=0.01):
+    print('\nL3 + L3_act gradient penalties, batch size {}: separate grad calls (original) vs combined\n'.format(args.batch_size))
+    model = SmallNet().to(args.device)
+    params = [model.conv1.weight, model.conv2.weight, model.linear1.weight, model.linear2.weight]
+    input = torch.rand(args.batch_size, 3, 32, 32, device=args.device)
+    label = torch.randint(0, 10, (args.batch_size,), device=args.device)
+
+    def loss_fn():
+        return F.cross_entropy(model(input), label)
+
+    def original():
+        model.zero_grad()
+        loss = loss_fn()
+        loss.backward(retain_graph=True)
+        acts = [model.conv1_, model.conv2_, model.linear1_, model.linear2_]
+        acts_grad = torch.autograd.grad(loss, acts, create_graph=True)
+        (L3_act * torch.stack([g.pow(2).sum() for g in acts_grad]).sum()).backward(retain_graph=True)
+        param_grads = torch.autograd.grad(loss, params, create_graph=True, only_inputs=True)
+        (L3 * sum(g.pow(2).sum() for g in param_grads)).backward()
+
+    def combined():
+        model.zero_grad()
+        loss = loss_fn()
+        acts = [model.conv1_, model.conv2_, model.linear1_, model.linear2_]
+        grads = torch.autograd.grad(loss, params + acts, create_graph=True)
+        total = loss + L3 * torch.stack([g.pow(2).sum() for g in grads[:4]]).sum() + L3_act * torch.stack([g.pow(2).sum() for g in grads[4:]]).sum()
+        total.backward()
+
+    results = {}
+    for name, fn in [('original', original), ('combined', combined)]:
+        fn()
+        results[name] = [p.grad.clone() for p in params]
+        t = timeit(fn, reps=args.reps) * 1000
+        if args.device.startswith('cuda'):
+            torch.cuda.reset_peak_memory_stats()
+            fn()
+            memory = 'peak memory {:7.1f}MB'.format(torch.cuda.max_memory_allocated() / 2 ** 20)
+        else:
+            memory = 'allocated {:7.1f}MB'.format(allocations(fn, reps=2)[1] / 2 ** 20)
+        print('{:<10} step {:8.3f}ms  {}'.format(name, t, memory))
+
+    diff = max(((a - b).abs().max() / b.abs().max()).item() for a, b in zip(results['combined'], results['original']))
+    print('\ncombined vs original: max relative difference {:.2e}\n'.format(diff))
+
+
+def bench_sequential_eval(args, num_samples=10000, tolerance=2.0, trials=200):
+    print('\nSequential evaluation of {} test samples, stopping at a {:.1f}% confidence interval\n'.format(num_samples, tolerance))
+    labels = torch.randint(10, (num_samples,), device=args.device)
+    for true_acc in [0.1, 0.5, 0.9]:
+        covered = 0
+        evaluated = []
+        for _ in range(trials):
+            # the "model" output: the label itself with probability true_acc, else another class
+            correct = torch.rand(num_samples, device=args.device) < true_acc
+            logits = F.one_hot(torch.where(correct, labels, (labels + 1) % 10), 10).float()
+            ci = BinomialCI(1.96)
+            acc = evaluate(lambda x: x, logits, labels, batch_size=250, ci=ci, tolerance=tolerance)
+            assert abs(acc - ci.accuracy()) < 1e-9
+            low, high = ci.interval()
+            covered += low <= true_acc * 100. <= high
+            evaluated.append(ci.total)
+        print('accuracy {:3.0f}%  samples evaluated {:6.0f} of {} (mean)  interval covers the true accuracy in {:.1f}% of {} runs'.format(
+            true_acc * 100., np.mean(evaluated), num_samples, covered * 100. / trials, trials))
+
+    full = timeit(lambda: evaluate(lambda x: x, logits, labels, batch_size=250), reps=args.reps) * 1000
+    early = timeit(lambda: evaluate(lambda x: x, logits, labels, batch_size=250, ci=BinomialCI(1.96), tolerance=tolerance), reps=args.reps) * 1000
+    print('\nfull pass {:8.3f}ms  sequential {:8.3f}ms\n'.format(full, early))
+
+
+def reference_faults(p, mode, noise):
+    """The dense test_distortion --stuck_at_weights code, before fault_injection.py"""
+    p = p.clone()
+    if mode == 'random_zero':
+        mask = torch.empty_like(p, dtype=torch.float).uniform_() > noise
+        return p * mask
+    elif mode == 'largest_zero':
+        thr = 1 - noise
+        pctl_pos, _ = torch.kthvalue(p[p > 0].flatten(), int(p[p > 0].numel() * thr))
+        pctl_neg, _ = torch.kthvalue(torch.abs(p[p < 0]).flatten(), int(p[p < 0].numel() * thr))
+        p[p > pctl_pos] = 0
+        p[p < -pctl_neg] = 0
+        return p
+    elif mode == 'smallest_zero':
+        pctl_pos, _ = torch.kthvalue(p[p > 0].flatten(), int(p[p > 0].numel() * noise))
+        pctl_neg, _ = torch.kthvalue(torch.abs(p[p < 0]).flatten(), int(p[p < 0].numel() * noise))
+        p_copy_pos = p.clone()
+        p_copy_neg = p.clone()
+        p_copy_pos[p < pctl_pos] = 0
+        p_copy_neg[p > -pctl_neg] = 0
+        return p_copy_pos + p_copy_neg
+    elif mode == 'random_one':
+        mask = torch.empty_like(p, dtype=torch.float).uniform_() > noise
+        return torch.where(mask, p, p.sign() * p.abs().max())
+
+
+def bench_faults(args, shape=(512, 512, 3, 3)):
+    print('\nStuck-at weight faults, {} weights: dense masks vs fault_injection.py\n'.format(list(shape)))
+    p = torch.randn(shape, device=args.device).round(decimals=2)  # with ties
+    out = torch.empty_like(p)
+    faults = WeightFaults(p)
+    for mode in ['largest_zero', 'smallest_zero']:
+        for noise in [0.01, 0.1, 0.5]:
+            faults.inject(out, mode, noise)
+            assert torch.equal(out, reference_faults(p, mode, noise)), '{} differs at {}'.format(mode, noise)
+    print('largest_zero, smallest_zero: identical to the dense version\n')
+
+    for mode in ['random_zero', 'random_one']:
+        for noise in [1e-5, 1e-3, 0.1]:
+            counts = [faults.inject(out, mode, noise) for _ in range(20)]
+            dense = [(reference_faults(p, mode, noise) != p).sum().item() for _ in range(20)]
+            t_dense = timeit(lambda: reference_faults(p, mode, noise), reps=args.reps) * 1000
+            t_sparse = timeit(lambda: faults.inject(out, mode, noise), reps=args.reps) * 1000
+            print('{:<12} rate {:7.0e}  faults per draw {:9.1f} (dense {:9.1f}, expected {:9.1f})   dense {:8.3f}ms  sparse {:8.3f}ms'.format(
+                mode, noise, np.mean(counts), np.mean(dense), p.numel() * noise, t_dense, t_sparse))
+    print()
+
+
+benchmarks = {
+    'fused_sigmas': bench_fused_sigmas,
+    'noise_sampling': bench_noise_sampling,
+    'quantize': bench_quantize,
+    'calibration': bench_calibration,
+    'augment': bench_augment,
+    'compact': bench_compact,
+    'triangle_lr': bench_triangle_lr,
+    'grad_penalty': bench_grad_penalty,
+    'sequential_eval': bench_sequential_eval,
+    'faults': bench_faults,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--bench', type=str, default='all', metavar='', help='benchmark to run: {} or all'.format(', '.join(benchmarks)))
+    parser.add_argument('--batch_size', type=int, default=64, metavar='', help='batch size')
+    parser.add_argument('--reps', type=int, default=20, metavar='', help='number of timed repetitions')
+    parser.add_argument('--num_threads', type=int, default=0, metavar='', help='number of CPU threads (0: torch default)')
+    parser.add_argument('--device', type=str, default='cpu', metavar='', help='device to run on')
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+
+    names = list(benchmarks) if args.bench == 'all' else args.bench.split(',')
+    for name in names:
+        benchmarks[name](args)
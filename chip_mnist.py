@@ -83,12 +83,10 @@ class Net(nn.Module):
             return self.output
 
 
-def train(args, model, num_train_batches, images, labels, optimizer):
+def train(args, model, train_sampler, optimizer):
     model.train()
     correct = 0
-    for i in range(num_train_batches):
-        batch = images[i * args.batch_size : (i + 1) * args.batch_size]
-        batch_labels = labels[i * args.batch_size : (i + 1) * args.batch_size]
+    for batch, batch_labels in train_sampler:
 
         optimizer.zero_grad()
         output = model(batch)
@@ -117,7 +115,7 @@ def train(args, model, num_train_batches, images, labels, optimizer):
 
         pred = output.argmax(dim=1, keepdim=True)  # get the index of the max log-probability
         correct += pred.eq(batch_labels.view_as(pred)).sum().item()
-    return 100. * correct / len(images)
+    return 100. * correct / len(train_sampler.inputs)
 
 
 def test(model, images, labels):
@@ -189,22 +187,31 @@ def main():
     parser.add_argument('--prune_epoch', type=float, default=90, help='do pruning at the end of this epoch')
     parser.add_argument('--var_name', type=str, default='', help='var_name')
     parser.add_argument('--gpu', type=str, default=None, help='gpu')
+    parser.add_argument('--device', type=str, default=None, help='device to run on (e.g. cpu, cuda), if None use cuda when available')
+    parser.add_argument('--num_threads', type=int, default=0, help='number of CPU threads per process (0: torch default)')
     parser.add_argument('--num_sims', type=int, default=1, help='number of simulation runs')
     args = parser.parse_args()
 
     if args.gpu is not None:
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
 
+    if args.device is None:
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
     np.set_printoptions(precision=4, linewidth=200, suppress=True)
 
     data = np.load(args.dataset, allow_pickle=True)
     train_data, val_data = data
     train_inputs, train_labels = train_data
     test_inputs, test_labels = val_data
-    train_inputs = torch.from_numpy(train_inputs).cuda()
-    train_labels = torch.from_numpy(train_labels).cuda()
-    test_inputs = torch.from_numpy(test_inputs).cuda()
-    test_labels = torch.from_numpy(test_labels).cuda()
+    train_inputs = torch.from_numpy(train_inputs).to(args.device)
+    train_labels = torch.from_numpy(train_labels).to(args.device)
+    train_sampler = utils.BatchSampler(train_inputs, train_labels, args.batch_size)
+    test_inputs = torch.from_numpy(test_inputs).to(args.device)
+    test_labels = torch.from_numpy(test_labels).to(args.device)
 
     results = {}
 
@@ -230,9 +237,8 @@ def main():
         best_accs = []
 
         for s in range(args.num_sims):
-            model = Net(args).cuda()
+            model = Net(args).to(args.device)
             optimizer = optim.SGD(model.parameters(), lr=args.LR, momentum=args.momentum, weight_decay=args.L2)
-            num_train_batches = int(len(train_inputs) / args.batch_size)
             best_acc = 0
 
             if s == 0:
@@ -240,15 +246,11 @@ def main():
 
             for epoch in range(args.epochs):
 
-                rnd_idx = np.random.permutation(len(train_inputs))
-                train_inputs = train_inputs[rnd_idx]
-                train_labels = train_labels[rnd_idx]
-
                 if epoch % 70 == 0 and epoch != 0:
                     print('\nReducing learning rate ')
                     for param_group in optimizer.param_groups:
                         param_group['lr'] = param_group['lr'] / 10.
-                train_acc = train(args, model, num_train_batches, train_inputs, train_labels, optimizer)
+                train_acc = train(args, model, train_sampler, optimizer)
                 val_acc = test(model, test_inputs, test_labels)
 
                 if (args.prune_weights1 > 0 or args.prune_weights2 > 0) and epoch % args.prune_epoch == 0 and epoch != 0:
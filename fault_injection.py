@@ -0,0 +1,82 @@
+"""Stuck-at faults for weight tensors (test_distortion --stuck_at_weights):
+
+random_zero    a fraction of randomly chosen weights is stuck at zero
+random_one     a fraction of randomly chosen weights is stuck at the largest weight magnitude (keeping their sign)
+largest_zero   the largest positive and negative weights (a fraction of each) are zeroed
+smallest_zero  the smallest positive and negative weights (a fraction of each) are zeroed (regular pruning)
+
+Only the faulty weights are touched: random faults are drawn as a set of flat indices (their number binomially distributed,
+as with an independent coin flip per weight), and the magnitude based modes read their thresholds from one sort of each
+tensor, shared by all fault modes and rates.
+"""
+import torch
+
+
+# above this fault rate, the faulty weights are drawn with a dense mask (the sparse draw only pays off for rare faults)
+DENSE_FAULT_RATE = 0.01
+
+
+def fault_indices(numel, rate, device):
+    """Flat indices of faulty weights, every one of numel weights being faulty with probability rate"""
+    if rate > DENSE_FAULT_RATE:
+        return (torch.rand(numel, device=device) < rate).nonzero().flatten()
+    count = int(torch.binomial(torch.tensor([float(numel)]), torch.tensor([float(rate)])).item())
+    indices = torch.randint(numel, (count,), device=device).unique()
+    while indices.numel() < count:  # redraw the (rare) duplicates
+        indices = torch.cat([indices, torch.randint(numel, (count - indices.numel(),), device=device)]).unique()
+    return indices
+
+
+class WeightFaults(object):
+
+    def __init__(self, weight):
+        self.weight = weight.detach()
+        self.flat = self.weight.flatten()
+        self.max_abs = self.flat.abs().max()
+        self.positive = None
+        self.negative = None
+
+    def sorted(self):
+        """(values, flat indices) of the positive weights and of the magnitudes of the negative weights, in ascending order"""
+        if self.positive is None:
+            for sign in [1, -1]:
+                index = (self.flat * sign > 0).nonzero().flatten()
+                values, order = torch.sort(self.flat[index] * sign)
+                if sign == 1:
+                    self.positive = (values, index[order])
+                else:
+                    self.negative = (values, index[order])
+        return self.positive, self.negative
+
+    def faulty(self, mode, rate):
+        """Flat indices of the weights that are faulty in mode, at fault rate rate"""
+        if mode in ['random_zero', 'random_one']:
+            return fault_indices(self.flat.numel(), rate, self.flat.device)
+
+        indices = []
+        for values, index in self.sorted():
+            if mode == 'largest_zero':
+                # weights larger than the int(n * (1 - rate))-th smallest one (torch.kthvalue), ties included
+                k = int(values.numel() * (1 - rate))
+                start = int(torch.searchsorted(values, values[k - 1], right=True).item()) if k > 0 else 0
+                indices.append(index[start:])
+            elif mode == 'smallest_zero':
+                # weights smaller than the int(n * rate)-th smallest one
+                k = int(values.numel() * rate)
+                end = int(torch.searchsorted(values, values[k - 1]).item()) if k > 0 else 0
+                indices.append(index[:end])
+            else:
+                print('\n\nUnknown stuck_at_weights mode: {}, Exiting...\n\n'.format(mode))
+                raise (SystemExit)
+        return torch.cat(indices)
+
+    def inject(self, out, mode, rate):
+        """Write the weights with faults (mode, rate) into out, and return the number of faulty weights"""
+        out.copy_(self.weight)
+        indices = self.faulty(mode, rate)
+        if mode == 'random_one':
+            values = self.flat[indices].sign() * self.max_abs
+        else:
+            values = torch.zeros([], dtype=out.dtype, device=out.device)
+        out.view(-1).index_put_((indices,), values)
+        return indices.numel()
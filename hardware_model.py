@@ -1,3 +1,4 @@
+import os
 import torch
 from torch import nn
 from torch.autograd.function import InplaceFunction, Function
@@ -5,87 +6,419 @@ import random
 import numpy as np
 import torch.nn.functional as F
 from torch.distributions.normal import Normal
-from torch.distributions.uniform import Uniform
 from plot_histograms import plot
+from quant import quantize_dequantize, HistogramQuantile, QuantMeasure as FractionQuantMeasure
 
 # random.seed(1)
 # torch.manual_seed(1)
 # torch.backends.cudnn.deterministic = True
 
 
-def add_noise_calculate_power(self, args, arrays, input, weights, output, layer_type='conv', i=0, layer_num=0, merged_dac=True):
+def weight_stats(self, weights, layer_num, merged_dac=True):
+    """abs(weights) and either max(abs(weights)) (merged DAC) or abs(weights)^2 + abs(weights) (external DAC) for the analog noise model.
+
+    With fixed weights (eval mode) these are cached per layer and only recomputed when the weight tensor changes: the cache is
+    keyed on the storage pointer and the version counter, which is bumped by every in-place update (optimizer step,
+    load_state_dict), and on whether inference_mode is on. Updates done through .data are not tracked, call clear_sigma_cache(model) after those.
+    """
+    if self.training:
+        cache = {'abs': torch.abs(weights)}
+    else:
+        if not hasattr(self, 'sigma_cache'):
+            self.sigma_cache = {}
+        key = (weights.data_ptr(), weights._version, torch.is_inference_mode_enabled())
+        cache = self.sigma_cache.get(layer_num)
+        if cache is None or cache['key'] != key:
+            cache = {'key': key, 'abs': torch.abs(weights)}
+            self.sigma_cache[layer_num] = cache
+
+    if merged_dac and 'w_max' not in cache:
+        cache['w_max'] = torch.max(cache['abs'])
+    elif not merged_dac and 'abs_w_squared' not in cache:
+        cache['abs_w_squared'] = cache['abs'].pow(2) + cache['abs']
+    return cache
+
+
+def clear_sigma_cache(model):
+    for m in model.modules():
+        if hasattr(m, 'sigma_cache'):
+            m.sigma_cache = {}
+
+
+def quant_measures(model):
+    """All activation quantizers in the model (pctl in percent here, as a fraction in the quant.py version)"""
+    return [m for m in model.modules() if isinstance(m, (QuantMeasure, FractionQuantMeasure))]
+
+
+def start_calibration(model, eval_mode=False):
+    for m in quant_measures(model):
+        m.start_calibration(eval_mode=eval_mode)
+
+
+def finish_calibration(model, tag='train'):
+    with torch.no_grad():
+        for m in quant_measures(model):
+            running_list = ['{:.2f}'.format(v.item()) for v in m.running_list]
+            m.finish_calibration()
+            print('({}) running_list: {} running_max: {:.3f}'.format(tag, running_list, m.running_max.item()))
+
+
+def calibrate(model, batches, num_batches=5, method='kthvalue', path=None, **kwargs):
+    """Set running_max of all activation quantizers from num_batches forward passes over batches (input tensors or
+    (input, label) pairs), with gradients off and BN in eval mode, instead of as a side effect of the first training batches.
+    method is 'kthvalue' (average of per batch percentiles) or 'histogram' (percentile of all values seen).
+    kwargs are passed to model.forward. If path is given, the ranges are also saved there (see load_calibration)"""
+    device = next(model.parameters()).device
+    training = model.training
+    model.eval()
+    for m in quant_measures(model):
+        m.calibration = method
+        m.sketch = HistogramQuantile() if method == 'histogram' else None
+    start_calibration(model, eval_mode=True)
+    with torch.no_grad():
+        for i, batch in enumerate(batches):
+            if i == num_batches:
+                break
+            if isinstance(batch, (list, tuple)):
+                batch = batch[0]
+            model(batch.to(device, non_blocking=True), **kwargs)
+    print('\n')
+    finish_calibration(model, tag='calibration')
+    model.train(training)
+    if path is not None:
+        save_calibration(model, path)
+
+
+def save_calibration(model, path):
+    if torch.distributed.is_available() and torch.distributed.is_initialized() and torch.distributed.get_rank() != 0:
+        return
+    ranges = {}
+    for name, m in model.named_modules():
+        if isinstance(m, (QuantMeasure, FractionQuantMeasure)):
+            ranges[name.replace('module.', '')] = {'running_min': m.running_min.cpu(), 'running_max': m.running_max.cpu()}
+    torch.save(ranges, path)
+    print('\nSaved activation ranges of {:d} quantizers to {}\n'.format(len(ranges), path))
+
+
+def load_calibration(model, path):
+    ranges = torch.load(path, map_location='cpu')
+    for name, m in model.named_modules():
+        if isinstance(m, (QuantMeasure, FractionQuantMeasure)):
+            name = name.replace('module.', '')
+            if name not in ranges:
+                print('\n\nNo calibrated range for {} in {}\n\n'.format(name, path))
+                raise(SystemExit)
+            m.running_min = ranges[name]['running_min'].to(m.running_min)
+            m.running_max = ranges[name]['running_max'].to(m.running_max)
+            m.calculate_running = False
+    print('\nLoaded activation ranges of {:d} quantizers from {}\n'.format(len(ranges), path))
+
+
+def calibrate_or_load(model, args, batches, **kwargs):
+    """Activation ranges from --calibration_file (if it exists) or from an offline pass (--calibrate) over batches.
+    Either way the in-loop calibration (--calculate_running) is turned off"""
+    if args.calibration_file is not None and os.path.exists(args.calibration_file):
+        load_calibration(model, args.calibration_file)
+    elif args.calibrate:
+        calibrate(model, batches, num_batches=args.calibration_batches, method=args.calibration, path=args.calibration_file, **kwargs)
+    else:
+        return
+    args.calculate_running = False
+
+
+class NoiseSampler(object):
+    """Noise source for add_noise_calculate_power.
+
+    Draws standard normal or uniform samples in place and scales them (reparameterization) instead of building
+    torch.distributions objects on every call. With reuse_buffers, calls made with reuse=True (the callers pass
+    not self.training, i.e. only when testing) write into one noise tensor per layer, which the next call for that layer
+    overwrites, so the returned noise is only valid until then. In training every call gets a new tensor: the noise can end
+    up saved for backward (e.g. output * noise), and refilling it before the backward pass would corrupt the gradients. With a seed, every (layer, call) pair gets its
+    own generator state derived from (seed, layer_num, call counter), which makes the noise reproducible independently of
+    any other use of the global RNG.
+    """
+
+    def __init__(self, reuse_buffers=True, seed=None):
+        self.reuse_buffers = reuse_buffers
+        self.seed = seed
+        self.buffers = {}
+        self.generators = {}
+        self.counters = {}
+
+    def reset(self):
+        self.counters = {}
+
+    def buffer(self, like, layer_num, shape=None, reuse=False):
+        shape = like.shape if shape is None else torch.Size(shape)
+        if not (self.reuse_buffers and reuse):
+            return torch.empty(shape, dtype=like.dtype, device=like.device)
+        buf = self.buffers.get(layer_num)
+        if (buf is None or buf.shape != shape or buf.dtype != like.dtype or buf.device != like.device
+                or buf.is_inference() != torch.is_inference_mode_enabled()):  # inference tensors can not be written outside inference_mode
+            buf = torch.empty(shape, dtype=like.dtype, device=like.device)
+            self.buffers[layer_num] = buf
+        return buf
+
+    def generator(self, device, layer_num):
+        if self.seed is None:
+            return None
+        key = (layer_num, str(device))
+        if key not in self.generators:
+            self.generators[key] = torch.Generator(device=device)
+        counter = self.counters.get(key, 0)
+        self.counters[key] = counter + 1
+        return self.generators[key].manual_seed(((self.seed * 1000003 + layer_num) * 1000003 + counter) % 2 ** 63)
+
+    def normal(self, like, scale, layer_num=0, shape=None, reuse=False):
+        """N(0, scale^2) noise shaped like `like` (or shape); scale is a number or a broadcastable tensor"""
+        noise = self.buffer(like, layer_num, shape, reuse).normal_(generator=self.generator(like.device, layer_num))
+        return noise.mul_(scale)
+
+    def uniform(self, like, low, high, layer_num=0, shape=None, reuse=False):
+        """U(low, high) noise shaped like `like` (or shape); low and high are numbers or broadcastable tensors"""
+        noise = self.buffer(like, layer_num, shape, reuse).uniform_(generator=self.generator(like.device, layer_num))
+        return noise.mul_(high - low).add_(low)
+
+
+def get_noise_sampler(self, args):
+    if not hasattr(self, 'noise_sampler'):
+        self.noise_sampler = NoiseSampler(reuse_buffers=args.reuse_noise_buffers, seed=args.noise_seed)
+    return self.noise_sampler
+
+
+class LayerStats(object):
+    """Per layer power, NSR and input sparsity measured by add_noise_calculate_power.
+
+    Values are summed on the device as they are added, so collecting them does not wait for the device; means() copies
+    all of them to the host in one transfer (e.g. at the end of an epoch). Statistics are collected from the batches
+    which start within the first `samples` samples of every pass over the data (so the window does not depend on the batch
+    size, e.g. --eval_batch_size), on every `every`-th batch.
+    """
+    names = ['power', 'nsr', 'input_sparsity']
+
+    def __init__(self, samples=1280, every=1):
+        self.samples = samples
+        self.every = every
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.counts = {}
+
+    def collect(self, i, batch_size):
+        return i * batch_size < self.samples and i % self.every == 0
+
+    def add(self, layer_num, power, nsr, input_sparsity):
+        values = torch.stack([v.double() for v in (power, nsr, input_sparsity)])
+        if layer_num in self.sums:
+            self.sums[layer_num] = self.sums[layer_num] + values  # not in place: sums may be inference tensors (utils.evaluate)
+        else:
+            self.sums[layer_num] = values
+        self.counts[layer_num] = self.counts.get(layer_num, 0) + 1
+
+    def means(self, num_layers):
+        """{name: [mean value in every layer]}, nan for layers without samples"""
+        means = {name: [float('nan')] * num_layers for name in self.names}
+        layers = sorted(self.sums)
+        if len(layers) == 0:
+            return means
+        sums = torch.stack([self.sums[layer] for layer in layers]).tolist()
+        for layer, values in zip(layers, sums):
+            for name, value in zip(self.names, values):
+                means[name][layer] = value / self.counts[layer]
+        return means
+
+
+def get_layer_stats(self):
+    if not hasattr(self, 'layer_stats'):
+        self.layer_stats = LayerStats()
+    return self.layer_stats
+
+
+def noise_mode(self, args):
+    """Noise model used by add_noise_calculate_power: one of the synthetic modes, or 'current' (physical model)"""
+    for mode in ['uniform_ind', 'uniform_dep', 'normal_ind', 'normal_dep']:
+        if getattr(args, mode) > 0 and (self.training or args.noise_test):
+            return mode
+    return 'current'
+
+
+def fused_conv_sigmas(input, weight, filters, layer_type='conv', bias=None, stride=1, padding=0, dilation=1):
+    """Convolve input with weight and with each of filters (weight shaped tensors) in a single F.conv2d/F.linear call.
+
+    The filters are concatenated with the weights along the output channel dimension, so the input is read once. Returns
+    the layer output and the list of filter outputs.
+    """
+    out_channels = weight.size(0)
+    fused_weight = torch.cat([weight] + filters, 0)
+    if bias is not None:
+        bias = torch.cat([bias, bias.new_zeros(fused_weight.size(0) - out_channels)])
+
+    if layer_type == 'conv':
+        fused_output = F.conv2d(input, fused_weight, bias, stride, padding, dilation)
+    elif layer_type == 'linear':
+        fused_output = F.linear(input, fused_weight, bias)
+
+    outputs = torch.split(fused_output, out_channels, dim=1)
+    return outputs[0], list(outputs[1:])
+
+
+def noisy_layer_forward(self, args, layer, input, layer_type='conv', i=0, layer_num=0, merged_dac=True):
+    """Run layer on input, and with --fused_sigmas also compute the sigma maps which add_noise_calculate_power needs for this
+    layer in the same call (see fused_conv_sigmas). Returns the layer output and the dict of sigma maps to pass to
+    add_noise_calculate_power (empty if they are not precomputed).
+
+    The fused call is only used when autograd is off (during training the backward pass would also run over the sigma
+    channels), and only for conv layers: for linear layers one wider matmul is slower than separate ones (benchmark.py).
+    """
+    if (not args.fused_sigmas or args.layer_currents[layer_num] == 0 or args.distort_act or args.sweep_currents or torch.is_grad_enabled()
+            or noise_mode(self, args) != 'current' or not isinstance(layer, NoisyConv2d) or layer.groups != 1):
+        return layer(input), {}
+
+    with torch.no_grad():
+        stats = weight_stats(self, layer.weight, layer_num, merged_dac=merged_dac)
+        if merged_dac:
+            names = ['sigmas']
+            filters = [stats['abs']]
+        else:
+            names = ['sigmas_w_squared']
+            filters = [stats['abs_w_squared']]
+            if get_layer_stats(self).collect(i, input.size(0)):
+                names.append('sigmas')
+                filters.append(stats['abs'])
+
+        output, sigmas = layer.forward_fused(input, filters)
+    return output, dict(zip(names, sigmas))
+
+
+def add_noise_sweep_currents(self, args, input, weights, output, currents, layer_type='conv', layer_num=0, merged_dac=True):
+    """Add analog noise for several current levels in a single pass.
+
+    The batch holds len(currents) copies of the same samples, one per current level (a leading current axis folded into
+    the batch dimension: (len(currents) * batch_size, ...), see --sweep_currents in noisynet.py), and the noise of each
+    copy uses its own current. The noise for all current levels is sampled at once. Power/noise stats are not collected in this mode.
+    """
+    with torch.no_grad():
+        num_currents = len(currents)
+        if output.size(0) % num_currents != 0:
+            print('\n\nadd_noise_sweep_currents: batch of {:d} is not made of {:d} copies (one per current)\n\n'.format(output.size(0), num_currents))
+            raise(SystemExit)
+        batch_size = output.size(0) // num_currents
+        stats = weight_stats(self, weights, layer_num, merged_dac=merged_dac)
+        if merged_dac:
+            filters = stats['abs']
+        else:
+            filters = stats['abs_w_squared']
+
+        if layer_type == 'conv':
+            sigmas = F.conv2d(input, filters)
+        elif layer_type == 'linear':
+            sigmas = F.linear(input, filters, bias=None)
+
+        if merged_dac:
+            max_value = stats['w_max']
+        else:
+            max_value = input.view(num_currents, -1).max(1)[0]
+
+        currents = torch.tensor(currents, dtype=output.dtype, device=output.device)
+        var_scale = (0.1 * max_value / currents).view([num_currents] + [1] * output.dim())
+        sigmas = sigmas.view([num_currents, batch_size] + list(sigmas.shape[1:]))
+        noise = get_noise_sampler(self, args).normal(output, torch.sqrt(var_scale * sigmas), layer_num, shape=sigmas.shape, reuse=not self.training)
+
+    noisy_out = output.view([num_currents, batch_size] + list(output.shape[1:])) + noise
+    return noisy_out.view([-1] + list(output.shape[1:]))
+
+
+def add_noise_calculate_power(self, args, arrays, input, weights, output, layer_type='conv', i=0, layer_num=0, merged_dac=True, precomputed=None):
+    sampler = get_noise_sampler(self, args)
+
     if args.distort_act:
         with torch.no_grad():
-            noise = output * torch.cuda.FloatTensor(output.size()).uniform_(-args.noise, args.noise)
+            noise = sampler.uniform(output, -args.noise, args.noise, layer_num, reuse=not self.training).mul_(output)
         return output + noise
 
+    if args.sweep_currents:
+        return add_noise_sweep_currents(self, args, input, weights, output, args.layer_currents[layer_num],
+                                        layer_type=layer_type, layer_num=layer_num, merged_dac=merged_dac)
+
+    if precomputed is None:
+        precomputed = {}
+
     #merged_dac = True
+    mode = noise_mode(self, args)
+    collect = get_layer_stats(self).collect(i, input.size(0))
     with torch.no_grad():
-        if (args.uniform_ind > 0 and self.training) or (args.uniform_ind > 0 and args.noise_test):
-            sigmas = torch.ones_like(output) * args.uniform_ind * torch.max(torch.abs(output))
-            noise_distr = Uniform(-sigmas, sigmas)
-            noise = noise_distr.sample()
+        if mode == 'uniform_ind':
+            sigmas = args.uniform_ind * torch.max(torch.abs(output))
+            noise = sampler.uniform(output, -sigmas, sigmas, layer_num, reuse=not self.training)
 
-        elif (args.uniform_dep > 0 and self.training) or (args.uniform_dep > 0 and args.noise_test):
-            noise_distr = Uniform(torch.ones_like(output) * args.uniform_dep, torch.ones_like(output) / args.uniform_dep)
-            noise = noise_distr.sample()
+        elif mode == 'uniform_dep':
+            noise = sampler.uniform(output, args.uniform_dep, 1. / args.uniform_dep, layer_num, reuse=not self.training)
 
-        elif (args.normal_ind > 0 and self.training) or (args.normal_ind > 0 and args.noise_test):
-            sigmas = (torch.ones_like(output) * args.normal_ind * torch.max(torch.abs(output))).pow(2)
-            noise_distr = Normal(loc=0, scale=torch.ones_like(output) * args.normal_ind * torch.max(torch.abs(output)))
-            noise = noise_distr.sample()
+        elif mode == 'normal_ind':
+            scale = args.normal_ind * torch.max(torch.abs(output))
+            sigmas = scale.pow(2)
+            noise = sampler.normal(output, scale, layer_num, reuse=not self.training)
 
-        elif (args.normal_dep > 0 and self.training) or (args.normal_dep > 0 and args.noise_test):
-            sigmas = (args.normal_dep * output).pow(2)
-            noise_distr = Normal(loc=0, scale=args.normal_dep * output)
-            noise = noise_distr.sample()
+        elif mode == 'normal_dep':
+            scale = args.normal_dep * output
+            sigmas = scale.pow(2)
+            noise = sampler.normal(output, scale, layer_num, reuse=not self.training)
 
         else:
-            abs_weights = torch.abs(weights)
+            stats = weight_stats(self, weights, layer_num, merged_dac=merged_dac)
+            abs_weights = stats['abs']
             input_max = torch.max(input)  # always 1 for RGB input, unless < 5 bits Imagenet.
             if merged_dac:  # merged DAC digital input (for the current chip - first and third layer input):
-                w_max = torch.max(abs_weights)
-                if layer_type == 'conv':
+                w_max = stats['w_max']
+                if 'sigmas' in precomputed:
+                    sigmas = precomputed['sigmas']
+                    dim = (1, 2, 3) if layer_type == 'conv' else 1
+                elif layer_type == 'conv':
                     sigmas = F.conv2d(input, abs_weights)
                     dim = (1, 2, 3)
                 elif layer_type == 'linear':
                     sigmas = F.linear(input, abs_weights, bias=None)
                     dim = 1
 
-                if i < 20:
+                if collect:
                     sample_sums = torch.sum(sigmas, dim=dim)
                     p = 1.0e-6 * 1.2 * args.layer_currents[layer_num] * torch.mean(sample_sums) / (input_max * w_max)
 
-                noise_distr = Normal(loc=0, scale=torch.sqrt(0.1 * (w_max / args.layer_currents[layer_num]) * sigmas))
+                scale = sigmas.mul(0.1 * w_max / args.layer_currents[layer_num]).sqrt_()
 
             else:  # external DAC (for the next gen hardware) or analog input in the current chip (layers 2 and 4)
-                abs_w_squared = abs_weights.pow(2) + abs_weights
+                abs_w_squared = stats['abs_w_squared']
 
-                if layer_type == 'conv':
+                if 'sigmas_w_squared' in precomputed:
+                    sigmas_w_squared = precomputed['sigmas_w_squared']
+                    dim = (1, 2, 3) if layer_type == 'conv' else 1
+                    if collect:
+                        sigmas = precomputed['sigmas']
+
+                elif layer_type == 'conv':
                     sigmas_w_squared = F.conv2d(input, abs_w_squared)
                     dim = (1, 2, 3)
-                    if i < 20:
+                    if collect:
                         sigmas = F.conv2d(input, abs_weights)
 
                 elif layer_type == 'linear':
                     sigmas_w_squared = F.linear(input, abs_w_squared, bias=None)
                     dim = 1
 
-                    if i < 20:
+                    if collect:
                         sigmas = F.linear(input, abs_weights, bias=None)
 
-                if i < 20:
+                if collect:
                     sample_sums = torch.sum(sigmas, dim=dim)
                     p = 1.0e-6 * 1.2 * args.layer_currents[layer_num] * torch.mean(sample_sums) / input_max
 
-                noise_distr = Normal(loc=0, scale=torch.sqrt(0.1 * (input_max / args.layer_currents[layer_num]) * sigmas_w_squared))
+                scale = sigmas_w_squared.mul(0.1 * input_max / args.layer_currents[layer_num]).sqrt_()
 
-            noise = noise_distr.sample()
+            noise = sampler.normal(output, scale, layer_num, reuse=not self.training)
 
-            if i < 20:
-                self.power[layer_num].append(p.item())
-                self.nsr[layer_num].append(torch.mean(torch.abs(noise) / torch.max(output)).item())
-                self.input_sparsity[layer_num].append(input[input > 0].numel() / input.numel())
+            if collect:
+                self.layer_stats.add(layer_num, p, torch.mean(torch.abs(noise) / torch.max(output)), torch.count_nonzero(input > 0) / input.numel())
 
     if (args.plot or args.write):
         if merged_dac:
@@ -119,10 +452,10 @@ def add_noise_calculate_power(self, args, arrays, input, weights, output, layer_
             if args.plot_power:
                 arrays.append([(sigmas / input_max).half()])
 
-    if (args.uniform_dep > 0 and self.training) or (args.uniform_dep > 0 and args.noise_test):
-        noisy_out = output * noise.cuda()
+    if mode == 'uniform_dep':
+        noisy_out = output * noise
     else:
-        noisy_out = output + noise.cuda()
+        noisy_out = output + noise
 
     return noisy_out
 
@@ -132,53 +465,35 @@ class UniformQuantize(InplaceFunction):
 
     @classmethod
     def forward(cls, ctx, input, num_bits=8, min_value=None, max_value=None, stochastic=0.5, inplace=False, debug=False):
-        ctx.inplace = inplace
-        ctx.num_bits = num_bits
-        ctx.min_value = min_value
-        ctx.max_value = max_value
-        ctx.stochastic = stochastic
-        ctx.save_for_backward(input)
-
-        if ctx.inplace:
-            ctx.mark_dirty(input)
-            output = input
-        else:
-            output = input.clone()
-
         qmin = 0.
         qmax = 2. ** num_bits - 1.
         scale = (max_value - min_value) / (qmax - qmin)
         scale = max(scale, 1e-6)  # TODO figure out how to set this robustly! causes nans
 
         with torch.no_grad():
-            output.add_(-min_value).div_(scale).add_(qmin)
+            # only the saturation mask is needed for the backward pass
+            saturated = (input > max_value) | (input < min_value)
+            ctx.save_for_backward(saturated)
             if debug:
                 print('\nnum_bits {:d} qmin {} qmax {} min_value {} max_value {} actual max value {}'.format(num_bits, qmin, qmax, min_value, max_value,
                                                                                                              input.max()))
                 print('\ninitial input\n', input[0, 0])
-                print('\nnormalized input\n', output[0, 0])
-            if ctx.stochastic > 0:
-                noise = output.new(output.shape).uniform_(-ctx.stochastic, ctx.stochastic)
-                output.add_(noise)
-                if debug:
-                    print('\nadding noise (stoch={:.1f})\n{}\n'.format(ctx.stochastic, output[0, 0]))
 
-            output.clamp_(qmin, qmax).round_()  # quantize
-            if debug:
-                print('\nquantized\n', output[0, 0])
+            if inplace:
+                ctx.mark_dirty(input)
+            output = quantize_dequantize(input, float(min_value), float(scale), qmax, float(stochastic), inplace)
 
-            output.add_(-qmin).mul_(scale).add_(min_value)  # dequantize
         if debug:
+            print('\nquantized (stoch={:.1f})\n{}'.format(stochastic, ((output[0, 0] - min_value) / scale).round()))
             print('\ndenormalized output\n', output[0, 0])
         return output
 
     @staticmethod
     def backward(ctx, grad_output):
         # Saturated Straight Through Estimator
-        input, = ctx.saved_tensors
+        saturated, = ctx.saved_tensors
         # Should we clone the grad_output???
-        grad_output[input > ctx.max_value] = 0
-        grad_output[input < ctx.min_value] = 0
+        grad_output.masked_fill_(saturated, 0)
         # grad_input = grad_output
         return grad_output, None, None, None, None, None, None
 
@@ -202,10 +517,12 @@ class QuantMeasure(nn.Module):
     Currently, calculate_running param is set in the training code, and NOT passed as an argument - TODO need to fix that
 
     If using dropout, during training the activations are divided by 1-p. Multiply calculate_running by 1-p during test.
+
+    calibration='histogram' collects a streaming HistogramQuantile sketch instead of a kthvalue per batch (see quant.py)
     """
 
     def __init__(self, num_bits=8, momentum=0.0, stochastic=0.5, min_value=0., max_value=0., scale=1,
-                 calculate_running=False, pctl=90., debug=False, inplace=False):
+                 calculate_running=False, pctl=90., debug=False, inplace=False, calibration='kthvalue'):
         super(QuantMeasure, self).__init__()
         self.register_buffer('running_min', torch.zeros(1))
         self.register_buffer('running_max', torch.zeros([]))
@@ -223,6 +540,24 @@ class QuantMeasure(nn.Module):
         if pctl < 1:
             print('\n\npctl is {} please check!!!\n\n\n'.format(pctl))
             raise(SystemExit)
+        self.calibration = calibration
+        self.sketch = HistogramQuantile() if calibration == 'histogram' else None
+
+    def start_calibration(self, eval_mode=False):
+        self.calculate_running = True
+        self.running_list = []
+        if self.sketch is not None:
+            self.sketch.reset()
+
+    def finish_calibration(self):
+        """Stop collecting statistics, and set running_max from the ones collected so far (if any)"""
+        self.calculate_running = False
+        if self.sketch is not None:
+            self.sketch.merge_distributed()
+        if self.sketch is not None and self.sketch.hist is not None and self.sketch.range > 0:
+            self.running_max = self.sketch.quantile(self.pctl / 100.).to(self.running_max)
+        elif len(self.running_list) > 0:
+            self.running_max = torch.stack([v.to(self.running_max) for v in self.running_list]).mean()
 
     def forward(self, input):
         # max_value_their = input.detach().contiguous().view(input.size(0), -1).max(-1)[0].mean()
@@ -243,6 +578,9 @@ class QuantMeasure(nn.Module):
                             pctl = torch.tensor(0.92)  # args.q_a_first == 4
                         else:
                             pctl = torch.tensor(1.0)
+                    elif self.sketch is not None:
+                        self.sketch.update(input)
+                        pctl = None
                     else:
                         #print('\nlen(input)', input.numel(), 'pctl', self.pctl, 'self.pctl / 100.', self.pctl / 100., 'int(input.numel() * self.pctl / 100.)',
                               #int(input.numel() * self.pctl / 100.), 'max', input.max().item(), 'min', input.min().item())
@@ -252,16 +590,17 @@ class QuantMeasure(nn.Module):
                     # max_value = pctl
                     max_value = input.max().item()
                     # raise(SystemExit)
-                    self.running_list.append(pctl)  # self.running_max)
+                    if pctl is not None:
+                        self.running_list.append(pctl)  # self.running_max)
                     # self.running_max.mul_(self.momentum).add_(max_value * (1 - self.momentum))
-                    if self.debug:
-                        print('{} gpu {} self.calculate_running {}  max value (pctl/actual) {:.3f}/{:.1f}'.format(
-                            list(input.shape), torch.cuda.current_device(), self.calculate_running, pctl.item(), input.max().item()))
+                    if self.debug and pctl is not None:
+                        print('{} device {} self.calculate_running {}  max value (pctl/actual) {:.3f}/{:.1f}'.format(
+                            list(input.shape), input.device, self.calculate_running, pctl.item(), input.max().item()))
             else:
                 if self.debug:
                     pctl, _ = torch.kthvalue(input.flatten(), int(input.numel() * self.pctl / 100.))
-                    print('{} gpu {} self.calculate_running {}  max value (pctl/actual) {:.3f}/{:.1f}'.format(
-                            list(input.shape), torch.cuda.current_device(), self.calculate_running, pctl.item(), input.max().item()))
+                    print('{} device {} self.calculate_running {}  max value (pctl/actual) {:.3f}/{:.1f}'.format(
+                            list(input.shape), input.device, self.calculate_running, pctl.item(), input.max().item()))
                 if self.min_value < 0 and self.running_min < 0:
                     min_value = self.running_min.item()
                     max_value = self.running_max.item()
@@ -277,8 +616,8 @@ class QuantMeasure(nn.Module):
                     max_value = max_value * self.scale
 
             if False and self.debug:  # list(input.shape) == [input.shape[0], 512] and torch.cuda.current_device() == 1:
-                print('{} gpu {}  max value (pctl/running/actual) {:.1f}/{:.1f}/{:.1f}'.format(
-                    list(input.shape), torch.cuda.current_device(), self.running_max.item(), input.max().item() * 0.95, input.max().item()))
+                print('{} device {}  max value (pctl/running/actual) {:.1f}/{:.1f}/{:.1f}'.format(
+                    list(input.shape), input.device, self.running_max.item(), input.max().item() * 0.95, input.max().item()))
 
             if self.training:
                 stoch = self.stochastic
@@ -325,7 +664,7 @@ class NoisyConv2d(nn.Conv2d):
         self.debug = debug
         self.test_noise = test_noise
 
-    def forward(self, input):
+    def prepare(self, input):
         if self.debug:
             print('\n\nEntering Convolutional Layer with {:d} {:d}x{:d} filters'.format(self.fms, self.fs, self.fs))
 
@@ -359,12 +698,20 @@ class NoisyConv2d(nn.Conv2d):
             if self.bias is not None:
                 bias = AddNoise().apply(self.bias, self.noise, self.debug)
 
+        return qinput, weight, bias
+
+    def forward(self, input):
+        qinput, weight, bias = self.prepare(input)
         output = F.conv2d(qinput, weight, bias, self.stride, self.padding, self.dilation, self.groups)
         if self.debug:
             pass
             #raise(SystemExit)
         return output
 
+    def forward_fused(self, input, filters):
+        qinput, weight, bias = self.prepare(input)
+        return fused_conv_sigmas(qinput, weight, filters, layer_type='conv', bias=bias, stride=self.stride, padding=self.padding, dilation=self.dilation)
+
 
 class NoisyLinear(nn.Linear):
 
@@ -383,7 +730,7 @@ class NoisyLinear(nn.Linear):
         self.debug = debug
         self.test_noise = test_noise
 
-    def forward(self, input):
+    def prepare(self, input):
         if self.debug:
             print('\n\nEntering Fully connected Layer {:d}x{:d}\n\n'.format(self.fc_in, self.fc_out))
 
@@ -418,6 +765,11 @@ class NoisyLinear(nn.Linear):
                 print('\n\nAfter:\n{}'.format(weight[0, :20]))
             if self.bias is not None:
                 bias = AddNoise().apply(self.bias, self.noise, self.debug)
+
+        return qinput, weight, bias
+
+    def forward(self, input):
+        qinput, weight, bias = self.prepare(input)
         output = F.linear(qinput, weight, bias)
 
         return output
@@ -453,7 +805,7 @@ def distort_tensor(self, args, input, scale=0, stop=False):   # TODO this is hor
                 print('\nbefore  {}\noffsets {}\nafter   {}\n'.format(
                     input.flatten().detach().cpu().numpy()[:6], offsets.flatten().detach().cpu().numpy()[:6], out.flatten().detach().cpu().numpy()[:6]))
         else:
-            noise = input * torch.cuda.FloatTensor(input.size()).uniform_(-args.noise, args.noise)
+            noise = input * torch.empty_like(input).uniform_(-args.noise, args.noise)
             out = input + noise
     return out
 
@@ -6,7 +6,6 @@ import warnings
 import logging
 import numpy as np
 from datetime import datetime
-import copy
 import random
 
 import torch
@@ -17,6 +16,7 @@ import torch.backends.cudnn as cudnn
 import torch.optim
 import torch.utils.data
 import torch.nn.functional as F
+from torch.func import functional_call
 
 try:
     from apex import amp
@@ -34,7 +34,8 @@ from models.resnet import ResNet18
 from models.mobilenet import mobilenet_v2  #MobileNetV2
 
 import utils
-from hardware_model import QuantMeasure
+from fault_injection import WeightFaults
+from hardware_model import QuantMeasure, clear_sigma_cache, start_calibration, finish_calibration, calibrate_or_load
 #from mn import mobilenet_v2
 
 def parse_args():
@@ -45,6 +46,7 @@ def parse_args():
     parser.add_argument('--epochs', default=150, type=int, metavar='N', help='number of total epochs to run')
     parser.add_argument('--start-epoch', default=0, type=int, metavar='N', help='manual epoch number (useful on restarts)')
     parser.add_argument('-b', '--batch_size', '--batchsize', '--batch-size', '--bs', default=256, type=int, metavar='N')
+    parser.add_argument('--eval_batch_size', default=1000, type=int, help='batch size for test accuracy of in memory (cifar) datasets')
     parser.add_argument('--lr', '--LR', '--learning-rate', default=0.1, type=float, metavar='LR', help='initial learning rate', dest='lr')
     parser.add_argument('--gamma', type=float, default=0.1, help='LR is multiplied by gamma on schedule.')
     parser.add_argument('--momentum', default=0.9, type=float, metavar='M', help='momentum')
@@ -53,6 +55,7 @@ def parse_args():
     parser.add_argument('--L3', type=float, default=0.000, metavar='', help='L2 for param grads')
     parser.add_argument('-p', '--print-freq', default=1000, type=int, metavar='N', help='print frequency')
     parser.add_argument('--resume', default='', type=str, metavar='PATH', help='path to latest checkpoint')
+    parser.add_argument('--mmap_checkpoint', dest='mmap_checkpoint', action='store_true', help='memory map --resume checkpoint instead of reading it all (torch >= 2.1)')
     parser.add_argument('--tag', default='', type=str, metavar='PATH', help='tag')
     parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true', help='evaluate model on validation set')
     parser.add_argument('--debug', dest='debug', action='store_true', help='debug')
@@ -65,6 +68,10 @@ def parse_args():
     parser.add_argument('--step-after', default=30, type=int, help='reduce LR after this number of epochs')
     parser.add_argument('--seed', default=None, type=int, help='seed for initializing training. ')
     parser.add_argument('--num_sims', default=1, type=int, help='number of simulations.')
+    parser.add_argument('--mc_sims', dest='mc_sims', action='store_true', help='test_distortion: evaluate all num_sims weight draws on each test batch, in one pass over the test set')
+    parser.add_argument('--ci_tolerance', default=0.0, type=float, help='test_distortion: stop evaluating a sim once its accuracy confidence interval (on a random part of the test set) is narrower than this (%%), and stop running sims once the interval of their mean accuracy is, 0: evaluate everything')
+    parser.add_argument('--ci_z', default=1.96, type=float, help='width of the --ci_tolerance confidence intervals in standard deviations (1.96: 95%%)')
+    parser.add_argument('--ci_min_sims', default=3, type=int, help='with --ci_tolerance, run at least this many sims per noise level before stopping')
     parser.add_argument('--var_name', default=None, type=str, help='var name for hyperparam search. ')
     parser.add_argument('--q_a', default=4, type=int, help='number of bits to quantize layer input')
     parser.add_argument('--q_a_first', default=0, type=int, help='number of bits to quantize first layer input (RGB dataset)')
@@ -82,14 +89,20 @@ def parse_args():
     parser.add_argument('--scale_bias', default=0, type=float, help='scale bias by this amount (merge_bn bias)')
     parser.add_argument('--pctl', default=99.98, type=float, help='percentile to use for input/activation clipping (usually for quantization)')
     parser.add_argument('--w_pctl', default=0, type=float, help='percentile to use for weights clipping')
+    parser.add_argument('--calibration_batches', default=5, type=int, help='number of batches for the --calibrate pass')
+    parser.add_argument('--calibration_file', default=None, type=str, help='load activation ranges from this file if it exists, otherwise save them there after --calibrate')
+    parser.add_argument('--calibration', default='kthvalue', type=str, help='activation range calibration (with --calculate_running): kthvalue (average over 5 batches) or histogram (streaming, whole first epoch)')
     parser.add_argument('--offset', default=0, type=float, help='offset values to add to activations (opamp distortion)')
     parser.add_argument('--offset_input', default=0, type=float, help='offset values to add to model input (opamp distortion)')
     parser.add_argument('--gpu', default=None, type=str, help='GPU to use, if None use all')
+    parser.add_argument('--device', default=None, type=str, help='device to run on (e.g. cpu, cuda:0), if None use cuda:0 when available')
+    parser.add_argument('--num_threads', default=0, type=int, help='number of CPU threads per process (0: torch default)')
     parser.add_argument('--amp_level', default='O1', type=str, help='GPU to use, if None use all')
     parser.add_argument('--loss_scale', default=128.0, type=float, help='when using FP16 precision, scale loss by this value')
     parser.add_argument('--keep-batchnorm-fp32', type=str, default=None)
     parser.add_argument('--selected_weights', type=float, default=0, metavar='', help='reduce noise for this fraction (%%) of weights by selected_weights_noise_scale')
     parser.add_argument('--selection_criteria', type=str, default=None, metavar='', help='how to choose important weights: "weight_magnitude", "grad_magnitude", "combined"')
+    parser.add_argument('--saliency_cache', type=str, default=None, metavar='', help='directory to save the sorted selection values (selection_criteria) of the weights in, and reuse them from')
     parser.add_argument('--selected_weights_noise_scale', type=float, default=0, metavar='', help='multiply noise for selected_weights by this amount')
     parser.add_argument('--scale_weights', type=float, default=0, metavar='', help='multiply weights by this amount')
     parser.add_argument('--test_temp', type=float, default=0, metavar='', help='temperature sensitivity coefficient, multiply weights by this amount')
@@ -171,6 +184,11 @@ def parse_args():
     feature_parser.add_argument('--no-calculate_running', dest='calculate_running', action='store_false')
     parser.set_defaults(calculate_running=False)
 
+    feature_parser = parser.add_mutually_exclusive_group(required=False)
+    feature_parser.add_argument('--calibrate', dest='calibrate', action='store_true', help='calibrate activation ranges in a separate pass before training/evaluation')
+    feature_parser.add_argument('--no-calibrate', dest='calibrate', action='store_false')
+    parser.set_defaults(calibrate=False)
+
     feature_parser = parser.add_mutually_exclusive_group(required=False)
     feature_parser.add_argument('--q_inplace', dest='q_inplace', action='store_true')
     feature_parser.add_argument('--no-q_inplace', dest='q_inplace', action='store_false')
@@ -214,7 +232,7 @@ def load_from_checkpoint(args):
     if os.path.isfile(args.resume):
         if args.var_name is None:
             print("=> loading checkpoint '{}'".format(args.resume))
-        checkpoint = torch.load(args.resume)
+        checkpoint = utils.load_checkpoint(args.resume, args.device, mmap=args.mmap_checkpoint)
         start_epoch = checkpoint['epoch']
         best_acc = checkpoint['best_acc']
         #model.load_state_dict(checkpoint['state_dict'])
@@ -226,37 +244,12 @@ def load_from_checkpoint(args):
 
         for saved_name, saved_param in checkpoint['state_dict'].items():
             #if saved model used DataParallel, convert this model to DP even if using a single GPU
-            if 'module' in saved_name and torch.cuda.device_count() == 1:
+            if 'module' in saved_name and torch.cuda.device_count() <= 1:
                 model = torch.nn.DataParallel(model)
                 break
-        for saved_name, saved_param in checkpoint['state_dict'].items():
-            matched = False
-            if args.debug:
-                print(saved_name)
-            for name, param in model.named_parameters():
-                if name == saved_name:
-                    matched = True
-                    if args.debug:
-                        print('\tmatched, copying...')
-                    param.data = saved_param.data
-                    #if 'bn' in name and 'weight' in name:
-                        #print('\n\n\nbn weight\n', param)
-            if 'running' in saved_name and 'bn' in saved_name and args.track_running_stats:  #batchnorm stats are not in named_parameters
-                matched = True
-                if args.debug:
-                    print('\tmatched, copying...')
-                m = model.state_dict()
-                m.update({saved_name: saved_param})
-                model.load_state_dict(m)
-            if args.q_a > 0 and ('quantize1' in saved_name or 'quantize2' in saved_name):
-                matched = True
-                if args.debug:
-                    print('\tmatched, copying...')
-                m = model.state_dict()
-                m.update({saved_name: saved_param})
-                model.load_state_dict(m)
-            if not matched and args.debug:
-                print('\t\t\t************ Not copying', saved_name)
+        #batchnorm stats and quantization ranges are not in named_parameters
+        utils.load_matching_state(model, checkpoint['state_dict'], debug=args.debug, buffer_filter=lambda name:
+                                  ('running' in name and 'bn' in name and args.track_running_stats) or (args.q_a > 0 and ('quantize1' in name or 'quantize2' in name)))
         if args.debug:
             print('\n\nCurrent model')
             for name, param in model.state_dict().items():
@@ -278,7 +271,7 @@ def load_from_checkpoint(args):
 def get_gradients(model, args, val_loader):
     params = []
     grads = []
-    criterion = nn.CrossEntropyLoss().cuda()
+    criterion = nn.CrossEntropyLoss().to(args.device)
     for n, p in model.named_parameters():
         if ('conv' in n or 'fc' in n or 'classifier' in n or 'linear' in n) and 'weight' in n:
             grads.append(torch.zeros_like(p))
@@ -299,15 +292,15 @@ def get_gradients(model, args, val_loader):
         for i, data in enumerate(val_loader):
             if args.dali:
                 input = data[0]["data"]
-                target = data[0]["label"].squeeze().cuda().long()
+                target = data[0]["label"].squeeze().to(args.device).long()
                 images = Variable(input)
                 target = Variable(target)
             else:
                 images, target = data
             if args.fp16 and not args.amp:
                 images = images.half()
-            images = images.cuda(non_blocking=True)
-            target = target.cuda(non_blocking=True)
+            images = images.to(args.device, non_blocking=True)
+            target = target.to(args.device, non_blocking=True)
             output = model(images)
             loss = criterion(output, target)
             batch_grads = torch.autograd.grad(loss, params)  # grads for a single batch
@@ -322,30 +315,67 @@ def get_gradients(model, args, val_loader):
     return grads
 
 
-def select_values(args, params, grads):
-    pctls = []
+def saliency_values(args, params, grads):
     values_list = []
     for p, g in zip(params, grads):
         if args.selection_criteria == 'grad_magnitude':
-            pctl, _ = torch.kthvalue(torch.abs(g.view(-1)), int(g.numel() * (100 - args.selected_weights) / 100.0))
             # distort the weights with top n gradients less than the rest of the weights
             values = g.data
         elif args.selection_criteria == 'weight_magnitude':
-            # choose top K largest weights:
-            pctl, _ = torch.kthvalue(torch.abs(p.view(-1)), int(p.numel() * (100 - args.selected_weights) / 100.0))
-            # distort these largest weights less than the rest of the weights
+            # choose top K largest weights, distort these largest weights less than the rest of the weights
             values = p.clone().data  # torch.where issues when using same data in assign and condition
         elif args.selection_criteria == 'combined':  # first order term of Taylor expansion - product of weight derivative and weight value
-            pctl, _ = torch.kthvalue(torch.abs((g * p).view(-1)), int(g.numel() * (100 - args.selected_weights) / 100.0))
             # distort the weights with top n (weight * gradients)  less than the rest of the weights
             values = g.data * p.clone().data  # torch.where issues when using same data in assign and condition
-        else:
-            print('\n\nUnknown selection criteria: {}, Exiting...\n\n'.format(args.selection_criteria))
-            raise (SystemExit)
-        pctls.append(pctl)
         values_list.append(values)
 
-    return pctls, values_list
+    return values_list
+
+
+saliencies = {}
+
+
+def get_saliency(model, args, params, val_loader):
+    """Selection values of params (saliency_values) and their sorted magnitudes, from which select_values reads the threshold
+    for any args.selected_weights. Computed once per set of weights and selection criterion: kept in memory, and with
+    --saliency_cache also saved there under a hash of the weights, so later runs skip get_gradients as well"""
+    if args.selection_criteria not in ['grad_magnitude', 'weight_magnitude', 'combined']:
+        print('\n\nUnknown selection criteria: {}, Exiting...\n\n'.format(args.selection_criteria))
+        raise (SystemExit)
+    key = '{}_{}'.format(args.selection_criteria, utils.tensor_hash(params))
+    if args.selection_criteria != 'weight_magnitude':
+        key += '_bs{:d}'.format(args.batch_size)  # gradients are accumulated over the first batches of val_loader
+    if key in saliencies:
+        return saliencies[key]
+
+    path = None
+    if args.saliency_cache is not None:
+        path = os.path.join(args.saliency_cache, key + '.pth')
+        if os.path.exists(path):
+            print('\n\nLoading {} saliency from {}\n'.format(args.selection_criteria, path))
+            saliencies[key] = torch.load(path, map_location=args.device)
+            return saliencies[key]
+
+    if args.selection_criteria == 'weight_magnitude':
+        grads = [None] * len(params)
+    else:
+        grads = get_gradients(model, args, val_loader)
+    values = saliency_values(args, params, grads)
+    saliency = {'values': values, 'sorted': [torch.sort(torch.abs(v).flatten())[0] for v in values]}
+
+    if path is not None:
+        os.makedirs(args.saliency_cache, exist_ok=True)
+        tmp_path = '{}.{:d}.tmp'.format(path, os.getpid())
+        torch.save(saliency, tmp_path)
+        os.replace(tmp_path, path)
+    saliencies[key] = saliency
+    return saliency
+
+
+def select_values(args, sorted_values):
+    # the same thresholds torch.kthvalue would return, looked up in the sorted magnitudes. With selected_weights=100 the
+    # threshold is the smallest magnitude, so all weights are selected, instead of wrapping around to the largest one
+    return [s[max(int(s.numel() * (100 - args.selected_weights) / 100.0) - 1, 0)] for s in sorted_values]
 
 
 def distort_weights(args, params, grads=None, values=None, pctls=None, noise=0.0):
@@ -369,7 +399,7 @@ def distort_weights(args, params, grads=None, values=None, pctls=None, noise=0.0
             pctls = [0] * len(params)
 
         for p, g, v, pctl in zip(params, grads, values, pctls):
-            p_noise = p * torch.cuda.FloatTensor(p.size()).uniform_(-noise, noise)
+            p_noise = p * torch.empty_like(p).uniform_(-noise, noise)
             if args.selected_weights > 0:
                 # reduce distortion of selected weights by args.selected_weights_noise_scale
                 p.data = torch.where(torch.abs(v) < pctl, p.data + p_noise, p.data + p_noise * args.selected_weights_noise_scale)
@@ -377,156 +407,163 @@ def distort_weights(args, params, grads=None, values=None, pctls=None, noise=0.0
                 p.data.add_(p_noise)
 
 
+class WeightDistortion(nn.Module):
+    """Runs model with distorted copies of its weights (given by name) through functional_call, so the model itself is never
+    modified or restored between trials. Every weight has one buffer, allocated once and overwritten by each distort() call.
+
+    With draws > 1 the buffers hold that many independent distortions, and forward returns the outputs of all of them
+    stacked, (draws, batch, classes), so every input batch is loaded once for all the draws (--mc_sims)"""
+
+    def __init__(self, model, args, names, values=None, pctls=None, draws=1):
+        super(WeightDistortion, self).__init__()
+        self.model = model
+        self.args = args
+        self.names = names
+        self.draws = draws
+        params = dict(model.named_parameters())
+        self.params = [params[n].detach() for n in names]
+        self.distorted = [torch.empty((draws,) + p.shape, dtype=p.dtype, device=p.device) for p in self.params]
+        self.weights = [dict(zip(names, [w[k] for w in self.distorted])) for k in range(draws)]
+        self.scales = [None] * len(names)
+        if args.selected_weights > 0:
+            # reduce distortion of selected weights by args.selected_weights_noise_scale
+            self.scales = [torch.where(torch.abs(v) < pctl, torch.ones_like(p), torch.full_like(p, args.selected_weights_noise_scale))
+                           for p, v, pctl in zip(self.params, values, pctls)]
+        self.faults = [None] * len(names)
+        if args.stuck_at_weights is not None:
+            # sorted once here for all the noise levels and sims
+            self.faults = [WeightFaults(p) for p in self.params]
+
+    def distort(self, noise):
+        args = self.args
+        with torch.no_grad():
+            for p, w, scale, faults in zip(self.params, self.distorted, self.scales, self.faults):
+                if args.scale_weights > 0 or args.test_temp > 0 or args.stuck_at_weights is not None:
+                    for k in range(self.draws):
+                        self.distort_draw(p, w[k], noise, faults)
+                else:
+                    # same values (and random numbers, for a single draw) as distort_weights
+                    w.uniform_(-noise, noise).mul_(p)
+                    if scale is not None:
+                        w.mul_(scale)
+                    w.add_(p)
+
+    def distort_draw(self, p, w, noise, faults=None):
+        args = self.args
+        if args.scale_weights > 0:
+            torch.mul(p, args.scale_weights, out=w)
+
+        elif args.test_temp > 0:
+            if args.debug:
+                print('\n\n{} Values'.format(list(p.shape)), args.test_temp + 273., noise + 273., (p.abs() / p.abs().max()).cpu().numpy().flatten()[:6],
+                      (args.test_temp + 273.) / (noise + 273.))
+                print('\nBefore', p.cpu().numpy().flatten()[:6])
+            w.copy_(p.sign() * p.abs().max() * (p.abs() / p.abs().max()) ** ((args.test_temp + 273.) / (args.temperature + 273.)))
+            if args.debug:
+                print('After ', w.cpu().numpy().flatten()[:6])
+
+        elif args.stuck_at_weights is not None:
+            if args.debug:
+                print('\n\n{} Noise {}  Mode: {}\n'.format(list(p.shape), noise, args.stuck_at_weights))
+                print('\nBefore mean, min, max  {:.4f} {:.4f} {:.4f}\n{}'.format(p.mean().item(), p.min().item(), p.max().item(),
+                                                                                 p.cpu().numpy().flatten()[:60]))
+            num_faults = faults.inject(w, args.stuck_at_weights, noise)
+            if args.debug:
+                print('\n{:d} faulty weights'.format(num_faults))
+                print('\nAfter  mean, min, max  {:.4f} {:.4f} {:.4f}\n{}'.format(w.mean().item(), w.min().item(), w.max().item(), w.cpu().numpy().flatten()[:60]))
+
+    def forward(self, *inputs, **kwargs):
+        if self.draws == 1:
+            return functional_call(self.model, self.weights[0], inputs, kwargs)
+        return torch.stack([functional_call(self.model, weights, inputs, kwargs) for weights in self.weights])
+
+
 def test_distortion(model, args, val_loader=None, mode='weights', vars=None):
     model.eval()
 
-    if mode == 'weights':
-        orig_m = copy.deepcopy(model.state_dict())
     if mode == 'acts':
         args.distort_act = True
 
     acc_d = []
     error_bars = []
+    samples = []
 
     if args.noise > 0:
         vars = [args.noise]
 
     # get weights
+    names = []
     params = []
     for n, p in model.named_parameters():
         if ('conv' in n or 'fc' in n or 'classifier' in n or 'linear' in n) and 'weight' in n:
             #print(n, list(p.shape), p.requires_grad)
+            names.append(n)
             params.append(p)
 
     if args.selected_weights > 0:
-        grads = get_gradients(model, args, val_loader)
-        pctls, values = select_values(args, params, grads)
+        saliency = get_saliency(model, args, params, val_loader)
+        values = saliency['values']
+        pctls = select_values(args, saliency['sorted'])
     else:
-        grads = None
         pctls = None
         values = None
 
+    # with --mc_sims all num_sims draws are evaluated together, in one pass over the test set
+    draws = args.num_sims if args.mc_sims and mode == 'weights' else 1
+    distorted_model = WeightDistortion(model, args, names, values=values, pctls=pctls, draws=draws) if mode == 'weights' else model
+
+    if args.ci_tolerance > 0 and not isinstance(val_loader, tuple) and args.dali:
+        print('\n\n--ci_tolerance needs a shuffled validation set, which the DALI loader does not provide, Exiting...\n\n')
+        raise (SystemExit)
+
     for noise in vars:
         if args.stuck_at_weights is not None:
             print('\n\n{}% {} {} stuck at {}'.format(noise * 100., args.stuck_at_weights.split('_')[0], mode, args.stuck_at_weights.split('_')[1]))
         else:
             print('\n\nDistorting {} by {:d}%'.format(mode, int(noise * 100)))
         te_acc_dist = []
+        # with --ci_tolerance, every sim stops once its own accuracy is known to ci_tolerance, evaluating the test set in a
+        # random order, and sims stop once their mean accuracy is (which includes the spread from draw to draw)
+        sim_samples = []
 
         if args.debug:
             print('\n\nbefore:\n{}\n'.format(model.module.conv1.weight.data.detach().cpu().numpy()[0, 0, 0]))
 
-        for s in range(args.num_sims):
+        for s in range(args.num_sims // draws):
+            if args.ci_tolerance > 0 and len(te_acc_dist) >= max(args.ci_min_sims, 2):
+                if 2 * args.ci_z * np.std(te_acc_dist, ddof=1) / np.sqrt(len(te_acc_dist)) < args.ci_tolerance:
+                    break
+            ci = utils.BinomialCI(args.ci_z) if args.ci_tolerance > 0 else None
             if mode == 'weights':
-                if args.scale_weights > 0:
-                    with torch.no_grad():
-                        for p in params:
-
-                            #print('\n', p.flatten()[:6])
-                            #distort_weights(args, params, noise=0.01)
-                            p.data = args.scale_weights * p.data
-                            #print(p.flatten()[:6])
-
-                elif args.test_temp > 0:
-                    with torch.no_grad():
-                        for p in params:
-                            if list(p.shape) == [64, 64, 3, 3]:
-                                #p.data = args.test_temp * p.data ** args.temperature
-                                #p.data = p.data ** (1. - (args.temperature - 25.) / 12.)
-                                print('\n\nValues', args.test_temp + 273., noise + 273., (p.data.abs() / p.data.abs().max()).cpu().numpy().flatten()[:6],
-                                      (args.test_temp + 273.) / (noise + 273.))
-                                print('\nBefore', p.data.cpu().numpy().flatten()[:6])
-                            #p.data = p.data.sign() * p.data.abs() ** ((args.test_temp + 273.) / (args.temperature + 273.))
-                            #p.data = p.data * p.data.abs().max() * (p.data.abs() / p.data.abs().max()) ** ((args.test_temp + 273.) / (noise + 273.))
-                            p.data = p.data.sign() * p.data.abs().max() * (p.data.abs() / p.data.abs().max()) ** ((args.test_temp + 273.) / (args.temperature + 273.))
-                            #p.data = p.data.sign() * p.data.abs().max() * (p.data.abs() / p.data.abs().max()) ** (1. - (noise - 25.) / 12.)
-                            if list(p.shape) == [64, 64, 3, 3]:
-                                print('After ', p.data.cpu().numpy().flatten()[:6])
-                                #p.data = p.data ** (1. - (args.temperature - 25.) / 12.)
-                                #p.data = p.data ** (args.test_temp + 273. / noise + 273.)
-
-                elif args.stuck_at_weights is not None:
-                    with torch.no_grad():
-                        for p in params:
-                            if args.debug:
-                                print('\n\n{} Noise {}  Mode: {}\n'.format(list(p.shape), noise, args.stuck_at_weights))
-                                print('\nBefore mean, min, max  {:.4f} {:.4f} {:.4f}\n{}'.format(p.mean().item(), p.min().item(), p.max().item(),
-                                                                                                 p.data.cpu().numpy().flatten()[:60]))
-                            if args.stuck_at_weights == 'random_zero':  # stuck at zero faults
-                                mask = torch.cuda.FloatTensor(p.shape).uniform_() > noise
-                                if args.debug:
-                                    print('\nMask: {}\n{}'.format(mask.shape, mask.flatten()[:60]))
-                                #if list(p.shape) != [1000, 512]:  # don't touch output layer weights
-                                #p.data = p.data.div(1.0 - noise) * mask  # should we compensate if we don't know the defect rate?
-                                p.data = p.data * mask
-
-                            elif args.stuck_at_weights == 'largest_zero':   # zero out most important (largest) weights
-                                thr = 1 - noise
-                                pctl_pos, _ = torch.kthvalue(p[p > 0].flatten(), int(p[p > 0].numel() * thr))
-                                pctl_neg, _ = torch.kthvalue(torch.abs(p[p < 0]).flatten(), int(p[p < 0].numel() * thr))
-                                if args.debug:
-                                    print('thr:', thr, 'pctl_neg', -pctl_neg.item(), 'pctl_pos', pctl_pos.item(), 'num elem', p[p > 0].numel(), 'int(p[p > 0].numel() * thr)', int(p[p > 0].numel() * thr))
-                                p.data[p.data > pctl_pos] = 0
-                                p.data[p.data < -pctl_neg] = 0
-
-                            elif args.stuck_at_weights == 'smallest_zero':  # regular pruning
-                                pctl_pos, _ = torch.kthvalue(p[p > 0].flatten(), int(p[p > 0].numel() * noise))
-                                pctl_neg, _ = torch.kthvalue(torch.abs(p[p < 0]).flatten(), int(p[p < 0].numel() * noise))
-                                p_copy_pos = p.data.clone()
-                                p_copy_neg = p.data.clone()
-                                p_copy_pos[p.data < pctl_pos] = 0
-                                p_copy_neg[p.data > -pctl_neg] = 0
-                                p.data = p_copy_pos + p_copy_neg
-                                if args.debug:
-                                    print('\nthr:', noise, 'pctl_neg', -pctl_neg.item(), 'pctl_pos', pctl_pos.item())
-                                    print('p_copy_neg:', p_copy_neg.min().item(), p_copy_neg.max().item())
-                                    print('p_copy_pos:', p_copy_pos.min().item(), p_copy_pos.max().item())
-
-                            elif args.stuck_at_weights == 'random_one':   # stuck at one faults
-                                mask = torch.cuda.FloatTensor(p.shape).uniform_() > noise
-                                if args.debug:
-                                    print('\nMask: {}\n{}'.format(mask.shape, mask.flatten()[:60]))
-                                p_copy = p.data.clone()
-                                p.data = torch.where(mask, p_copy, p_copy.sign()*p_copy.abs().max())
-
-                            if args.debug:
-                                print('\nAfter  mean, min, max  {:.4f} {:.4f} {:.4f}\n{}'.format(p.mean().item(), p.min().item(), p.max().item(), p.data.cpu().numpy().flatten()[:60]))
-                else:
-                    distort_weights(args, params, grads=grads, values=values, pctls=pctls, noise=noise)
+                distorted_model.distort(noise)
 
             if isinstance(val_loader, tuple):   #TODO cifar-10
                 inputs, labels = val_loader
-                te_accs = []
-                for i in range(10000 // args.batch_size):
-                    input = inputs[i * args.batch_size:(i + 1) * args.batch_size]
-                    label = labels[i * args.batch_size:(i + 1) * args.batch_size]
-                    output = model(input)
-                    pred = output.data.max(1)[1]
-                    te_acc = pred.eq(label.data).cpu().sum().numpy() * 100.0 / args.batch_size
-                    te_accs.append(te_acc)
-                te_acc_d = np.mean(te_accs, dtype=np.float64)
+                order = torch.randperm(len(labels), device=labels.device) if ci is not None else None
+                te_acc_d = np.float64(utils.evaluate(distorted_model, inputs, labels, args.eval_batch_size, ci=ci, tolerance=args.ci_tolerance, order=order))
             else:
-                te_acc_d = validate(val_loader, model, args)
+                te_acc_d = validate(val_loader, distorted_model, args, ci=ci)
 
-            te_acc_dist.append(te_acc_d.item())
+            te_acc_dist += np.atleast_1d(te_acc_d).tolist()
+            if ci is not None:
+                sim_samples.append(ci.total // np.size(te_acc_d))
 
-            if args.debug:
-                print('after:\n{}\n'.format(model.module.conv1.weight.data.detach().cpu().numpy()[0, 0, 0]))
-
-            if mode == 'weights':
-                model.load_state_dict(orig_m)
-
-            if args.debug:
-                print('restored:\n{}\n'.format(model.module.conv1.weight.data.detach().cpu().numpy()[0, 0, 0]))
+            if args.debug and mode == 'weights':
+                print('after:\n{}\n'.format(distorted_model.distorted[0][0].detach().cpu().numpy()[0, 0, 0]))
 
         avg_te_acc_dist = np.mean(te_acc_dist, dtype=np.float64)
         error_bars.append(te_acc_dist)
         acc_d.append(avg_te_acc_dist)
         print('\n{}   Noise {:>5.2f}: {}  avg acc {:>5.2f}'.format(args.stuck_at_weights, noise, [float('{:.2f}'.format(v)) for v in te_acc_dist], avg_te_acc_dist))
+        if args.ci_tolerance > 0:
+            samples.append(sim_samples)
+            print('{:d} sims, samples evaluated per sim: {}'.format(len(te_acc_dist), sim_samples))
         #raise(SystemExit)
     print('\n\n{}\n{}\n\n\n'.format(vars, [float('{0:.2f}'.format(x)) for x in acc_d]))
     for var, bar, avg_acc in zip(vars, error_bars, acc_d):
         print('Noise', var, [float('{:.2f}'.format(v)) for v in bar], '{:.2f}'.format(avg_acc))
+    if len(samples) > 0:
+        print('\nSamples evaluated:', samples)
     print('\n\n{}\n'.format(args.stuck_at_weights))
     print(vars)
     print(acc_d)
@@ -653,40 +690,66 @@ def merge_batchnorm(model, args):
             print('\nbn4 scale\n', bn4_scale.view(-1).detach().cpu().numpy())
         model.linear2.weight.data *= bn4_scale
 
+    clear_sigma_cache(model)  # weights were scaled through .data
+
 
-def validate(val_loader, model, args, epoch=0, plot_acc=0.0):
+def calibration_batches(loader, args):
+    for data in loader:
+        if args.dali:
+            images = data[0]["data"]
+        else:
+            images = data[0]
+        if args.fp16 and not args.amp:
+            images = images.half()
+        yield images
+
+
+def calibrate_model(model, args, loader):
+    calibrate_or_load(model, args, calibration_batches(loader, args))
+    if args.dali:
+        loader.reset()
+
+
+def validate(val_loader, model, args, epoch=0, plot_acc=0.0, ci=None):
+    # ci: utils.BinomialCI to count the predictions in, stop once it is narrower than args.ci_tolerance (the loader has to be
+    # shuffled for this to stop on a random part of the validation set, see setup_data)
     model.eval()
     te_accs = []
     with torch.no_grad():
         for i, data in enumerate(val_loader):
             if args.dali:
                 input = data[0]["data"]
-                target = data[0]["label"].squeeze().cuda().long()
+                target = data[0]["label"].squeeze().to(args.device).long()
                 images = Variable(input)
             else:
                 images, target = data
             if args.fp16 and not args.amp:
                 images = images.half()
-            images = images.cuda(non_blocking=True)
-            target = target.cuda(non_blocking=True)
+            images = images.to(args.device, non_blocking=True)
+            target = target.to(args.device, non_blocking=True)
             output = model(images, epoch=epoch, i=i, acc=plot_acc)
             if i == 0:
                 args.print_shapes = False
-            acc = utils.accuracy(output, target)
+            if output.dim() == 3:  # several weight draws (WeightDistortion)
+                acc = [utils.accuracy(o, target) for o in output]
+            else:
+                acc = utils.accuracy(output, target)
             te_accs.append(acc)
+            if ci is not None and args.ci_tolerance > 0:
+                ci.update(int(round(np.sum(acc) * target.size(0) / 100.)), np.size(acc) * target.size(0))
+                if ci.width() < args.ci_tolerance:
+                    break
 
-            if args.q_a > 0 and args.calculate_running and epoch == 0 and i == 4:
+            if args.q_a > 0 and args.calculate_running and epoch == 0 and i == 4 and args.calibration == 'kthvalue':
                 if args.debug:
                     print('\n')
-                with torch.no_grad():
-                    for m in model.modules():
-                        if isinstance(m, QuantMeasure):
-                            m.calculate_running = False
-                            m.running_max = torch.tensor(m.running_list, device='cuda:0').mean()
-                            print('(val) running_list:', ['{:.2f}'.format(v.item()) for v in m.running_list], 'running_max: {:.3f}'.format(m.running_max.item()))
-
-        mean_acc = np.mean(te_accs, dtype=np.float64)
-        print('\n{}\tEpoch {:d}  Validation Accuracy: {:.2f}\n'.format(str(datetime.now())[:-7], epoch, mean_acc))
+                finish_calibration(model, tag='val')
+
+        if args.q_a > 0 and args.calculate_running and epoch == 0 and args.calibration == 'histogram':
+            finish_calibration(model, tag='val')
+
+        mean_acc = np.mean(te_accs, axis=0, dtype=np.float64)
+        print('\n{}\tEpoch {:d}  Validation Accuracy: {:.2f}\n'.format(str(datetime.now())[:-7], epoch, np.mean(mean_acc)))
         if args.dali:
             val_loader.reset()
     return mean_acc
@@ -729,7 +792,7 @@ def build_model(args):
     elif args.var_name is not None:
         utils.print_model(model, args, full=False)
 
-    criterion = nn.CrossEntropyLoss(reduction='mean').cuda()
+    criterion = nn.CrossEntropyLoss(reduction='mean').to(args.device)
 
 
 
@@ -742,7 +805,8 @@ def build_model(args):
             logging.warning('Using more than one GPU per process in distributed mode is not allowed. Setting num_gpu to 1.')
             args.num_gpu = 1
 
-    args.device = 'cuda:0'
+    if args.device is None:
+        args.device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
     args.world_size = 1
     args.rank = 0  # global rank
     if args.distributed:
@@ -769,9 +833,9 @@ def build_model(args):
             logging.warning(
                 'AMP does not work well with nn.DataParallel, disabling. Use distributed mode for multi-GPU AMP.')
             args.amp = False
-        model = nn.DataParallel(model, device_ids=list(range(args.num_gpu))).cuda()
+        model = nn.DataParallel(model, device_ids=list(range(args.num_gpu))).to(args.device)
     else:
-        model.cuda()
+        model.to(args.device)
 
     optimizer = torch.optim.SGD(model.parameters(), args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
 
@@ -858,7 +922,7 @@ def train(train_loader, val_loader, model, criterion, optimizer, start_epoch, be
         for i, data in enumerate(train_loader):
             if args.dali:
                 input = data[0]["data"]
-                target = data[0]["label"].squeeze().cuda().long()
+                target = data[0]["label"].squeeze().to(args.device).long()
                 train_loader_len = int(train_loader._size / args.batch_size)
                 images = Variable(input)
                 target = Variable(target)
@@ -867,8 +931,8 @@ def train(train_loader, val_loader, model, criterion, optimizer, start_epoch, be
             else:
                 images, target = data
                 train_loader_len = len(train_loader)
-                images = images.cuda(non_blocking=True)
-                target = target.cuda(non_blocking=True)
+                images = images.to(args.device, non_blocking=True)
+                target = target.to(args.device, non_blocking=True)
             if args.fp16 and not args.amp:
                 images = images.half()
 
@@ -941,14 +1005,9 @@ def train(train_loader, val_loader, model, criterion, optimizer, start_epoch, be
                     print('{}  Epoch {:>2d} Batch {:>4d}/{:d} LR {:.5f} | {:.2f}'.format(
                         str(datetime.now())[:-7], epoch, i, train_loader_len, float(optimizer.param_groups[0]["lr"]), np.mean(tr_accs, dtype=np.float64)))
 
-            if args.q_a > 0 and args.calculate_running and epoch == start_epoch and i == 5:
+            if args.q_a > 0 and args.calculate_running and epoch == start_epoch and i == 5 and args.calibration == 'kthvalue':
                 print('\n')
-                with torch.no_grad():
-                    for m in model.modules():
-                        if isinstance(m, QuantMeasure):
-                            m.calculate_running = False
-                            m.running_max = torch.tensor(m.running_list, device='cuda:0').mean()
-                            print('(train) running_list:', ['{:.2f}'.format(v.item()) for v in m.running_list], 'running_max: {:.3f}'.format(m.running_max.item()))
+                finish_calibration(model, tag='train')
 
             if args.w_max > 0:
                 for n, p in model.named_parameters():
@@ -967,6 +1026,10 @@ def train(train_loader, val_loader, model, criterion, optimizer, start_epoch, be
                                 args.w_pctl, p.min().item(), p.max().item(), -pctl_neg.item(), pctl_pos.item()))
                         p.data.clamp_(-pctl_neg, pctl_pos)
 
+        if args.q_a > 0 and args.calculate_running and epoch == start_epoch and args.calibration == 'histogram':
+            print('\n')
+            finish_calibration(model, tag='train')
+
         acc = validate(val_loader, model, args, epoch=epoch)
         if acc > best_acc:
             best_acc = acc
@@ -995,6 +1058,9 @@ def main():
     if args.gpu is not None:
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
 
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
     train_loader, val_loader = utils.setup_data(args)
 
     if args.act_max > 0:
@@ -1068,11 +1134,10 @@ def main():
                             raise (SystemExit)
                         break
 
+                if args.q_a > 0:
+                    calibrate_model(model, args, train_loader)
                 if args.calculate_running:
-                    for m in model.modules():
-                        if isinstance(m, QuantMeasure):
-                            m.calculate_running = True
-                            m.running_list = []
+                    start_calibration(model)
                 acc = validate(val_loader, model, args, epoch=start_epoch, plot_acc=best_acc)
                 acc_list.append(acc)
 
@@ -1180,11 +1245,10 @@ def main():
     if args.reset_start_epoch:   # do not scale LR based on start_epoch (default=False)
         start_epoch = 0
 
+    if args.q_a > 0:
+        calibrate_model(model, args, train_loader)
     if args.q_a > 0 and args.calculate_running:
-        for m in model.modules():
-            if isinstance(m, QuantMeasure):
-                m.calculate_running = True
-                m.running_list = []
+        start_calibration(model)
 
     best_acc, best_epoch = train(train_loader, val_loader, model, criterion, optimizer, start_epoch, best_acc, args)
     if args.local_rank == 0:
@@ -213,7 +213,7 @@ class ConvBNReLU(nn.Module):
         self.stride = stride
         self.groups = groups
         if args.q_a > 0:
-            self.quantize = QuantMeasure(args.q_a, stochastic=args.stochastic, scale=args.q_scale, calculate_running=args.calculate_running, pctl=args.pctl / 100, debug=args.debug_quant)
+            self.quantize = QuantMeasure(args.q_a, stochastic=args.stochastic, scale=args.q_scale, calculate_running=args.calculate_running, calibration=args.calibration, pctl=args.pctl / 100, debug=args.debug_quant)
 
     def forward(self, x):
         input = x
@@ -274,9 +274,9 @@ class InvertedResidual(nn.Module):
         self.bn = nn.BatchNorm2d(oup)
 
         if args.q_a > 0:
-            self.quantize1 = QuantMeasure(args.q_a, stochastic=args.stochastic, scale=args.q_scale, calculate_running=args.calculate_running, pctl=args.pctl / 100, debug=args.debug_quant)
-            self.quantize2 = QuantMeasure(args.q_a, stochastic=args.stochastic, scale=args.q_scale, calculate_running=args.calculate_running, pctl=args.pctl / 100, debug=args.debug_quant)
-            self.quantize3 = QuantMeasure(args.q_a, stochastic=args.stochastic, scale=args.q_scale, calculate_running=args.calculate_running, pctl=args.pctl / 100, debug=args.debug_quant)
+            self.quantize1 = QuantMeasure(args.q_a, stochastic=args.stochastic, scale=args.q_scale, calculate_running=args.calculate_running, calibration=args.calibration, pctl=args.pctl / 100, debug=args.debug_quant)
+            self.quantize2 = QuantMeasure(args.q_a, stochastic=args.stochastic, scale=args.q_scale, calculate_running=args.calculate_running, calibration=args.calibration, pctl=args.pctl / 100, debug=args.debug_quant)
+            self.quantize3 = QuantMeasure(args.q_a, stochastic=args.stochastic, scale=args.q_scale, calculate_running=args.calculate_running, calibration=args.calibration, pctl=args.pctl / 100, debug=args.debug_quant)
 
     def forward(self, x):
         input = x
@@ -355,7 +355,7 @@ class MobileNetV2(nn.Module):
             self.bn_out = nn.BatchNorm1d(1000, track_running_stats=args.track_running_stats)
 
         if args.q_a > 0:
-            self.quantize = QuantMeasure(args.q_a, stochastic=args.stochastic, scale=args.q_scale, calculate_running=args.calculate_running, pctl=args.pctl / 100, debug=args.debug_quant)
+            self.quantize = QuantMeasure(args.q_a, stochastic=args.stochastic, scale=args.q_scale, calculate_running=args.calculate_running, calibration=args.calibration, pctl=args.pctl / 100, debug=args.debug_quant)
 
         #self.classifier = nn.Sequential(nn.Dropout(0.2), nn.Linear(self.last_channel, num_classes), )
 
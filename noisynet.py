@@ -11,7 +11,7 @@ import numpy as np
 
 import utils
 from plot_histograms import plot, plot_layers, get_layers
-from hardware_model import add_noise_calculate_power, NoisyConv2d, NoisyLinear, QuantMeasure
+from hardware_model import add_noise_calculate_power, noisy_layer_forward, NoisyConv2d, NoisyLinear, QuantMeasure, LayerStats, start_calibration, finish_calibration, calibrate_or_load
 from main import merge_batchnorm, distort_weights, test_distortion
 import scipy.io
 
@@ -22,6 +22,11 @@ parser = argparse.ArgumentParser(description='Your project title goes here', for
 #parser.add_argument('--dataset', type=str, default='cifar_RGB_4bit.npz', metavar='', help='name of dataset')
 parser.add_argument('--dataset', type=str, default='data/cifar_RGB_4bit.npz', metavar='', help='name of dataset')
 parser.add_argument('--resume', type=str, default=None, metavar='', help='full path of models to resume training')
+
+feature_parser = parser.add_mutually_exclusive_group(required=False)
+feature_parser.add_argument('--mmap_checkpoint', dest='mmap_checkpoint', action='store_true', help='memory map --resume checkpoint instead of reading it all (torch >= 2.1)')
+feature_parser.add_argument('--no-mmap_checkpoint', dest='mmap_checkpoint', action='store_false')
+parser.set_defaults(mmap_checkpoint=False)
 parser.add_argument('--tag', type=str, default='', metavar='', help='string to prepend to args.checkpoint_dir')
 
 feature_parser = parser.add_mutually_exclusive_group(required=False)
@@ -29,6 +34,17 @@ feature_parser.add_argument('--generate_input', dest='generate_input', action='s
 feature_parser.add_argument('--no-generate_input', dest='generate_input', action='store_false')
 parser.set_defaults(generate_input=False)  #default is to load entire cifar into RAM
 
+feature_parser = parser.add_mutually_exclusive_group(required=False)
+feature_parser.add_argument('--mmap_dataset', dest='mmap_dataset', action='store_true', help='memory map a preprocessed .npy cache of the dataset (shared by all runs on the host) instead of decompressing the npz')
+feature_parser.add_argument('--no-mmap_dataset', dest='mmap_dataset', action='store_false')
+parser.set_defaults(mmap_dataset=False)
+parser.add_argument('--dataset_cache', type=str, default=None, metavar='', help='directory of the --mmap_dataset cache (default: next to --dataset)')
+
+feature_parser = parser.add_mutually_exclusive_group(required=False)
+feature_parser.add_argument('--compact_dataset', dest='compact_dataset', action='store_true', help='opt-in memory saving: keep images as uint8 codes (4x less memory), converted to float one batch at a time, which makes every batch gather ~5x slower (benchmark.py compact). Takes precedence over --mmap_dataset')
+feature_parser.add_argument('--no-compact_dataset', dest='compact_dataset', action='store_false')
+parser.set_defaults(compact_dataset=False)
+
 feature_parser = parser.add_mutually_exclusive_group(required=False)
 feature_parser.add_argument('--use_bias', dest='use_bias', action='store_true')
 feature_parser.add_argument('--no-use_bias', dest='use_bias', action='store_false')
@@ -49,6 +65,11 @@ feature_parser.add_argument('--augment', dest='augment', action='store_true')
 feature_parser.add_argument('--no-augment', dest='augment', action='store_false')
 parser.set_defaults(augment=True)
 
+feature_parser = parser.add_mutually_exclusive_group(required=False)
+feature_parser.add_argument('--per_sample_augment', dest='per_sample_augment', action='store_true', help='draw crop and flip for every sample (on device) instead of once per batch: costs a gather per batch instead of a view, see benchmark.py augment')
+feature_parser.add_argument('--no-per_sample_augment', dest='per_sample_augment', action='store_false')
+parser.set_defaults(per_sample_augment=False)
+
 feature_parser = parser.add_mutually_exclusive_group(required=False)
 feature_parser.add_argument('--normalize', dest='normalize', action='store_true')
 feature_parser.add_argument('--no-normalize', dest='normalize', action='store_false')
@@ -183,17 +204,53 @@ feature_parser = parser.add_mutually_exclusive_group(required=False)
 feature_parser.add_argument('--print_stats', dest='print_stats', action='store_true')
 feature_parser.add_argument('--no-print_stats', dest='print_stats', action='store_false')
 parser.set_defaults(print_stats=False)
+parser.add_argument('--eval_batch_size', type=int, default=1000, metavar='', help='batch size for computing test accuracy (independent of --batch_size)')
+parser.add_argument('--stats_samples', type=int, default=1280, metavar='', help='measure power/noise/sparsity on the first this many samples of every pass (20 training batches of 64)')
+parser.add_argument('--stats_every', type=int, default=1, metavar='', help='measure power/noise/sparsity on every n-th batch within --stats_samples')
 
 feature_parser = parser.add_mutually_exclusive_group(required=False)
 feature_parser.add_argument('--calculate_running', dest='calculate_running', action='store_true')
 feature_parser.add_argument('--no-calculate_running', dest='calculate_running', action='store_false')
 parser.set_defaults(calculate_running=False)
 
+feature_parser = parser.add_mutually_exclusive_group(required=False)
+feature_parser.add_argument('--calibrate', dest='calibrate', action='store_true', help='calibrate activation ranges in a separate pass before training/testing')
+feature_parser.add_argument('--no-calibrate', dest='calibrate', action='store_false')
+parser.set_defaults(calibrate=False)
+
+feature_parser = parser.add_mutually_exclusive_group(required=False)
+feature_parser.add_argument('--ensemble', dest='ensemble', action='store_true', help='train all num_sims simulations at once as one vmapped ensemble (noise free models only)')
+feature_parser.add_argument('--no-ensemble', dest='ensemble', action='store_false')
+parser.set_defaults(ensemble=False)
+
+feature_parser = parser.add_mutually_exclusive_group(required=False)
+feature_parser.add_argument('--mc_sims', dest='mc_sims', action='store_true', help='distort_w_test: evaluate all num_sims weight draws on each test batch, in one pass over the test set')
+feature_parser.add_argument('--no-mc_sims', dest='mc_sims', action='store_false')
+parser.set_defaults(mc_sims=False)
+parser.add_argument('--ci_tolerance', type=float, default=0.0, metavar='', help='distort_w_test: stop evaluating a sim once its accuracy confidence interval (on a random part of the test set) is narrower than this (%%), and stop running sims once the interval of their mean accuracy is, 0: evaluate everything')
+parser.add_argument('--ci_z', type=float, default=1.96, metavar='', help='width of the --ci_tolerance confidence intervals in standard deviations (1.96: 95%%)')
+parser.add_argument('--ci_min_sims', type=int, default=3, metavar='', help='with --ci_tolerance, run at least this many sims per noise level before stopping')
+
 feature_parser = parser.add_mutually_exclusive_group(required=False)
 feature_parser.add_argument('--debug_noise', dest='debug_noise', action='store_true')
 feature_parser.add_argument('--no-debug_noise', dest='debug_noise', action='store_false')
 parser.set_defaults(debug_noise=False)
 
+feature_parser = parser.add_mutually_exclusive_group(required=False)
+feature_parser.add_argument('--fused_sigmas', dest='fused_sigmas', action='store_true', help='compute conv layer outputs and noise sigmas in a single conv call during evaluation (only about 1.03x overall in benchmark.py, and slower for some layers)')
+feature_parser.add_argument('--no-fused_sigmas', dest='fused_sigmas', action='store_false')
+parser.set_defaults(fused_sigmas=False)
+
+feature_parser = parser.add_mutually_exclusive_group(required=False)
+feature_parser.add_argument('--reuse_noise_buffers', dest='reuse_noise_buffers', action='store_true', help='sample activation noise into a preallocated buffer per layer (only in eval mode, i.e. when testing)')
+feature_parser.add_argument('--no-reuse_noise_buffers', dest='reuse_noise_buffers', action='store_false')
+parser.set_defaults(reuse_noise_buffers=True)
+
+feature_parser = parser.add_mutually_exclusive_group(required=False)
+feature_parser.add_argument('--sweep_currents', dest='sweep_currents', action='store_true', help='evaluate all --var_name current levels in a single pass (with --resume)')
+feature_parser.add_argument('--no-sweep_currents', dest='sweep_currents', action='store_false')
+parser.set_defaults(sweep_currents=False)
+
 parser.add_argument('-a', '--arch', metavar='ARCH', default='noisynet')
 parser.add_argument('--current', type=float, default=0.0, metavar='', help='current level in nano Amps, which determines the noise level. 0 disables noise')
 parser.add_argument('--current1', type=float, default=0.0, metavar='', help='current level in nano Amps, which determines the noise level. 0 disables noise')
@@ -279,6 +336,9 @@ parser.add_argument('--weight_init_scale_fc', type=float, default=1.0, metavar='
 parser.add_argument('--w_scale', type=float, default=1.0, metavar='', help='weight distortion scaling factor')
 parser.add_argument('--early_stop_after', type=int, default=100, metavar='', help='number of epochs to tolerate without improvement')
 parser.add_argument('--var_name', type=str, default='', metavar='', help='variable to test')
+parser.add_argument('--var_value', type=str, default=None, metavar='', help='test only this value of --var_name (instead of the whole list)')
+parser.add_argument('--results_file', type=str, default=None, metavar='', help='append one json row per simulation to this file')
+parser.add_argument('--job_id', type=str, default=None, metavar='', help='job id to record in --results_file (see sweep.py)')
 parser.add_argument('--q_a', type=int, default=0, metavar='', help='activation quantization bits')
 parser.add_argument('--q_w', type=int, default=0, metavar='', help='weight quantization bits')
 parser.add_argument('--q_a1', type=int, default=0, metavar='', help='activation quantization bits')
@@ -298,16 +358,23 @@ parser.add_argument('--n_w_test', type=float, default=0, metavar='', help='weigh
 parser.add_argument('--selected_weights', type=float, default=0, metavar='', help='reduce noise for this fraction (%%) of weights by selected_weights_noise_scale')
 parser.add_argument('--noise_values', type=float, default=0, metavar='', help='reduce noise for this fraction (%%) of weights by selected_weights_noise_scale')
 parser.add_argument('--selection_criteria', type=str, default=None, metavar='', help='how to choose important weights: "weight_magnitude", "grad_magnitude", "combined"')
+parser.add_argument('--saliency_cache', type=str, default=None, metavar='', help='directory to save the sorted selection values (selection_criteria) of the weights in, and reuse them from')
 parser.add_argument('--selected_weights_noise_scale', type=float, default=0, metavar='', help='multiply noise for selected_weights by this amount')
 parser.add_argument('--scale_weights', type=float, default=0, metavar='', help='multiply weights by this amount')
 parser.add_argument('--stochastic', type=float, default=0.5, metavar='', help='stochastic uniform noise to add before rounding during quantization')
 parser.add_argument('--pctl', default=99.98, type=float, help='percentile to show when plotting')
+parser.add_argument('--calibration_batches', type=int, default=5, metavar='', help='number of batches for the --calibrate pass')
+parser.add_argument('--calibration_file', type=str, default=None, metavar='', help='load activation ranges from this file if it exists, otherwise save them there after --calibrate')
+parser.add_argument('--calibration', type=str, default='kthvalue', metavar='', help='activation range calibration (with --calculate_running): "kthvalue" (average over 5 batches) or "histogram" (streaming, whole first epoch)')
 parser.add_argument('--seed', type=int, default=None, metavar='', help='random seed')
+parser.add_argument('--noise_seed', type=int, default=None, metavar='', help='seed for reproducible activation noise (per layer and batch, independent of --seed)')
 parser.add_argument('--uniform_ind', type=float, default=0.0, metavar='', help='add random uniform in [-a, a] range to act x, where a is this value')
 parser.add_argument('--uniform_dep', type=float, default=0.0, metavar='', help='multiply act x by random uniform in [x/a, ax] range, where a is this value')
 parser.add_argument('--normal_ind', type=float, default=0.0, metavar='', help='add random normal with 0 mean and variance = a to each act x where a is this value')
 parser.add_argument('--normal_dep', type=float, default=0.0, metavar='', help='add random normal with 0 mean and variance = ax to each act x where a is this value')
 parser.add_argument('--gpu', default=None, type=str, help='GPU to use, if None use all')
+parser.add_argument('--device', default=None, type=str, help='device to run on (e.g. cpu, cuda, cuda:1), if None use cuda when available')
+parser.add_argument('--num_threads', type=int, default=0, metavar='', help='number of CPU threads per process (0: torch default)')
 
 args = parser.parse_args()
 
@@ -322,6 +389,12 @@ else:
 if args.gpu is not None:
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
 
+if args.device is None:
+    args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+if args.num_threads > 0:
+    torch.set_num_threads(args.num_threads)
+
 
 class Net(nn.Module):
     def __init__(self, args=None):
@@ -341,10 +414,10 @@ class Net(nn.Module):
         self.pool = nn.MaxPool2d(2, 2)
         self.relu = nn.ReLU()
 
-        self.quantize1 = QuantMeasure(args.q_a1, stochastic=args.stochastic, pctl=args.pctl, max_value=1.0, debug=args.debug_quant)
-        self.quantize2 = QuantMeasure(args.q_a2, stochastic=args.stochastic, pctl=args.pctl, debug=args.debug_quant)
-        self.quantize3 = QuantMeasure(args.q_a3, stochastic=args.stochastic, pctl=args.pctl, max_value=args.act_max / (1. - args.dropout), debug=args.debug_quant)
-        self.quantize4 = QuantMeasure(args.q_a4, stochastic=args.stochastic, pctl=args.pctl, debug=args.debug_quant)
+        self.quantize1 = QuantMeasure(args.q_a1, stochastic=args.stochastic, pctl=args.pctl, calibration=args.calibration, max_value=1.0, debug=args.debug_quant)
+        self.quantize2 = QuantMeasure(args.q_a2, stochastic=args.stochastic, pctl=args.pctl, calibration=args.calibration, debug=args.debug_quant)
+        self.quantize3 = QuantMeasure(args.q_a3, stochastic=args.stochastic, pctl=args.pctl, calibration=args.calibration, max_value=args.act_max / (1. - args.dropout), debug=args.debug_quant)
+        self.quantize4 = QuantMeasure(args.q_a4, stochastic=args.stochastic, pctl=args.pctl, calibration=args.calibration, debug=args.debug_quant)
 
         self.conv1 = NoisyConv2d(3, args.fm1 * args.width, kernel_size=args.fs, bias=args.use_bias, num_bits=0, num_bits_weight=args.q_w1,
                                      noise=args.n_w1, test_noise=args.n_w_test, stochastic=args.stochastic, debug=args.debug_noise)
@@ -395,7 +468,7 @@ class Net(nn.Module):
         if epoch == 0 and i == 0 and s == 0 and self.training:
             print('\ninput shape:', self.input.shape)
 
-        self.conv1_no_bias = self.conv1(self.input)
+        self.conv1_no_bias, sigmas1 = noisy_layer_forward(self, args, self.conv1, self.input, layer_type='conv', i=i, layer_num=0, merged_dac=args.merged_dac)
 
         if args.plot or args.write:
             get_layers(arrays, self.input, self.conv1.weight, self.conv1_no_bias, stride=1, padding=0, layer='conv', basic=args.plot_basic, debug=args.debug, block_size=args.block_size)
@@ -412,7 +485,7 @@ class Net(nn.Module):
             print('conv1 out shape:', self.conv1_.shape)
 
         if args.current1 > 0 or args.distort_act:
-            conv1_out = add_noise_calculate_power(self, args, arrays, self.input, self.conv1.weight, self.conv1_, layer_type='conv', i=i, layer_num=0, merged_dac=args.merged_dac)
+            conv1_out = add_noise_calculate_power(self, args, arrays, self.input, self.conv1.weight, self.conv1_, layer_type='conv', i=i, layer_num=0, merged_dac=args.merged_dac, precomputed=sigmas1)
         else:
             conv1_out = self.conv1_
 
@@ -459,7 +532,7 @@ class Net(nn.Module):
         if args.q_a2 > 0:
             self.relu1 = self.quantize2(self.relu1)
 
-        self.conv2_no_bias = self.conv2(self.relu1)
+        self.conv2_no_bias, sigmas2 = noisy_layer_forward(self, args, self.conv2, self.relu1, layer_type='conv', i=i, layer_num=1, merged_dac=False)
 
         if args.plot or args.write:
             get_layers(arrays, self.relu1, self.conv2.weight, self.conv2_no_bias, stride=1, padding=0, layer='conv', basic=args.plot_basic, debug=args.debug, block_size=args.block_size)
@@ -476,7 +549,7 @@ class Net(nn.Module):
             print('conv2 out shape:', self.conv2_.shape)
 
         if args.current2 > 0 or args.distort_act:
-            conv2_out = add_noise_calculate_power(self, args, arrays, self.relu1, self.conv2.weight, self.conv2_, layer_type='conv', i=i, layer_num=1, merged_dac=False)
+            conv2_out = add_noise_calculate_power(self, args, arrays, self.relu1, self.conv2.weight, self.conv2_, layer_type='conv', i=i, layer_num=1, merged_dac=False, precomputed=sigmas2)
         else:
             conv2_out = self.conv2_
 
@@ -519,7 +592,7 @@ class Net(nn.Module):
         if args.q_a3 > 0:
             self.relu2 = self.quantize3(self.relu2)
 
-        self.linear1_no_bias = self.linear1(self.relu2)
+        self.linear1_no_bias, sigmas3 = noisy_layer_forward(self, args, self.linear1, self.relu2, layer_type='linear', i=i, layer_num=2, merged_dac=args.merged_dac)
 
         if args.plot or args.write:
             get_layers(arrays, self.relu2, self.linear1.weight, self.linear1_no_bias, layer='linear', basic=args.plot_basic, debug=args.debug, block_size=args.block_size)
@@ -533,7 +606,7 @@ class Net(nn.Module):
             self.linear1_ = self.linear1_no_bias
 
         if args.current3 > 0 or args.distort_act:
-            linear1_out = add_noise_calculate_power(self, args, arrays, self.relu2, self.linear1.weight, self.linear1_, layer_type='linear', i=i, layer_num=2, merged_dac=args.merged_dac)
+            linear1_out = add_noise_calculate_power(self, args, arrays, self.relu2, self.linear1.weight, self.linear1_, layer_type='linear', i=i, layer_num=2, merged_dac=args.merged_dac, precomputed=sigmas3)
         else:
             linear1_out = self.linear1_
 
@@ -568,7 +641,7 @@ class Net(nn.Module):
         if args.q_a4 > 0:
             self.relu3 = self.quantize4(self.relu3)
 
-        self.linear2_no_bias = self.linear2(self.relu3)
+        self.linear2_no_bias, sigmas4 = noisy_layer_forward(self, args, self.linear2, self.relu3, layer_type='linear', i=i, layer_num=3, merged_dac=False)
 
         if args.plot or args.write:
             get_layers(arrays, self.relu3, self.linear2.weight, self.linear2_no_bias, layer='linear', basic=args.plot_basic, debug=args.debug, block_size=args.block_size)
@@ -586,7 +659,7 @@ class Net(nn.Module):
             self.bias4 = torch.Tensor([0])
 
         if args.current4 > 0 or args.distort_act:
-            linear2_out = add_noise_calculate_power(self, args, arrays, self.relu3, self.linear2.weight, self.linear2_, layer_type='linear', i=i, layer_num=3, merged_dac=False)
+            linear2_out = add_noise_calculate_power(self, args, arrays, self.relu3, self.linear2.weight, self.linear2_, layer_type='linear', i=i, layer_num=3, merged_dac=False, precomputed=sigmas4)
         else:
             linear2_out = self.linear2_
 
@@ -670,7 +743,7 @@ class Net(nn.Module):
                 temp = []
                 temp.append('{:d} inputs '.format(inputs[idx]))
                 if args.plot_power:
-                    temp.append('{:.2f}mW '.format(self.power[idx][0]))
+                    temp.append('{:.2f}mW '.format(self.layer_stats.means(len(inputs))['power'][idx]))
                 info.append(temp)
 
             if args.plot:
@@ -690,7 +763,7 @@ class Net(nn.Module):
                 np.save(args.checkpoint_dir + 'input_sizes.npy', np.array(inputs))
                 print('input sizes saved to', args.checkpoint_dir + 'input_sizes.npy', '\n\n')
                 if args.plot_power:
-                    np.save(args.checkpoint_dir + 'layer_power.npy', np.array([x[0] for x in self.power]))
+                    np.save(args.checkpoint_dir + 'layer_power.npy', np.array(self.layer_stats.means(args.num_layers)['power']))
                     print('layers power saved to', args.checkpoint_dir + 'layers_power.npy', '\n\n')
 
             if (args.plot and args.resume is not None) or args.write:
@@ -700,9 +773,279 @@ class Net(nn.Module):
         return self.linear2_out
 
 
+class Regularizer(object):
+    """Sum of all the weight, activation and range penalties enabled in args (L1_x, L2_actx, L2_act_max, L2_w_max, L2_bn_x).
+
+    The terms are grouped by norm: all L1 terms are reduced with one multi-tensor norm, and so are all squared L2 terms,
+    then each group is combined with its coefficients in a single dot product, instead of a reduction and an add per term.
+    The coefficients are read from args when the regularizer is built (build it after changing currents, e.g. with --split).
+    """
+
+    def __init__(self, args, verbose=False):
+        self.terms = {1: [], 2: []}  # p: [(name, coefficient, function returning the penalized tensor of the model)]
+        for k, layer in enumerate(['conv1', 'conv2', 'linear1', 'linear2']):
+            if getattr(args, 'L1_{:d}'.format(k + 1)) > 0:
+                self.terms[1].append(('L1_{:d}'.format(k + 1), getattr(args, 'L1_{:d}'.format(k + 1)), lambda model, layer=layer: getattr(model, layer).weight))
+            if getattr(args, 'L2_act{:d}'.format(k + 1)) > 0:  #does not help
+                self.terms[2].append(('L2_act{:d}'.format(k + 1), getattr(args, 'L2_act{:d}'.format(k + 1)), lambda model, layer=layer: getattr(model, layer + '_')))
+
+        if args.train_act_max and args.L2_act_max > 0:
+            for k, current in enumerate([args.current2, args.current3, args.current4]):
+                coefficient = args.L2_act_max if args.current1 == 0 else args.L2_act_max / current
+                self.terms[2].append(('L2_act_max{:d}'.format(k + 1), coefficient, lambda model, k=k: getattr(model, 'act_max{:d}'.format(k + 1))))
+
+        if args.train_w_max and args.L2_w_max > 0:
+            self.terms[2].append(('L2_w_min1', args.L2_w_max, lambda model: model.w_min1))
+            self.terms[2].append(('L2_w_max1', args.L2_w_max, lambda model: model.w_max1))
+
+        if args.batchnorm:  #haven't tested this properly
+            for bn in ['bn1', 'bn2']:
+                if args.L2_bn_weight > 0:
+                    self.terms[2].append(('L2_bn_weight_' + bn, args.L2_bn_weight, lambda model, bn=bn: getattr(model, bn).weight))
+                if args.L2_bn_bias > 0:
+                    self.terms[2].append(('L2_bn_bias_' + bn, args.L2_bn_bias, lambda model, bn=bn: getattr(model, bn).bias))
+
+        self.coefficients = {p: torch.tensor([c for _, c, _ in terms]) for p, terms in self.terms.items()}
+
+        if verbose:
+            for name, coefficient, _ in self.terms[1] + self.terms[2]:
+                print('Applying {} loss penalty {}'.format(name, coefficient))
+
+    def __len__(self):
+        return len(self.terms[1]) + len(self.terms[2])
+
+    @staticmethod
+    def norms(tensors, p):
+        if hasattr(torch, '_foreach_norm'):
+            return torch.stack(torch._foreach_norm(tensors, p))
+        return torch.stack([t.norm(p=p) for t in tensors])
+
+    def __call__(self, model, breakdown=False):
+        """Total penalty, and if breakdown, also a dict with the value of every term (for logging, it syncs with the device)"""
+        loss = 0
+        values = {}
+        for p, terms in self.terms.items():
+            if len(terms) == 0:
+                continue
+            norms = self.norms([get(model) for _, _, get in terms], p)
+            if p == 2:
+                norms = norms.pow(2)
+            coefficients = self.coefficients[p].to(norms)
+            loss = loss + torch.dot(coefficients, norms)
+            if breakdown:
+                values.update({name: value for (name, _, _), value in zip(terms, (coefficients * norms).tolist())})
+        if breakdown:
+            return loss, values
+        return loss
+
+
+def backward_with_penalties(model, args, loss, stats=False):
+    """loss.backward(), plus the gradient norm penalties --L3_new, --L3, --L3_act and --L4. The first order gradients of
+    all penalties come from a single torch.autograd.grad call over the weights and activations, and the total is
+    backpropagated once.
+
+    If stats, returns the first order gradients of loss w.r.t. the weights and activations (for --print_stats).
+    """
+    params = [model.conv1.weight, model.conv2.weight, model.linear1.weight, model.linear2.weight]
+    acts = [model.conv1_, model.conv2_, model.linear1_, model.linear2_]
+    grad_L3 = args.L3 > 0 or args.L3_new > 0
+
+    if not (grad_L3 or args.L3_act > 0 or args.L4 > 0):
+        if stats:
+            for act in acts:
+                act.retain_grad()
+        loss.backward()
+        if stats:
+            return [p.grad for p in params], [act.grad for act in acts]
+        return None, None
+
+    inputs = params + acts if args.L3_act > 0 or stats else params
+    grads = torch.autograd.grad(loss, inputs, create_graph=True)
+    param_grads, act_grads = grads[:len(params)], grads[len(params):]
+
+    total = loss
+    if grad_L3 or args.L4 > 0:
+        grad_sum = torch.stack([grad.pow(2).sum() for grad in param_grads]).sum()
+        if grad_L3:
+            total = total + args.L3 * grad_sum
+            if args.L3_L2:
+                total = total + args.L3_new * grad_sum
+            elif args.L3_L1:
+                total = total + args.L3_new * torch.stack([grad.norm(p=1) for grad in param_grads]).sum()
+        if args.L4 > 0:  #L2 penalty for second order gradient size
+            grads2 = torch.autograd.grad(grad_sum, params, create_graph=True)
+            total = total + args.L4 * torch.stack([g2.pow(2).sum() for g2 in grads2]).sum()
+    if args.L3_act > 0:   #L2 penalty for gradient size in respect to activations
+        total = total + args.L3_act * torch.stack([act_grad.pow(2).sum() for act_grad in act_grads]).sum()
+
+    total.backward()
+    if stats:
+        return [grad.detach() for grad in param_grads], [act_grad.detach() for act_grad in act_grads]
+    return None, None
+
+
+def train_ensemble(args, train_inputs, train_labels, test_inputs, test_labels):
+    """Train args.num_sims independent copies of Net at once (--ensemble).
+
+    Parameters and BN buffers of all copies are stacked along a new first dim, and one vmapped forward/backward per batch
+    advances all of them. Each copy has its own initialization, data order and dropout masks, and SGD/Adam/AdamW updates
+    are elementwise, so every copy follows the same update rule as in a separate run. Returns best test accuracy and epoch of each copy.
+    """
+    from torch.func import functional_call, stack_module_state, vmap
+
+    unsupported = [name for name, value in [
+        ('q_a', args.q_a1 + args.q_a2 + args.q_a3 + args.q_a4), ('q_w', args.q_w1 + args.q_w2 + args.q_w3 + args.q_w4),
+        ('n_w', args.n_w1 + args.n_w2 + args.n_w3 + args.n_w4 + args.n_w_test), ('current', args.current1 + args.current2 + args.current3 + args.current4),
+        ('distort_act', args.distort_act), ('uniform_ind', args.uniform_ind), ('uniform_dep', args.uniform_dep), ('normal_ind', args.normal_ind),
+        ('normal_dep', args.normal_dep), ('L3', args.L3), ('L3_new', args.L3_new), ('L3_act', args.L3_act), ('L4', args.L4),
+        ('L2_act', args.L2_act1 + args.L2_act2 + args.L2_act3 + args.L2_act4), ('L2_act_max', args.L2_act_max),
+        ('L2_bn_weight', args.L2_bn_weight), ('L2_bn_bias', args.L2_bn_bias), ('train_act_max', args.train_act_max), ('train_w_max', args.train_w_max),
+        ('merge_bn', args.merge_bn), ('split', args.split), ('weightnorm', args.weightnorm), ('fp16', args.fp16), ('print_stats', args.print_stats),
+        ('plot', args.plot), ('write', args.write), ('distort_w_test', args.distort_w_test), ('resume', args.resume is not None)] if value]
+    if len(unsupported) > 0:
+        print('\n\n--ensemble does not support: {}\n\n'.format(', '.join(unsupported)))
+        raise(SystemExit)
+
+    num_copies = args.num_sims
+    models = []
+    for s in range(num_copies):
+        model = Net(args=args).to(args.device)
+        utils.init_model(model, args, s)
+        models.append(model)
+    utils.print_model(models[0], args, full=args.debug)
+    params, buffers = stack_module_state(models)
+    base = models[0].to('meta')
+
+    def forward(params, buffers, input, epoch, i):
+        return functional_call(base, (params, buffers), (input,), {'epoch': epoch, 'i': i, 's': 1})
+
+    def loss_fn(params, buffers, input, label, epoch, i):
+        output = forward(params, buffers, input, epoch, i)
+        return nn.CrossEntropyLoss()(output, label), output
+
+    train_step = vmap(loss_fn, in_dims=(0, 0, 0, 0, None, None), randomness='different')
+    test_step = vmap(forward, in_dims=(0, 0, None, None, None), randomness='different')
+
+    layer_groups = [('conv1.', args.L2_1, args.LR_1), ('conv2.', args.L2_2, args.LR_2), ('linear1.', args.L2_3, args.LR_3), ('linear2.', args.L2_4, args.LR_4)]
+    param_groups = [{'params': [p for n, p in params.items() if n.startswith(prefix)], 'weight_decay': L2, 'lr': LR} for prefix, L2, LR in layer_groups]
+    param_groups.append({'params': [p for n, p in params.items() if n.startswith('bn')], 'weight_decay': args.L2_bn})
+    param_groups = [g for g in param_groups if len(g['params']) > 0]
+
+    if args.optim == 'SGD':
+        optimizer = torch.optim.SGD(param_groups, lr=args.LR, momentum=args.momentum, nesterov=args.nesterov)
+    elif args.optim == 'Adam':
+        optimizer = torch.optim.Adam(param_groups, lr=args.LR, amsgrad=args.amsgrad)
+    elif args.optim == 'AdamW':
+        optimizer = torch.optim.AdamW(param_groups, lr=args.LR, amsgrad=args.amsgrad)
+
+    if args.LR_scheduler == 'step':
+        scheduler = lr_scheduler.StepLR(optimizer, args.LR_step_after, gamma=args.LR_step)
+    elif args.LR_scheduler == 'exp':
+        scheduler = lr_scheduler.ExponentialLR(optimizer, gamma=args.LR_decay)
+    elif args.LR_scheduler == 'triangle':
+        scheduler = utils.TriangleLR(optimizer, args.LR, args.momentum, args.nepochs, args.LR_max_epoch, args.LR_finetune_epochs, num_train_batches, batch_size=args.batch_size)
+
+    w_max = {'conv1.weight': args.w_max1, 'conv2.weight': args.w_max2, 'linear1.weight': args.w_max3, 'linear2.weight': args.w_max4}
+    L1 = {'conv1.weight': args.L1_1, 'conv2.weight': args.L1_2, 'linear1.weight': args.L1_3, 'linear2.weight': args.L1_4}
+
+    best_accuracies = np.zeros(num_copies)
+    best_epochs = np.zeros(num_copies, dtype=int)
+    prev_best_accs = np.full(num_copies, 15.)
+    stopped = np.zeros(num_copies, dtype=bool)
+    saved_path = None
+
+    for epoch in range(args.nepochs):
+        if args.LR_scheduler == 'manual':
+            lr = args.LR * args.LR_step ** (epoch // args.LR_step_after)
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = lr
+        elif args.LR_scheduler != 'triangle':
+            scheduler.step()
+
+        base.train()
+        rnd_idx = torch.stack([torch.randperm(len(train_inputs), device=train_inputs.device) for _ in range(num_copies)])
+        tr_correct = torch.zeros(num_copies, device=train_inputs.device)
+
+        for i in range(num_train_batches):
+            idx = rnd_idx[:, i * args.batch_size:(i + 1) * args.batch_size]
+            input = train_inputs[idx]  # (num_copies, batch_size, 3, 32, 32)
+            label = train_labels[idx]
+
+            if args.augment and args.per_sample_augment:
+                input = utils.random_crop_flip(input.flatten(0, 1)).view(num_copies, args.batch_size, 3, 32, 32)
+            elif args.augment:
+                crops = []
+                for s in range(num_copies):
+                    k = random.randint(0, 8)
+                    j = random.randint(0, 8)
+                    crop = input[s, :, :, k:k + 32, j:j + 32]
+                    if random.random() < 0.5:
+                        crop = torch.flip(crop, [3])
+                    crops.append(crop)
+                input = torch.stack(crops)
+
+            if args.LR_scheduler == 'triangle':
+                scheduler.step()
+
+            losses, output = train_step(params, buffers, input, label, epoch, i)
+            loss = losses.sum()  # copies do not share parameters, so each one gets the gradient of its own loss
+            for n, coef in L1.items():
+                if coef > 0:
+                    loss = loss + coef * params[n].abs().sum()
+
+            optimizer.zero_grad()
+            loss.backward()
+
+            if args.grad_clip > 0:
+                for p in params.values():
+                    p.grad.data.clamp_(-args.grad_clip, args.grad_clip)
+
+            optimizer.step()
+
+            with torch.no_grad():
+                for n, value in w_max.items():
+                    if value > 0:
+                        params[n].clamp_(-value, value)
+                tr_correct += output.argmax(-1).eq(label).sum(1)
+
+        base.eval()
+        te_correct = torch.zeros(num_copies, device=test_inputs.device)
+        with torch.no_grad():
+            for i in range(num_test_batches):
+                input = test_inputs[i * args.batch_size:(i + 1) * args.batch_size]
+                label = test_labels[i * args.batch_size:(i + 1) * args.batch_size]
+                te_correct += test_step(params, buffers, input, epoch, i).argmax(-1).eq(label).sum(1)
+
+        tr_accs = (tr_correct * 100.0 / (num_train_batches * args.batch_size)).tolist()
+        te_accs = (te_correct * 100.0 / (num_test_batches * args.batch_size)).tolist()
+        print('{}  Epoch {:>3d}  Train {}  Test {}'.format(str(datetime.now())[:-7], epoch, ' '.join('{:.2f}'.format(a) for a in tr_accs), ' '.join('{:.2f}'.format(a) for a in te_accs)))
+
+        for s in range(num_copies):
+            if stopped[s] or te_accs[s] <= best_accuracies[s]:
+                continue
+            best_accuracies[s] = te_accs[s]
+            best_epochs[s] = epoch
+            if s == 0 and epoch > 10:
+                if saved_path is None:
+                    utils.saveargs(args)
+                elif os.path.exists(saved_path):
+                    os.remove(saved_path)
+                saved_path = args.checkpoint_dir + '/model_epoch_{:d}_acc_{:.2f}.pth'.format(epoch, te_accs[s])
+                torch.save({n: t[0] for n, t in list(params.items()) + list(buffers.items())}, saved_path)
+
+        if epoch != 0 and epoch % args.early_stop_after == 0:
+            stopped |= best_accuracies <= prev_best_accs
+            prev_best_accs = best_accuracies.copy()
+            if stopped.all():
+                break
+
+    return best_accuracies.tolist(), best_epochs.tolist()
+
+
 np.set_printoptions(precision=4, linewidth=120, suppress=True)
 
 train_inputs, train_labels, test_inputs, test_labels = utils.load_cifar(args)
+train_sampler = utils.BatchSampler(train_inputs, train_labels, args.batch_size)
 
 num_train_batches = 50000 // args.batch_size
 num_test_batches = 10000 // args.batch_size
@@ -717,10 +1060,14 @@ if args.LR_4 == 0:
     args.LR_4 = args.LR
 
 currents = {}
-if args.var_name == 'current':
-    current_vars = [1, 3, 5, 10, 20, 50, 100]
-else:
-    current_vars = [args.current]
+current_vars = utils.get_current_list(args.var_name, args.current)
+
+if args.sweep_currents:
+    if args.resume is None:
+        print('\n\n--sweep_currents only works when evaluating a saved model (--resume)\n\n')
+        raise(SystemExit)
+    sweep_currents = current_vars
+    current_vars = [max(current_vars)]  # all levels are simulated at once, see add_noise_sweep_currents
 
 for current in current_vars:
     print('\n\n****************** Current {} ********************\n\n'.format(current))
@@ -757,106 +1104,11 @@ for current in current_vars:
     act_sparsity_results = {}
     w_sparsity_results = {}
 
-    if args.var_name == 'w_max1':
-        var_list = [0.05, 0.1, 0.3, 0.5, 1]
-        #var_list = [0, 2, 4, 8]
-        var_list = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1]
-    elif args.var_name == 'act_max':#'act_max' in args.var_name:
-        #var_list = [0.8, 1.2, 1.5, 2, 2.5, 3, 5, 10, 0]
-        var_list = [0, 0.2, 1, 5, 20]
-        var_list = [0.25, 1, 2, 4, 10, 0]
-    elif args.var_name == 'act_max1':#'act_max' in args.var_name:
-        #var_list = [0.8, 1.2, 1.5, 2, 2.5, 3, 5, 10, 0]
-        var_list = [0, 0.2, 1, 5, 20]
-        var_list = [0.5, 1, 1.5, 2, 2.5, 3, 4, 5]
-    elif args.var_name == 'act_max2':#'act_max' in args.var_name:
-        #var_list = [0.8, 1.2, 1.5, 2, 2.5, 3, 5, 10, 0]
-        var_list = [0, 0.2, 1, 5, 20]
-        var_list = [0.5, 1, 2, 3, 4, 5, 10]
-    elif args.var_name == 'act_max3':#'act_max' in args.var_name:
-        #var_list = [0.8, 1.2, 1.5, 2, 2.5, 3, 5, 10, 0]
-        var_list = [0, 0.2, 1, 5, 20]
-        var_list = [0.5, 1, 2, 3, 4, 5, 10]
-    elif args.var_name == 'LR':
-        #var_list = [0.0001, 0.0002, 0.0003, 0.0005, 0.001, 0.005, 0.01, 0.02, 0.03, 0.05, 0.1]
-        #var_list = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.003, 0.005, 0.01, 0.02]
-        var_list = [0.01, 0.015, 0.02, 0.025, 0.03, 0.035]
-        var_list = [0.001, 0.002, 0.005, 0.01, 0.02, 0.04]
-        var_list = [0.005, 0.01, 0.02, 0.03, 0.04, 0.05, 0.06, 0.08, 0.1]
-        var_list = [0.5, 0.6, 0.7, 0.8, 1, 1.2, 1.5, 2, 2.5, 3, 4, 5, 7, 10]
-        var_list = [0.0001, 0.0002, 0.0003, 0.0005, 0.001, 0.002, 0.003, 0.004, 0.006, 0.008, 0.01]
-    elif args.var_name == 'L2_act_max':
-        var_list = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.03, 0.05]
-    elif args.var_name == 'uniform_ind':
-        #var_list = [0.08, 0.09, 0.1, 0.11, 0.12, 0.13, 0.14, 0.15]
-        var_list = [x/current for x in [0.12, 0.14, 0.16]]
-    elif args.var_name == 'uniform_dep':
-        var_list = [0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1]  #0.5, 0.6, and 1.5-3.0
-    elif args.var_name == 'normal_ind':
-        #var_list = [0.03, 0.04, 0.05, 0.06, 0.07, 0.08, 0.09, 0.1]
-        var_list = [x/current for x in [0.05, 0.07, 0.09]]
-    elif args.var_name == 'normal_dep':
-        #var_list = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7]
-        var_list = [x/current for x in [0.3, 0.4, 0.5]]
-    elif args.var_name == 'L2_1':
-        var_list = [0.0, 0.0002, 0.0005, 0.001, 0.002, 0.003, 0.005]
-    elif args.var_name == 'L2':
-        var_list = [0.00005, 0.0001, 0.0002, 0.0003, 0.0005, 0.001]
-        var_list = [0, 0.0001, 0.0002, 0.0003, 0.0004, 0.0005, 0.0006, 0.0008, 0.001, 0.0012, 0.0015, 0.002]
-        var_list = [0, 0.00005, 0.0001, 0.0002, 0.0003, 0.0004, 0.0005, 0.0006, 0.0007, 0.0008, 0.001]
-        var_list = [0.0005, 0.001, 0.002, 0.003, 0.004, 0.005, 0.006, 0.008, 0.01, 0.02, 0.03, 0.05]
-        var_list = [0.5, 0.6, 0.7, 0.8, 1, 1.2, 1.5, 2, 2.5, 3, 4, 5, 7, 10]
-        var_list = [0, 0.02, 0.03, 0.05, 0.07, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4]
-        var_list = [0, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.03, 0.04, 0.05, 0.07, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4]
-    elif args.var_name == 'L1':
-        var_list = [0, 1e-7, 2e-7, 5e-7, 1e-6, 2e-6, 5e-6, 1e-5]#, 3e-5, 2e-5, 5e-5, 0.0001]
-        #var_list = [1e-5, 2e-5, 5e-5, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.03, 0.05, 0.07, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.7, 1]
-        var_list = [2e-6, 4e-6, 6e-6, 8e-6, 1e-5, 2e-5, 3e-5]
-    elif args.var_name == 'L2_2':
-        var_list = [0.0, 0.00001, 0.00002, 0.00003, 0.00005, 0.0001]#, 0.0002, 0.0003, 0.0005, 0.001]
-    elif args.var_name == 'L3':
-        #var_list = [0.1, 0.2, 0.5, 1, 2, 3, 5]  # currents 1,3,5,10,20,50,100:  30, 20, 10, 1, 0.2, 0.05, 0.01
-        #var_list = [x/args.test_current for x in [10, 20, 50]]
-        var_list = [0, 0.001, 0.005, 0.01, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 30, 50]
-        var_list = [0, 0.001, 0.002, 0.005, 0.01, 0.02, 0.03, 0.05, 0.1, 0.2, 0.5]
-        var_list = [0.0005, 0.001, 0.002, 0.003, 0.005, 0.007, 0.01, 0.015, 0.02]
-        #var_list = [0.02, 0.025, 0.03, 0.035, 0.04, 0.05, 0.06, 0.07, 0.08]
-        var_list = [0.001, 0.0025, 0.005, 0.0075, 0.01, 0.015, 0.02, 0.025, 0.03]
-        var_list = [0, 0.0005, 0.001, 0.002, 0.003, 0.004, 0.005, 0.006, 0.007, 0.008, 0.01]
-        var_list = [5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3]#0.0005, 0.001, 0.002, 0.003, 0.004, 0.005, 0.006, 0.007, 0.008, 0.01]
-        var_list = [0, 0.0005, 0.001, 0.002, 0.003, 0.005, 0.007, 0.01, 0.02, 0.03, 0.04, 0.06, 0.08, 0.1, 0.2, 0.3, 0.5, 1]
-    elif args.var_name == 'L3_new':
-        var_list = [0, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 1]#1, 2, 3, 5, 10, 20, 30]
-    elif args.var_name == 'L3_act':
-        #var_list = [500000, 1000000, 2000000, 4000000, 10000000, 20000000]
-        #var_list = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20]
-        var_list = [0.001, 0.005, 0.01, 0.05, 0.1, 0.2, 0.5, 1, 2]
-    elif args.var_name == 'L4':
-        var_list = [0.00002, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5]
-    elif args.var_name == 'momentum':
-        var_list = [0., 0.5, 0.7, 0.8, 0.85, 0.9, 0.95, 0.97, 0.99]
-    elif args.var_name == 'grad_clip':
-        #var_list = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2, 5, 0]
-        var_list = [0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2, 5, 0]
-        var_list = [0.005, 0.05, 0.5, 2, 0]
-    elif args.var_name == 'dropout':
-        var_list = [0, 0.05, 0.1, 0.15, 0.2, 0.25]
-        var_list = [0, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.5]
-    elif args.var_name == 'width':
-        var_list = [1, 2, 4]
-    elif args.var_name == 'noise':
-        var_list = [0, 0.02, 0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5]
-    elif args.var_name == 'n_w':
-        var_list = [0, 0.02, 0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5]
-        var_list = [0, 0.02, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5]
-    elif args.var_name == 'selected_weights':
-        var_list = [0, 1, 2, 3, 5, 10, 20, 30]
-        var_list = [2, 5, 10]
+    var_list = utils.get_var_list(args.var_name, current)
+    if args.var_value is not None:
+        var_list = [utils.parse_value(args.var_value)]
+    if args.var_name == 'selected_weights':
         acc_lists = []
-    elif args.var_name == 'L2_w_max':
-        var_list = [0.1]    #0.1 works fine for current=10 and init_w_max=0.2, no L2, and no act_max: w_min=-0.16, w_max=0.18, Acc 78.72 (epoch 225), power 3.45, noise 0.04 (0.02, 0.03, 0.04, 0.08)
-    else:
-        var_list = [' ']
 
     for var in var_list:
         if args.var_name != '':
@@ -936,7 +1188,18 @@ for current in current_vars:
             'grad_clip-' + str(args.grad_clip) +
             '/')
 
-        for s in range(args.num_sims):
+        if args.ensemble:
+            saved = False
+            ensemble_accs, ensemble_epochs = train_ensemble(args, train_inputs, train_labels, test_inputs, test_labels)
+            for s, (best_accuracy, best_epoch) in enumerate(zip(ensemble_accs, ensemble_epochs)):
+                print('\n\nSimulation {:d}  {} {}  Best Accuracy: {:.2f} (epoch {})\n\n'.format(s, args.tag+args.var_name, var, best_accuracy, best_epoch))
+                best_accuracies.append(best_accuracy)
+                if args.results_file is not None:
+                    utils.append_result(args.results_file, {
+                        'job_id': args.job_id, 'var_name': args.var_name, 'var': var, 'current': args.current, 'sim': s, 'seed': args.seed,
+                        'best_accuracy': float(best_accuracy), 'best_epoch': best_epoch, 'power': 0., 'nsr': 0.})
+
+        for s in ([] if args.ensemble else range(args.num_sims)):
 
             best_accuracy = 0
             best_accuracy_dist = 0
@@ -962,7 +1225,7 @@ for current in current_vars:
 
                 model = Net(args=args)
                 utils.init_model(model, args, s)
-                model = model.cuda() #do this before constructing optimizer!!
+                model = model.to(args.device) #do this before constructing optimizer!!
                 if args.fp16:
                     model = model.half()
                     if args.keep_bn_fp32:
@@ -985,26 +1248,13 @@ for current in current_vars:
                 print('\n\nLoading model from saved checkpoint at\n{}\n\n'.format(args.resume))
                 args.checkpoint_dir = '/'.join(args.resume.split('/')[:-1]) + '/'
                 model = Net(args=args)
-                model = model.cuda()
-
-                saved_model = torch.load(args.resume)  #ignore unnecessary parameters
-
-                for saved_name, saved_param in saved_model.items():
-                    if args.debug:
-                        print(saved_name)
-                    for name, param in model.named_parameters():
-                        if name == saved_name:
-                            if args.debug:
-                                print('\tmatched, copying...')
-                            param.data = saved_param.data
-                    if 'running_min' in saved_name or 'running_max' in saved_name:
-                        continue
-                    elif 'running' in saved_name and args.track_running_stats:  #batchnorm stats are not in named_parameters
-                        if args.debug:
-                            print('\tmatched, copying...')
-                        m = model.state_dict()
-                        m.update({saved_name: saved_param})
-                        model.load_state_dict(m)
+                model = model.to(args.device)
+
+                saved_model = utils.load_checkpoint(args.resume, args.device, mmap=args.mmap_checkpoint)  #ignore unnecessary parameters
+
+                #batchnorm stats are not in named_parameters (quantization ranges are recalculated)
+                utils.load_matching_state(model, saved_model, debug=args.debug, buffer_filter=lambda name: args.track_running_stats and
+                                          'running' in name and 'running_min' not in name and 'running_max' not in name)
 
                 #model.load_state_dict(torch.load(args.resume))
                 if args.distort_w_test and args.var_name != '':
@@ -1062,28 +1312,34 @@ for current in current_vars:
                 init_acc = model_fname.split('_')[-1][:-4]
                 print('\n\nCurrents:', args.current1, args.current2, args.current3, args.current4)
 
-                model.power = [[] for _ in range(args.num_layers)]  #[[]]*num_layers won't work!
-                model.nsr = [[] for _ in range(args.num_layers)]
-                model.input_sparsity = [[] for _ in range(args.num_layers)]
+                model.layer_stats = LayerStats(samples=args.stats_samples, every=args.stats_every)
                 w_sparsity = []
                 te_accs = []
 
-                for i in range(10000 // args.batch_size):
-                    input = test_inputs[i * args.batch_size:(i + 1) * args.batch_size]
-                    label = test_labels[i * args.batch_size:(i + 1) * args.batch_size]
-                    output = model(input, init_epoch, i, acc=float(init_acc))
-                    pred = output.data.max(1)[1]
-                    te_acc = pred.eq(label.data).cpu().sum().numpy() * 100.0 / args.batch_size
-                    te_accs.append(te_acc)
+                if args.q_a > 0:
+                    calibrate_or_load(model, args, (utils.random_crop_flip(input) if args.augment else input for input, _ in train_sampler))
+
+                if args.sweep_currents:
+                    args.layer_currents = [sweep_currents] * args.num_layers
+                    num_currents = len(sweep_currents)
+
+                    def sweep_model(input, **kwargs):
+                        # one copy of the batch per current level, outputs as (current, batch, classes)
+                        output = model(input.repeat(num_currents, *[1] * (input.dim() - 1)), **kwargs)
+                        return output.view(num_currents, input.size(0), -1)
+
+                    te_accs = utils.evaluate(sweep_model, test_inputs, test_labels, args.batch_size, pass_index=True, epoch=init_epoch, acc=float(init_acc))
+                    print('\n\nRestored Model Accuracy (epoch {:d}) vs current:\n'.format(init_epoch))
+                    for current, te_acc in zip(sweep_currents, te_accs):
+                        print('current {:>6.1f}nA  accuracy {:.2f}'.format(current, te_acc))
+                    print('\n\n')
+                    raise(SystemExit)
+
+                te_acc = utils.evaluate(model, test_inputs, test_labels, args.eval_batch_size, pass_index=True, epoch=init_epoch, acc=float(init_acc))
 
                 if args.print_stats:
-                    p = []
-                    input_sp = []
-                    nsr = []
-                    for ind in range(args.num_layers):
-                        p.append(np.nanmean(model.power[ind]))
-                        input_sp.append(np.nanmean(model.input_sparsity[ind]))
-                        nsr.append(np.nanmean(model.nsr[ind]))
+                    means = model.layer_stats.means(args.num_layers)
+                    p, input_sp, nsr = means['power'], means['input_sparsity'], means['nsr']
 
                     avg_input_sparsity = np.nanmean(input_sp)
                     input_sparsity_string = '  act spars {:.2f} ({:.2f} {:.2f} {:.2f} {:.2f})'.format(avg_input_sparsity, *input_sp)
@@ -1092,8 +1348,6 @@ for current in current_vars:
                     total_power = np.nansum(p)
                     power_string = '  Power {:.2f}mW ({:.2f} {:.2f} {:.2f} {:.2f})'.format(total_power, *p)
 
-                te_acc = np.mean(te_accs, dtype=np.float64)
-
                 print('\n\nRestored Model Accuracy (epoch {:d}): {:.2f}{}{}{}\n\n'.format(init_epoch, te_acc, power_string, noise_string, input_sparsity_string))
                 if not args.distort_w_test and args.q_w == 0:
                     raise(SystemExit)
@@ -1186,15 +1440,8 @@ for current in current_vars:
                 scheduler = lr_scheduler.ExponentialLR(optimizer, gamma=args.LR_decay)
                 lr = scheduler.get_lr()[0]
             elif args.LR_scheduler == 'triangle':
-                lr_increment = args.LR / ((args.LR_max_epoch + 1) * num_train_batches)
-                mom_decrement = args.momentum / ((args.LR_max_epoch + 1) * num_train_batches)
-                lr_decrement = (args.LR - 0.05 * args.LR) / ((args.nepochs - args.LR_max_epoch - args.LR_finetune_epochs) * num_train_batches)
-                lr_decrement2 = (0.05 * args.LR) / (args.LR_finetune_epochs * num_train_batches)
-                mom_increment = (args.LR - 0.05 * args.LR) / (   #TODO!!!
-                                (args.nepochs - args.LR_max_epoch - args.LR_finetune_epochs) * num_train_batches)
-                mom_increment2 = (0.05 * args.LR) / (args.LR_finetune_epochs * num_train_batches)
+                scheduler = utils.TriangleLR(optimizer, args.LR, args.momentum, args.nepochs, args.LR_max_epoch, args.LR_finetune_epochs, num_train_batches, batch_size=args.batch_size)
                 lr = 0
-                mom = args.momentum
 
             prev_best_acc = 15
             grad_norms = []
@@ -1211,16 +1458,14 @@ for current in current_vars:
             max_string = ''
 
             # when quantizing activations, calculate signal ranges in all layers
+            if args.q_a > 0:
+                model.layer_stats = LayerStats(samples=args.stats_samples, every=args.stats_every)
+                calibrate_or_load(model, args, (utils.random_crop_flip(input) if args.augment else input for input, _ in train_sampler))
             if args.q_a > 0 and args.calculate_running:
-                for m in model.modules():
-                    if isinstance(m, QuantMeasure):
-                        m.calculate_running = True
-                        m.running_list = []
+                start_calibration(model)
 
             for epoch in range(args.nepochs):
-                model.power = [[] for _ in range(args.num_layers)]
-                model.nsr = [[] for _ in range(args.num_layers)]
-                model.input_sparsity = [[] for _ in range(args.num_layers)]
+                model.layer_stats = LayerStats(samples=args.stats_samples, every=args.stats_every)
 
                 model.train()
                 tr_accuracies = []
@@ -1235,10 +1480,6 @@ for current in current_vars:
                     scheduler.step()
                     lr = scheduler.get_lr()[0]
 
-                rnd_idx = np.random.permutation(len(train_inputs))
-                train_inputs = train_inputs[rnd_idx]
-                train_labels = train_labels[rnd_idx]
-
                 if args.train_w_max:
                     w_max1_grad_sum = 0
 
@@ -1249,24 +1490,20 @@ for current in current_vars:
                     if epoch == 0:
                         print('*********************** Setting Train Current to', args.train_current, 'currents:', args.current1, args.current2, args.current3, args.current4)
 
+                if epoch == 0 or args.split:
+                    regularizer = Regularizer(args, verbose=epoch == 0)
+
                 clip_string = ''
 
-                for i in range(num_train_batches):
-                    # when quantizing activations, calculate signal ranges in all layers for the first 5 batches:
-                    if args.q_a > 0 and args.calculate_running and epoch == 0 and i == 5:
+                for i, (input, label) in enumerate(train_sampler):  #input: (64, 3, 40, 40) when augmenting
+                    # when quantizing activations, calculate signal ranges in all layers for the first 5 batches (histogram: first epoch):
+                    if args.q_a > 0 and args.calculate_running and epoch == 0 and i == 5 and args.calibration == 'kthvalue':
                         print('\n')
-                        with torch.no_grad():
-                            for m in model.modules():
-                                #print(m)
-                                if isinstance(m, QuantMeasure):
-                                    m.calculate_running = False
-                                    m.running_max = torch.tensor(m.running_list, device='cuda:0').mean()
-                                    print('(train) running_list:', m.running_list, 'running_max:', m.running_max.item())
-
-                    input = train_inputs[i * args.batch_size:(i + 1) * args.batch_size]  #(64, 3, 32, 32)
-                    label = train_labels[i * args.batch_size:(i + 1) * args.batch_size]
-
-                    if args.augment:
+                        finish_calibration(model, tag='train')
+
+                    if args.augment and args.per_sample_augment:
+                        input = utils.random_crop_flip(input)
+                    elif args.augment:
                         k = random.randint(0, 8)
                         j = random.randint(0, 8)
                         input = input[:, :, k:k + 32, j:j + 32]
@@ -1286,199 +1523,33 @@ for current in current_vars:
                         utils.print_batchnorm(model, i)
 
                     if args.LR_scheduler == 'triangle':
-                        if epoch <= args.LR_max_epoch:
-                            lr +=  lr_increment
-                            mom -= mom_decrement
-                        elif epoch <= args.nepochs - args.LR_finetune_epochs:
-                            lr -= lr_decrement
-                            mom += mom_increment
-                        else:
-                            lr -= lr_decrement2
-                            mom += mom_increment2
-
-                        for param_group in optimizer.param_groups:
-                            param_group['lr'] = lr / args.batch_size
-                            param_group['momentum'] = mom
-
-                    if args.L2_act1 > 0:  #does not help
-                        loss += args.L2_act1 * (model.conv1_).pow(2).sum()
-                    if args.L2_act2 > 0:
-                        loss += args.L2_act2 * (model.conv2_).pow(2).sum()
-                    if args.L2_act3 > 0:
-                        loss += args.L2_act3 * (model.linear1_).pow(2).sum()
-                    if args.L2_act4 > 0:
-                        loss += args.L2_act4 * (model.linear2_).pow(2).sum()
-
-                    if args.L1_1 > 0:
-                        if epoch == 0 and i == 0:
-                            print('\n\nApplying L1 loss penalty {} in conv1 layer\n'.format(args.L1_1))
-                        loss = loss + args.L1_1 * model.conv1.weight.norm(p=1)
-
-                    if args.L1_2 > 0:
-                        if epoch == 0 and i == 0:
-                            print('\nApplying L1 loss penalty {} in conv2 layer\n'.format(args.L1_2))
-                        loss = loss + args.L1_2 * model.conv2.weight.norm(p=1)
-
-                    if args.L1_3 > 0:
-                        if epoch == 0 and i == 0:
-                            print('\nApplying L1 loss penalty {} in linear1 layer\n'.format(args.L1_3))
-                        loss = loss + args.L1_3 * model.linear1.weight.norm(p=1)
-
-                    if args.L1_4 > 0:
-                        if epoch == 0 and i == 0:
-                            print('\nApplying L1 loss penalty {} in linear2 layer\n'.format(args.L1_4))
-                        loss = loss + args.L1_4 * model.linear2.weight.norm(p=1)
-
-
-                    if args.train_act_max and args.L2_act_max > 0:
-                        if args.current1 == 0:
-                            loss = loss + args.L2_act_max * (model.act_max1 ** 2 + model.act_max2 ** 2 + model.act_max3 ** 2)
-                        else:
-                            loss = loss + args.L2_act_max * ((model.act_max1 ** 2) / args.current2 + (model.act_max2 ** 2) / args.current3 + (model.act_max3 ** 2) / args.current4)
+                        lr, mom = scheduler.step()
 
-                    if args.train_w_max and args.L2_w_max > 0:
-                        if i % 100 == 0:
-                            pass
-                            #print('w_min1/w_max1: {:.2f}/{:.2f}'.format(model.w_min1.item(), model.w_max1.item()))
-                        loss = loss + args.L2_w_max * (model.w_min1 ** 2 + model.w_max1 ** 2)
-
-                    if args.batchnorm:  #haven't tested this properly
-                        if args.L2_bn_weight > 0:
-                            loss = loss + args.L2_bn_weight * (torch.sum(model.bn1.weight ** 2) + torch.sum(model.bn2.weight ** 2))
-                        if args.L2_bn_bias > 0:
-                            loss = loss + args.L2_bn_bias * (torch.sum(model.bn1.bias ** 2) + torch.sum(model.bn2.bias ** 2))
+                    if len(regularizer) > 0:
+                        if args.debug and i == 0:
+                            penalty, penalties = regularizer(model, breakdown=True)
+                            print('penalties: {}'.format('  '.join('{} {:.4f}'.format(n, v) for n, v in penalties.items())))
+                        else:
+                            penalty = regularizer(model)
+                        loss = loss + penalty
 
                     optimizer.zero_grad()
 
-                    if args.L3_new > 0:  # L2 penalty for gradient size
-                        params = [model.conv1.weight, model.conv2.weight, model.linear1.weight, model.linear2.weight]
-                        param_grads = torch.autograd.grad(loss, params, create_graph=True, only_inputs=True)
-                        # torch.autograd.grad does not accumuate the gradients into the .grad attributes. It instead returns the gradients as Variable tuples.
-                        # now compute the 2-norm of the param_grads
-                        grad_norm = 0
-                        for grad in param_grads:
-                            # print('param_grad {}:\n{}\ngrad.pow(2).mean(): {:.4f}'.format(grad.shape, grad[0,0], grad.pow(2).mean().item()))
-                            if args.L3_L2:
-                                grad_norm += args.L3_new * grad.pow(2).sum()#.mean()
-                            elif args.L3_L1:
-                                grad_norm += args.L3_new * grad.norm(p=1)
-                        # take the gradients wrt grad_norm. backward() will accumulate the gradients into the .grad attributes
-                        # grad_norm.backward(retain_graph=False)  # or like this:
-                        # print('loss {:.4f} grad_norm {:.4f}'.format(loss.item(), grad_norm.item()))
-                        #print('\nloss before', loss.item())
-                        loss = loss + grad_norm
-                        #print('\nloss after ', loss.item())
-
-                    if args.L3 > 0 or args.L4 > 0 or args.print_stats:
-                        retain_graph = True
-                    else:
-                        retain_graph = False
-
-                    loss.backward(retain_graph=retain_graph)
-
-                    if args.print_stats and i == 0:
-                        for act in [model.conv1_, model.conv2_, model.linear1_, model.linear2_]:
-                            act_norms.append(torch.mean(torch.abs(act)).item())
-                        for param in [model.conv1.weight, model.conv2.weight, model.linear1.weight, model.linear2.weight]:
-                            weight_norms.append(torch.mean(torch.abs(param)).item())
-
-                        if args.L3 == 0:
-                            params = [model.conv1.weight, model.conv2.weight, model.linear1.weight, model.linear2.weight]
-                            param_grads = torch.autograd.grad(loss, params, create_graph=True)
-                            for grad in param_grads:
-                                grad_norms.append(torch.mean(torch.abs(grad)).item() * 1000.)
+                    stats = args.print_stats and i == 0
+                    param_grads, act_grads = backward_with_penalties(model, args, loss, stats=stats)
 
-                        if args.L3_act == 0:
-                            acts = [model.conv1_, model.conv2_, model.linear1_, model.linear2_]
-                            acts_grad = torch.autograd.grad(loss, acts, create_graph=True)
-                            for act_grad in acts_grad:
-                                act_grad_norms.append(torch.mean(torch.abs(act_grad)).item()*1000.)
-
-                    if args.L3_act > 0:   #L2 penalty for gradient size in respect to activations
+                    if stats:  # all the norms are copied to the host at once
                         acts = [model.conv1_, model.conv2_, model.linear1_, model.linear2_]
-                        acts_grad = torch.autograd.grad(loss, acts, create_graph=True)
-                        # torch.autograd.grad does not accumuate the gradients into the .grad attributes. It instead returns the gradients as Variable tuples.
-                        # now compute the 2-norm of the param_grads
-                        act_grad_norm = args.L3_act * torch.stack([act_grad.pow(2).sum() for act_grad in acts_grad]).sum()  #.sqrt()
-
-                        if i == 0:
-                            act_grad_norms = [torch.mean(torch.abs(act_grad)).item()*1000. for act_grad in acts_grad]
-                            #max_act_grads.append(torch.max(torch.abs(act_grad)).item())
-
-                        # take the gradients wrt grad_norm. backward() will accumulate the gradients into the .grad attributes
-                        if False and i == 0:
-                            print('\n\nconv1 grads before\n{}'.format(model.conv1.weight.grad.detach().cpu().numpy()[0, 0]))
-                        act_grad_norm.backward(retain_graph=False)
-                        if False and i == 0:
-                            print('\n\nconv1 grads after\n{}\n\n'.format(model.conv1.weight.grad.detach().cpu().numpy()[0, 0]))
-
-                    if args.L3 > 0:   #L2 penalty for gradient size
-                        params = [model.conv1.weight, model.conv2.weight, model.linear1.weight, model.linear2.weight]
-                        param_grads = torch.autograd.grad(loss, params, create_graph=True, only_inputs=True)
-                        # torch.autograd.grad does not accumuate the gradients into the .grad attributes. It instead returns the gradients as Variable tuples.
-                        # now compute the 2-norm of the param_grads
-                        grad_sum = 0
-                        grad_norm = 0
-                        for grad in param_grads:
-                            if args.L4 > 0:
-                                grad_sum += grad.pow(2).sum()
-                            grad_norm += args.L3 * grad.pow(2).sum()
-                            if i == 0:
-                                grad_norms.append(torch.mean(torch.abs(grad)).item()*1000.)
-                                #max_grads.append(torch.max(torch.abs(grad)).item())
-
-                        # take the gradients wrt grad_norm. backward() will accumulate the gradients into the .grad attributes
-                        if args.L4 > 0:
-                            retain_graph = True
-                        else:
-                            retain_graph = False
-                        grad_norm.backward(retain_graph=retain_graph)
-
-                        if args.L4 > 0:
-                            grads2 = torch.autograd.grad(grad_sum, params, create_graph=False)
-                            #grads2 = torch.autograd.grad(grad_norm, params, create_graph=True)
-                            g2_norm = 0
-                            for g2 in grads2:
-                                #g2_norm += g2.norm(p=2)
-                                g2_norm += g2.pow(2).sum()
-                            g2_norm = args.L4 * g2_norm
-
-                            g2_norm.backward(retain_graph=True)
-
-                    if args.print_stats and i == 0:
+                        weights = [model.conv1.weight, model.conv2.weight, model.linear1.weight, model.linear2.weight]
+                        norms = torch.stack([torch.mean(torch.abs(t.detach())) for t in acts + weights + list(param_grads) + list(act_grads)]).tolist()
+                        act_norms, weight_norms = norms[:4], norms[4:8]
+                        grad_norms = [x * 1000. for x in norms[8:12]]
+                        act_grad_norms = [x * 1000. for x in norms[12:]]
                         norm_string = '  weights {}  weight_grads {}  acts {}  act_grads {}'.format(
                             '{:.2f} {:.2f} {:.2f} {:.2f}'.format(*weight_norms), '{:.2f} {:.2f} {:.2f} {:.2f}'.format(*grad_norms),
                             '{:.2f} {:.2f} {:.2f} {:.2f}'.format(*act_norms), '{:.2f} {:.2f} {:.2f} {:.2f}'.format(*act_grad_norms))
                         norm_string_reduced = '  weights {}  acts {}'.format(
                             '{:.2f} {:.2f} {:.2f} {:.2f}'.format(*weight_norms), '{:.2f} {:.2f} {:.2f} {:.2f}'.format(*act_norms))
-                        #max_string = 'max weights {}  weight_grads {}  acts {}  act_grads {}'.format('{:.3f} {:.3f} {:.3f} {:.3f}'.format(*max_weights),
-                            #'{:.3f} {:.3f} {:.3f} {:.3f}'.format(*max_grads), '{:.3f} {:.3f} {:.3f} {:.3f}'.format(*max_acts), '{:.3f} {:.3f} {:.3f} {:.3f}'.format(*max_act_grads))
-                        grad_norms = []
-                        act_grad_norms = []
-                        act_norms = []
-                        weight_norms = []
-                        max_weights = []
-                        max_acts = []
-                        max_grads = []
-                        max_act_grads = []
-
-                    if args.L4 > 0 and args.L3 == 0:  #L2 penalty for second order gradient size
-                        params = [model.conv1.weight, model.conv2.weight, model.linear1.weight, model.linear2.weight]
-                        grads = torch.autograd.grad(loss, params, create_graph=True)
-
-                        grads_sum = 0
-                        for g in grads:
-                            #grads_sum += torch.abs(g).sum()
-                            grads_sum += g.pow(2).sum()
-                        grads2 = torch.autograd.grad(grads_sum, params, create_graph=True)
-
-                        g2_norm = 0
-                        for g2 in grads2:
-                            #g2_norm += g2.norm(p=2)
-                            g2_norm += g2.pow(2).sum()
-                        g2_norm = args.L4 * g2_norm
-
-                        g2_norm.backward(retain_graph=False)
 
                     if args.grad_clip > 0:
                         for n, p in model.named_parameters():
@@ -1550,6 +1621,10 @@ for current in current_vars:
                     acc = pred.eq(label.data).cpu().sum().numpy() * 100.0 / args.batch_size
                     tr_accuracies.append(acc)
 
+                if args.q_a > 0 and args.calculate_running and epoch == 0 and args.calibration == 'histogram':
+                    print('\n')
+                    finish_calibration(model, tag='train')
+
                 tr_acc = np.mean(tr_accuracies, dtype=np.float64)
 
                 model.eval()
@@ -1562,32 +1637,18 @@ for current in current_vars:
                 #print('\n\n\nWeights after update:\n{}\n{}\n{}\n{}\n'.format(model.conv1.weight.data.detach().cpu().numpy()[0, 0, :2],
                         #model.conv2.weight.data.detach().cpu().numpy()[0, 0, :2], model.linear1.weight.data.detach().cpu().numpy()[0, :10], model.linear2.weight.data.detach().cpu().numpy()[0, :10]))
 
-                with torch.no_grad():
-                    for i in range(num_test_batches):
-                        input = test_inputs[i * args.batch_size:(i + 1) * args.batch_size]
-                        label = test_labels[i * args.batch_size:(i + 1) * args.batch_size]
-                        output = model(input, epoch, i)
-                        pred = output.data.max(1)[1]
-                        te_acc = pred.eq(label.data).cpu().sum().numpy() * 100.0 / args.batch_size
-                        te_accuracies.append(te_acc)
+                te_acc = utils.evaluate(model, test_inputs, test_labels, args.eval_batch_size, pass_index=True, epoch=epoch)
 
-                    if args.print_stats:
-                        p = []
-                        input_sp = []
-                        nsr = []
-                        for ind in range(args.num_layers):
-                            p.append(np.nanmean(model.power[ind]))
-                            input_sp.append(np.nanmean(model.input_sparsity[ind]))
-                            nsr.append(np.nanmean(model.nsr[ind]))
-
-                        avg_input_sparsity = np.nanmean(input_sp)
-                        input_sparsity_string = '  act spars {:.2f} ({:.2f} {:.2f} {:.2f} {:.2f})'.format(avg_input_sparsity, *input_sp)
-                        avg_nsr = np.nanmean(nsr)
-                        noise_string = '  avg noise {:.3f} ({:.2f} {:.2f} {:.2f} {:.2f})'.format(avg_nsr, *nsr)
-                        total_power = np.nansum(p)
-                        power_string = '  Power {:.2f}mW ({:.2f} {:.2f} {:.2f} {:.2f})'.format(total_power, *p)
-
-                te_acc = np.mean(te_accuracies, dtype=np.float64)
+                if args.print_stats:
+                    means = model.layer_stats.means(args.num_layers)
+                    p, input_sp, nsr = means['power'], means['input_sparsity'], means['nsr']
+
+                    avg_input_sparsity = np.nanmean(input_sp)
+                    input_sparsity_string = '  act spars {:.2f} ({:.2f} {:.2f} {:.2f} {:.2f})'.format(avg_input_sparsity, *input_sp)
+                    avg_nsr = np.nanmean(nsr)
+                    noise_string = '  avg noise {:.3f} ({:.2f} {:.2f} {:.2f} {:.2f})'.format(avg_nsr, *nsr)
+                    total_power = np.nansum(p)
+                    power_string = '  Power {:.2f}mW ({:.2f} {:.2f} {:.2f} {:.2f})'.format(total_power, *p)
 
                 if args.distort_w_test:
                     noise_levels = [0.02, 0.04, 0.06, 0.08, 0.1, 0.12]
@@ -1664,6 +1725,10 @@ for current in current_vars:
 
             print('\n\nSimulation {:d}  {} {}  Best Accuracy: {:.2f} (epoch {})\n\n'.format(s, args.tag+args.var_name, var, best_accuracy, best_epoch))
             best_accuracies.append(best_accuracy)
+            if args.results_file is not None:
+                utils.append_result(args.results_file, {
+                    'job_id': args.job_id, 'var_name': args.var_name, 'var': var, 'current': args.current, 'sim': s, 'seed': args.seed,
+                    'best_accuracy': float(best_accuracy), 'best_epoch': best_epoch, 'power': float(best_power), 'nsr': float(best_nsr)})
             if args.print_stats:
                 print('\n\nCurrent {}  {} {}  Simulation {:d} Best Accuracy: {:.2f}{} (epoch {:d}){}{}{}\n\n'.format(
                     args.current1, args.tag+args.var_name, var, s, best_accuracy, best_accuracy_dist_string, best_epoch, best_power_string, best_noise_string, best_w_sparsity_string, best_input_sparsity_string))
@@ -2,65 +2,150 @@
 https://github.com/eladhoffer/quantized.pytorch/blob/master/models/modules/quantize.py
 """
 
+import threading
+
 import torch
 from torch.autograd.function import InplaceFunction, Function
 import torch.nn as nn
 
 
+@torch.jit.script
+def quantize_dequantize(input: torch.Tensor, min_value: float, scale: float, qmax: float, stochastic: float, inplace: bool) -> torch.Tensor:
+    """Uniform quantization of input to qmax + 1 levels of size scale starting at min_value, returned dequantized.
+
+    The first op writes into a new tensor (or into input if inplace), the rest are done in place, so there is no separate
+    clone pass. qmin is 0, so the (x + qmin) and (x - qmin) steps are omitted: the result is bit-for-bit the same.
+    """
+    if inplace:
+        output = input.add_(-min_value)
+    else:
+        output = input.add(-min_value)
+    output.div_(scale)
+    if stochastic > 0:
+        output.add_(torch.empty_like(output).uniform_(-stochastic, stochastic))
+    return output.clamp_(0., qmax).round_().mul_(scale).add_(min_value)
+
+
 class UniformQuantize(InplaceFunction):
 
     @classmethod
     def forward(cls, ctx, input, num_bits=8, min_value=None, max_value=None, stochastic=0.5, inplace=False, debug=False):
-        ctx.inplace = inplace
-        ctx.num_bits = num_bits
-        ctx.min_value = min_value
-        ctx.max_value = max_value
-        ctx.stochastic = stochastic
-        ctx.save_for_backward(input)
-
-        if ctx.inplace:
-            ctx.mark_dirty(input)
-            output = input
-        else:
-            output = input.clone()
-
         qmin = 0.
         qmax = 2. ** num_bits - 1.
         scale = (max_value - min_value) / (qmax - qmin)
         scale = max(scale, 1e-6)  #TODO figure out how to set this robustly! causes nans
 
         with torch.no_grad():
-            output.add_(-min_value).div_(scale).add_(qmin)
+            # for the backward pass we only need to know which values were saturated, not the input itself
+            saturated = (input > max_value) | (input < min_value)
+            ctx.save_for_backward(saturated)
             if debug:
                 print('\nnum_bits {:d} qmin {} qmax {} min_value {} max_value {} actual max value {}'.format(num_bits, qmin, qmax, min_value, max_value, input.max()))
                 print('\ninitial input\n', input[0, 0])
-                print('\nnormalized input\n', output[0, 0])
-            if ctx.stochastic > 0:
-                noise = output.new(output.shape).uniform_(-ctx.stochastic, ctx.stochastic)
-                output.add_(noise)
-                if debug:
-                    print('\nadding noise (stoch={:.1f})\n{}\n'.format(ctx.stochastic, output[0, 0]))
-
-            output.clamp_(qmin, qmax).round_()  # quantize
-            if debug:
-                print('\nquantized\n', output[0, 0])
 
-            output.add_(-qmin).mul_(scale).add_(min_value)  # dequantize
+            if inplace:
+                ctx.mark_dirty(input)
+            output = quantize_dequantize(input, float(min_value), float(scale), qmax, float(stochastic), inplace)
+
         if debug:
+            print('\nquantized (stoch={:.1f})\n{}'.format(stochastic, ((output[0, 0] - min_value) / scale).round()))
             print('\ndenormalized output\n', output[0, 0])
         return output
 
     @staticmethod
     def backward(ctx, grad_output):
         #Saturated Straight Through Estimator
-        input, = ctx.saved_tensors
+        saturated, = ctx.saved_tensors
         #Should we clone the grad_output???
-        grad_output[input > ctx.max_value] = 0
-        grad_output[input < ctx.min_value] = 0
+        grad_output.masked_fill_(saturated, 0)
         #grad_input = grad_output
         return grad_output, None, None, None, None, None, None
 
 
+class HistogramQuantile(object):
+    """Streaming quantile estimate for calibrating quantization ranges, in O(bins) memory regardless of how many values are seen.
+
+    Values are counted in equal width bins over [0, range]. range is a power of 2, and when a value larger than range arrives,
+    range is doubled (as many times as needed) by merging groups of neighbouring bins. Negative values (rare for activations)
+    are counted but not resolved. range and all the counts are device tensors, so update() never waits for the device; only
+    quantile() copies to the host. Sketches collected on several DDP ranks are combined with merge_distributed().
+    """
+
+    def __init__(self, bins=2048):
+        self.bins = bins
+        self.lock = threading.Lock()  # DataParallel replicas share the sketch and update it from several threads
+        self.reset()
+
+    def __getstate__(self):
+        # locks can not be copied or pickled (deepcopy, torch.save of the model): every copy gets a new one
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.hist = None
+        self.negative = None
+        self.range = 0.
+
+    def grow(self, max_value):
+        doublings = torch.ceil(torch.log2(torch.maximum(max_value, self.range) / self.range))
+        doublings = torch.where(self.range > 0, doublings, torch.zeros_like(doublings))  # nothing to merge in an empty sketch
+        factor = torch.exp2(doublings)
+        index = torch.div(torch.arange(self.bins, dtype=torch.float64, device=self.hist.device), factor, rounding_mode='floor').long()
+        self.hist = torch.zeros_like(self.hist).scatter_add_(0, index, self.hist)
+        self.range = self.range * factor
+
+    def update(self, input):
+        input = input.detach().flatten()
+        max_value = input.max().to(torch.float64)
+        with self.lock:
+            if self.hist is None:
+                self.hist = torch.zeros(self.bins, dtype=torch.float64, device=input.device)
+                self.negative = torch.zeros([], dtype=torch.float64, device=input.device)
+                # smallest power of 2 above the first values, 1 if none of them is positive
+                self.range = torch.where(max_value > 0, torch.exp2(torch.ceil(torch.log2(max_value))), torch.ones_like(max_value))
+            self.grow(max_value.to(self.hist.device))
+            # same bins as torch.histc(input, bins, 0, range), which needs range on the host
+            index = input.float().mul(self.bins / self.range.to(input.device, torch.float32)).long().clamp_(0, self.bins - 1)
+            counts = torch.zeros(self.bins, dtype=torch.int32, device=input.device).scatter_add_(0, index, (input >= 0).int())
+            self.hist += counts.to(self.hist)
+            self.negative += (input < 0).sum().to(self.negative)
+
+    def merge_distributed(self):
+        """Combine the sketches of all DDP ranks. Must be called on every rank, including ranks which saw no values"""
+        if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+            return
+        if self.hist is None:  # take part in the reductions with an empty sketch
+            if torch.distributed.get_backend() == 'nccl':
+                device = torch.device('cuda', torch.cuda.current_device())
+            else:
+                device = torch.device('cpu')
+            self.hist = torch.zeros(self.bins, dtype=torch.float64, device=device)
+            self.negative = torch.zeros([], dtype=torch.float64, device=device)
+            self.range = torch.zeros([], dtype=torch.float64, device=device)
+        max_range = self.range.clone()
+        torch.distributed.all_reduce(max_range, op=torch.distributed.ReduceOp.MAX)
+        self.range = torch.where(self.range > 0, self.range, max_range)  # empty sketch: just take over the common range
+        self.grow(max_range)
+        torch.distributed.all_reduce(self.hist)
+        torch.distributed.all_reduce(self.negative)
+
+    def quantile(self, q):
+        """Value below which a fraction q of all the values seen so far lies (linear interpolation inside a bin)"""
+        cdf = self.hist.cumsum(0) + self.negative
+        target = q * cdf[-1].item()
+        if target <= self.negative.item():
+            return torch.zeros([], device=self.hist.device)
+        b = min(int(torch.searchsorted(cdf, torch.tensor([target], dtype=cdf.dtype, device=cdf.device)).item()), self.bins - 1)
+        below = cdf[b - 1].item() if b > 0 else self.negative.item()
+        fraction = (target - below) / max(self.hist[b].item(), 1.)
+        return torch.tensor((b + fraction) * self.range.item() / self.bins, device=self.hist.device)
+
+
 class QuantMeasure(nn.Module):
     '''
     https://arxiv.org/abs/1308.3432
@@ -76,10 +161,13 @@ class QuantMeasure(nn.Module):
     Calculate_running indicates if we want to calculate the given percentile of signals to use as a max_value for quantization range
     if True, we will calculate pctl for several batches (only on training set), and use the average as a running_max, which will became max_value
     if False we will either use self.max_value (if given), or self.running_max (previously calculated)
+
+    calibration='histogram' replaces the per batch kthvalue with a HistogramQuantile sketch, so statistics can be collected for
+    as long as needed (e.g. the whole first epoch): running_max is then the pctl of all the values seen
     '''
 
     def __init__(self, num_bits=8, momentum=0.0, stochastic=0.5, min_value=0, max_value=0, scale=1,
-                 calculate_running=False, pctl=.999, debug=False, debug_quant=False, inplace=False):
+                 calculate_running=False, pctl=.999, debug=False, debug_quant=False, inplace=False, calibration='kthvalue'):
         super(QuantMeasure, self).__init__()
         self.register_buffer('running_min', torch.zeros(1))
         self.register_buffer('running_max', torch.zeros([]))
@@ -95,25 +183,51 @@ class QuantMeasure(nn.Module):
         self.calculate_running = calculate_running
         self.running_list = []
         self.pctl = pctl
+        self.calibration = calibration
+        self.sketch = HistogramQuantile() if calibration == 'histogram' else None
+        self.calibrate_eval = False
+
+    def start_calibration(self, eval_mode=False):
+        """eval_mode: also collect statistics when not training (offline calibration pass)"""
+        self.calculate_running = True
+        self.calibrate_eval = eval_mode
+        self.running_list = []
+        if self.sketch is not None:
+            self.sketch.reset()
+
+    def finish_calibration(self):
+        """Stop collecting statistics, and set running_max from the ones collected so far (if any)"""
+        self.calculate_running = False
+        self.calibrate_eval = False
+        if self.sketch is not None:
+            self.sketch.merge_distributed()
+        if self.sketch is not None and self.sketch.hist is not None and self.sketch.range > 0:
+            self.running_max = self.sketch.quantile(self.pctl).to(self.running_max)
+        elif len(self.running_list) > 0:
+            self.running_max = torch.stack([v.to(self.running_max) for v in self.running_list]).mean()
 
     def forward(self, input):
         #max_value_their = input.detach().contiguous().view(input.size(0), -1).max(-1)[0].mean()
         with torch.no_grad():
-            if self.calculate_running and self.training:
+            if self.calculate_running and (self.training or self.calibrate_eval):
                 if 224 in list(input.shape): #first layer input is special (needs more precision)
                     if self.num_bits == 4:
                         pctl = torch.tensor(0.92)  #args.q_a_first == 4
                     else:
                         pctl = torch.tensor(1.0)
+                elif self.sketch is not None:
+                    self.sketch.update(input)
+                    pctl = None
                 else:
                     pctl, _ = torch.kthvalue(input.view(-1), int(input.numel() * self.pctl))
                 #print('input.shape', input.shape, 'pctl.shape', pctl.shape)
                 #self.running_max = pctl
                 max_value = input.max().item()  #self.running_max
-                self.running_list.append(pctl)  #self.running_max)
+                if pctl is not None:
+                    self.running_list.append(pctl)  #self.running_max)
                 #self.running_max.mul_(self.momentum).add_(max_value * (1 - self.momentum))
-                if self.debug:
-                    print('{} gpu {} self.calculate_running {}  max value (pctl/running/actual) {:.3f}/{:.1f}/{:.1f}'.format(list(input.shape), torch.cuda.current_device(), self.calculate_running, pctl.item(), input.max().item() * 0.95, input.max().item()))
+                if self.debug and pctl is not None:
+                    print('{} device {} self.calculate_running {}  max value (pctl/running/actual) {:.3f}/{:.1f}/{:.1f}'.format(list(input.shape), input.device, self.calculate_running, pctl.item(), input.max().item() * 0.95, input.max().item()))
             else:
                 if self.max_value > 0:
                     max_value = self.max_value
@@ -127,7 +241,7 @@ class QuantMeasure(nn.Module):
                     max_value = max_value * self.scale
 
             if False and self.debug:  #list(input.shape) == [input.shape[0], 512] and torch.cuda.current_device() == 1:
-                print('{} gpu {}  max value (pctl/running/actual) {:.1f}/{:.1f}/{:.1f}'.format(list(input.shape), torch.cuda.current_device(), self.running_max.item(), input.max().item()*0.95, input.max().item()))
+                print('{} device {}  max value (pctl/running/actual) {:.1f}/{:.1f}/{:.1f}'.format(list(input.shape), input.device, self.running_max.item(), input.max().item()*0.95, input.max().item()))
 
             if self.training:
                 stoch = self.stochastic
@@ -0,0 +1,128 @@
+"""Run a noisynet.py --var_name sweep as a table of independent jobs (current x var value x simulation) on a pool of workers.
+
+Each worker is pinned to its own set of CPU cores (and optionally a device), every job appends one row to --results_file,
+and jobs already recorded there are skipped, so an interrupted sweep can be resumed by running the same command again.
+Arguments not recognized here are passed to noisynet.py unchanged:
+
+python sweep.py --var_name LR --num_sims 5 --workers 16 --results_file results/LR_sweep.jsonl -- --current 1 --act_max 5
+"""
+import argparse
+import os
+import queue
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import utils
+
+
+def job_table(args):
+    jobs = []
+    for current in utils.get_current_list(args.var_name, args.current):
+        if args.var_name in ['', 'current']:
+            var_list = [None]
+        elif args.var_values is not None:
+            var_list = args.var_values.split(',')
+        else:
+            var_list = utils.get_var_list(args.var_name, current)
+        for var in var_list:
+            for s in range(args.num_sims):
+                job_id = 'current-{}_{}-{}_sim-{:d}'.format(current, args.var_name, var, s)
+                jobs.append({'job_id': job_id, 'current': current, 'var': var, 'sim': s})
+    return jobs
+
+
+def job_command(args, job, num_threads, device):
+    cmd = [sys.executable, 'noisynet.py', '--current', str(job['current']), '--num_sims', '1', '--results_file', args.results_file,
+           '--job_id', job['job_id'], '--num_threads', str(num_threads)]
+    if job['var'] is not None:
+        cmd += ['--var_name', args.var_name, '--var_value', str(job['var'])]
+    if device is not None:
+        cmd += ['--device', device]
+    if args.seed is not None:
+        cmd += ['--seed', str(args.seed + job['sim'])]
+    return cmd + args.noisynet_args
+
+
+def worker_slots(args):
+    """(cores, device) for each worker: the available cores are split evenly, devices are assigned round robin"""
+    cores = sorted(os.sched_getaffinity(0))
+    per_worker = max(len(cores) // args.workers, 1)
+    devices = args.devices.split(',') if args.devices is not None else [None]
+    slots = []
+    for w in range(args.workers):
+        worker_cores = cores[w * per_worker:(w + 1) * per_worker] or cores
+        slots.append((worker_cores, devices[w % len(devices)]))
+    return slots
+
+
+def run_job(args, job, free_slots):
+    cores, device = free_slots.get()
+    try:
+        cmd = job_command(args, job, len(cores), device)
+        env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), MKL_NUM_THREADS=str(len(cores)))
+        log_path = os.path.join(args.log_dir, job['job_id'] + '.log')
+        start = time.time()
+        with open(log_path, 'w') as log:
+            log.write(' '.join(cmd) + '\n\n')
+            log.flush()
+            returncode = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT, env=env, preexec_fn=lambda: os.sched_setaffinity(0, cores))
+        print('{}  {:<40} {} in {:.1f} min (cores {}-{}{})'.format(
+            str(datetime.now())[:-7], job['job_id'], 'done' if returncode == 0 else 'FAILED ({:d}, see {})'.format(returncode, log_path),
+            (time.time() - start) / 60., cores[0], cores[-1], '' if device is None else ', ' + device))
+        return returncode
+    finally:
+        free_slots.put((cores, device))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parallel noisynet.py sweeps', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--var_name', type=str, default='', help='variable to sweep (values from utils.get_var_list unless --var_values is given)')
+    parser.add_argument('--var_values', type=str, default=None, help='comma separated values of --var_name to sweep')
+    parser.add_argument('--current', type=float, default=0.0, help='current level in nano Amps (ignored for --var_name current)')
+    parser.add_argument('--num_sims', type=int, default=1, help='number of simulation runs for every value')
+    parser.add_argument('--seed', type=int, default=None, help='if given, simulation s uses seed + s')
+    parser.add_argument('--workers', type=int, default=1, help='number of jobs to run at the same time')
+    parser.add_argument('--devices', type=str, default=None, help='comma separated devices to assign to workers round robin (e.g. cuda:0,cuda:1), default: noisynet.py default')
+    parser.add_argument('--results_file', type=str, default='results/sweep.jsonl', help='results of all jobs (one json row per job), also used to resume')
+    parser.add_argument('--log_dir', type=str, default='results/sweep_logs', help='output of every job goes to <log_dir>/<job_id>.log')
+    parser.add_argument('--dry_run', dest='dry_run', action='store_true', help='print the job table and exit')
+    args, noisynet_args = parser.parse_known_args()
+    args.noisynet_args = [a for a in noisynet_args if a != '--']
+
+    jobs = job_table(args)
+    done = set(row['job_id'] for row in utils.read_results(args.results_file))
+    todo = [job for job in jobs if job['job_id'] not in done]
+    print('\n\n{:d} jobs, {:d} already in {}, {:d} to run on {:d} workers\n\n'.format(len(jobs), len(jobs) - len(todo), args.results_file, len(todo), args.workers))
+    if args.dry_run:
+        for job in todo:
+            print(' '.join(job_command(args, job, 1, None)))
+        return
+
+    if not os.path.isdir(args.log_dir):
+        os.makedirs(args.log_dir)
+
+    free_slots = queue.Queue()
+    for slot in worker_slots(args):
+        free_slots.put(slot)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        returncodes = list(pool.map(lambda job: run_job(args, job, free_slots), todo))
+
+    failed = sum(1 for r in returncodes if r != 0)
+    print('\n\n{:d} jobs finished, {:d} failed\n\n'.format(len(returncodes) - failed, failed))
+
+    job_ids = set(job['job_id'] for job in jobs)
+    summary = {}
+    for row in utils.read_results(args.results_file):
+        if row['job_id'] in job_ids:
+            summary.setdefault((row['current'], row['var']), []).append(row['best_accuracy'])
+    for (current, var), accs in sorted(summary.items(), key=lambda kv: (kv[0][0], str(kv[0][1]))):
+        print('current {:<6} {} {:<10} {} mean {:.2f} max {:.2f} min {:.2f}'.format(
+            current, args.var_name, str(var), ['{:.2f}'.format(a) for a in accs], sum(accs) / len(accs), max(accs), min(accs)))
+
+
+if __name__ == '__main__':
+    main()
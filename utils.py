@@ -1,4 +1,6 @@
 import os
+import json
+import hashlib
 import numpy as np
 import math
 import torch
@@ -39,6 +41,58 @@ def adjust_learning_rate(args, optimizer, epoch, iteration, num_iter):
         param_group['lr'] = lr #/ args.batch_size
 
 
+class TriangleLR(object):
+    """Triangle (super-convergence) LR and momentum schedule of noisynet.py, precomputed for every iteration.
+
+    LR rises linearly from 0 to LR until the end of max_epoch (while momentum falls from momentum to 0), then falls to
+    5% of LR by epoch nepochs - finetune_epochs, and to 0 during the last finetune_epochs. The per iteration values are
+    built with a sequential cumsum of the same increments the original loop added one at a time, so they are bit for bit
+    the same. step() is called before every batch and writes lr / batch_size (and momentum, for optimizers which have it)
+    into every param group.
+    """
+
+    def __init__(self, optimizer, LR, momentum, nepochs, max_epoch, finetune_epochs, iters_per_epoch, batch_size=1, last_iteration=-1):
+        self.optimizer = optimizer
+        self.batch_size = batch_size
+        self.iteration = last_iteration + 1
+        self.lrs, self.moms = self.schedule(LR, momentum, nepochs, max_epoch, finetune_epochs, iters_per_epoch)
+
+    @staticmethod
+    def schedule(LR, momentum, nepochs, max_epoch, finetune_epochs, iters_per_epoch):
+        lr_increment = LR / ((max_epoch + 1) * iters_per_epoch)
+        mom_decrement = momentum / ((max_epoch + 1) * iters_per_epoch)
+        lr_decrement = (LR - 0.05 * LR) / ((nepochs - max_epoch - finetune_epochs) * iters_per_epoch)
+        lr_decrement2 = (0.05 * LR) / (finetune_epochs * iters_per_epoch)
+        mom_increment = (LR - 0.05 * LR) / ((nepochs - max_epoch - finetune_epochs) * iters_per_epoch)  #TODO!!! (same as in noisynet.py)
+        mom_increment2 = (0.05 * LR) / (finetune_epochs * iters_per_epoch)
+
+        epochs = np.arange(nepochs * iters_per_epoch) // iters_per_epoch
+        rising = epochs <= max_epoch
+        falling = ~rising & (epochs <= nepochs - finetune_epochs)
+        lr_steps = np.where(rising, lr_increment, np.where(falling, -lr_decrement, -lr_decrement2))
+        mom_steps = np.where(rising, -mom_decrement, np.where(falling, mom_increment, mom_increment2))
+        lrs = np.cumsum(np.concatenate([[0.], lr_steps]))[1:]
+        moms = np.cumsum(np.concatenate([[momentum], mom_steps]))[1:]
+        return lrs, moms
+
+    def step(self):
+        t = min(self.iteration, len(self.lrs) - 1)
+        lr = float(self.lrs[t])
+        mom = float(self.moms[t])
+        for param_group in self.optimizer.param_groups:
+            param_group['lr'] = lr / self.batch_size
+            if 'momentum' in param_group:
+                param_group['momentum'] = mom
+        self.iteration += 1
+        return lr, mom
+
+    def state_dict(self):
+        return {'iteration': self.iteration}
+
+    def load_state_dict(self, state_dict):
+        self.iteration = state_dict['iteration']
+
+
 def accuracy(output, target):
     with torch.no_grad():
         batch_size = target.size(0)
@@ -122,11 +176,115 @@ def setup_data(args):
                         transforms.CenterCrop(224), transforms.ToTensor(), transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]), ]))
 
         train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.workers, pin_memory=False)
-        val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers, pin_memory=False)
+        # --ci_tolerance stops on a part of the validation set, which has to be a random one (the images are sorted by class)
+        val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=args.batch_size, shuffle=args.ci_tolerance > 0, num_workers=args.workers, pin_memory=False)
 
     return train_loader, val_loader
 
 
+class CompactImages(object):
+    """Images with few distinct values per channel (e.g. 4 bit CIFAR) stored as uint8 codes, plus a (channels, 256) table
+    of the float values (already cast and whitened) they stand for. Indexing and index_select return float tensors: only
+    the selected samples are ever converted, so the dataset takes a byte per pixel. Padding uses PAD_CODE, which maps to 0.
+    This trades speed for memory: the table lookup makes every batch gather several times slower than indexing a float tensor.
+    """
+    PAD_CODE = 255
+
+    def __init__(self, codes, lut):
+        self.codes = codes
+        self.lut = lut
+        self.channels = torch.arange(codes.shape[1], device=codes.device).view(-1, 1, 1)
+
+    @classmethod
+    def from_numpy(cls, images, dtype, mean=None, std=None, pad=0):
+        codes = np.empty(images.shape, dtype=np.uint8)
+        lut = np.zeros((images.shape[1], 256), dtype=dtype)
+        for c in range(images.shape[1]):
+            values, inverse = np.unique(images[:, c], return_inverse=True)
+            if len(values) > cls.PAD_CODE:
+                print('\n\nchannel {:d} has {:d} distinct values, too many to store as uint8 codes\n\n'.format(c, len(values)))
+                raise(SystemExit)
+            codes[:, c] = inverse.reshape(codes[:, c].shape)
+            values = values.astype(dtype)
+            if mean is not None:
+                values = (values - mean.reshape(-1)[c]) / std.reshape(-1)[c]
+            lut[c, :len(values)] = values
+        if pad > 0:
+            codes = np.pad(codes, ((0, 0), (0, 0), (pad, pad), (pad, pad)), constant_values=cls.PAD_CODE)
+        return cls(torch.from_numpy(codes), torch.from_numpy(lut))
+
+    def to(self, device):
+        return CompactImages(self.codes.to(device), self.lut.to(device))
+
+    def decode(self, codes):
+        return self.lut[self.channels, codes.long()]
+
+    def __getitem__(self, index):
+        return self.decode(self.codes[index])
+
+    def index_select(self, dim, index):
+        return self.decode(self.codes.index_select(dim, index))
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def device(self):
+        return self.codes.device
+
+    @property
+    def is_cuda(self):
+        return self.codes.is_cuda
+
+
+def cifar_cache(args, dtype):
+    """Paths of uncompressed .npy copies of args.dataset, already reshaped, cast, whitened and padded the way load_cifar
+    would do it for args, so that they can be memory mapped and used as they are. Written on first use; every file is
+    written under a temporary name and then renamed, so concurrent runs never see a partial file."""
+    if args.dataset_cache is not None:
+        cache_dir = args.dataset_cache
+    else:
+        cache_dir = os.path.splitext(args.dataset)[0] + '_cache'
+    tag = np.dtype(dtype).name + ('_whiten' if args.whiten_cifar10 else '')
+    paths = {
+        'train_inputs': os.path.join(cache_dir, 'train_inputs_{}{}.npy'.format(tag, '_pad4' if args.augment else '')),
+        'train_labels': os.path.join(cache_dir, 'train_labels.npy'),
+        'test_inputs': os.path.join(cache_dir, 'test_inputs_{}.npy'.format(tag)),
+        'test_labels': os.path.join(cache_dir, 'test_labels.npy')}
+    if all(os.path.exists(path) for path in paths.values()):
+        return paths
+
+    print('\n\nwriting dataset cache to', cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    f = np.load(args.dataset)
+    arrays = {
+        'train_inputs': f['arr_0'].reshape(50000, 3, 32, 32).astype(dtype),
+        'train_labels': f['arr_1'],
+        'test_inputs': f['arr_2'].reshape(10000, 3, 32, 32).astype(dtype),
+        'test_labels': f['arr_3']}
+    f.close()
+
+    if args.whiten_cifar10:
+        mean = np.asarray((0.4914, 0.4822, 0.4465)).reshape(1, 3, 1, 1).astype(dtype)
+        std = np.asarray((0.2023, 0.1994, 0.2010)).reshape(1, 3, 1, 1).astype(dtype)
+        arrays['train_inputs'] = (arrays['train_inputs'] - mean) / std
+        arrays['test_inputs'] = (arrays['test_inputs'] - mean) / std
+
+    if args.augment:
+        arrays['train_inputs'] = np.pad(arrays['train_inputs'], ((0, 0), (0, 0), (4, 4), (4, 4)))
+
+    for name, path in paths.items():
+        tmp_path = '{}.{:d}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, arrays[name])
+        os.replace(tmp_path, path)
+    return paths
+
+
 def load_cifar(args):
     print('\n\n\n\t***************** dataset:', args.dataset, '*******************\n\n\n')
 
@@ -140,6 +298,30 @@ def load_cifar(args):
     else:
         dtype = np.float32
 
+    if args.mmap_dataset:
+        paths = cifar_cache(args, dtype)
+        # copy on write mapping: nothing is read until used, and the pages stay shared with all other runs mapping the same
+        # files (on CPU the tensors below are the mapping itself, the training loop only reads from them)
+        arrays = [np.load(paths[name], mmap_mode='c') for name in ['train_inputs', 'train_labels', 'test_inputs', 'test_labels']]
+        train_inputs, train_labels, test_inputs, test_labels = [torch.from_numpy(a).to(args.device) for a in arrays]
+        print('Memory mapped {} (whitened: {}, padded for augmentation: {})\n\n'.format(paths['train_inputs'], args.whiten_cifar10, args.augment))
+        return train_inputs, train_labels, test_inputs, test_labels
+
+    if args.compact_dataset:
+        if args.whiten_cifar10:
+            mean = np.asarray((0.4914, 0.4822, 0.4465)).astype(dtype)
+            std = np.asarray((0.2023, 0.1994, 0.2010)).astype(dtype)
+        else:
+            mean = std = None
+        f = np.load(args.dataset)
+        train_inputs = CompactImages.from_numpy(f['arr_0'].reshape(50000, 3, 32, 32), dtype, mean, std, pad=4 if args.augment else 0).to(args.device)
+        test_inputs = CompactImages.from_numpy(f['arr_2'].reshape(10000, 3, 32, 32), dtype, mean, std).to(args.device)
+        train_labels = torch.from_numpy(f['arr_1']).to(args.device)
+        test_labels = torch.from_numpy(f['arr_3']).to(args.device)
+        f.close()
+        print('Storing images as uint8 codes (whitened: {}, padded for augmentation: {})\n\n'.format(args.whiten_cifar10, args.augment))
+        return train_inputs, train_labels, test_inputs, test_labels
+
     f = np.load(args.dataset)
     train_inputs = f['arr_0'].reshape(50000, 3, 32, 32).astype(dtype)
     train_labels = f['arr_1']
@@ -147,17 +329,17 @@ def load_cifar(args):
     test_labels = f['arr_3']
     f.close()
 
-    train_inputs = torch.from_numpy(train_inputs).cuda()
-    train_labels = torch.from_numpy(train_labels).cuda()
-    test_inputs = torch.from_numpy(test_inputs).cuda()
-    test_labels = torch.from_numpy(test_labels).cuda()
+    train_inputs = torch.from_numpy(train_inputs).to(args.device)
+    train_labels = torch.from_numpy(train_labels).to(args.device)
+    test_inputs = torch.from_numpy(test_inputs).to(args.device)
+    test_labels = torch.from_numpy(test_labels).to(args.device)
 
     if args.whiten_cifar10:  #whiten
         mean = np.asarray((0.4914, 0.4822, 0.4465)).reshape(1, 3, 1, 1).astype(dtype)
         std = np.asarray((0.2023, 0.1994, 0.2010)).reshape(1, 3, 1, 1).astype(dtype)
 
-        mean = torch.from_numpy(mean).cuda()
-        std = torch.from_numpy(std).cuda()
+        mean = torch.from_numpy(mean).to(args.device)
+        std = torch.from_numpy(std).to(args.device)
 
         test_inputs = test_inputs.sub_(mean).div_(std)
         train_inputs = train_inputs.sub_(mean).div_(std)
@@ -176,6 +358,69 @@ def load_cifar(args):
     return train_inputs, train_labels, test_inputs, test_labels
 
 
+class BatchSampler(object):
+    """Iterates over (inputs, labels) minibatches in a new random order every epoch.
+
+    The dataset tensors are never modified or copied: every batch is gathered with index_select from a permutation of the
+    sample indices, so the only per epoch allocation is the index vector, and several runs can share one read only copy of
+    the data. On CUDA, the gather of the next batch is issued on a side stream while the current batch is being used.
+    The last incomplete batch is dropped, as in the original slicing loops.
+    """
+
+    def __init__(self, inputs, labels, batch_size, shuffle=True, prefetch=True):
+        self.inputs = inputs
+        self.labels = labels
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.stream = torch.cuda.Stream(device=inputs.device) if prefetch and inputs.is_cuda else None
+
+    def __len__(self):
+        return len(self.inputs) // self.batch_size
+
+    def gather(self, indices, i):
+        batch_idx = indices[i * self.batch_size:(i + 1) * self.batch_size]
+        return self.inputs.index_select(0, batch_idx), self.labels.index_select(0, batch_idx)
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = torch.randperm(len(self.inputs), device=self.inputs.device)
+        else:
+            indices = torch.arange(len(self.inputs), device=self.inputs.device)
+
+        if self.stream is None:
+            for i in range(len(self)):
+                yield self.gather(indices, i)
+            return
+
+        current = torch.cuda.current_stream(self.inputs.device)
+        self.stream.wait_stream(current)
+        with torch.cuda.stream(self.stream):
+            batch = self.gather(indices, 0)
+        for i in range(len(self)):
+            current.wait_stream(self.stream)
+            for t in batch:
+                t.record_stream(current)
+            ready = batch
+            if i + 1 < len(self):
+                with torch.cuda.stream(self.stream):
+                    batch = self.gather(indices, i + 1)
+            yield ready
+
+
+def random_crop_flip(input, size=32):
+    """Random size x size crop and random horizontal flip of every sample in a padded batch (N, C, H, W), drawn
+    independently per sample. The crop offsets and flips of the whole batch are applied by two gathers (rows, then
+    columns, flipped columns in reverse order) with broadcast (expanded, not materialized) indices"""
+    n, c, h, w = input.shape
+    device = input.device
+    offsets = torch.arange(size, device=device)
+    rows = torch.randint(0, h - size + 1, (n, 1), device=device) + offsets
+    cols = torch.randint(0, w - size + 1, (n, 1), device=device) + offsets
+    cols = torch.where(torch.rand(n, 1, device=device) < 0.5, cols.flip(1), cols)
+    input = input.gather(2, rows.view(n, 1, size, 1).expand(n, c, size, w))
+    return input.gather(3, cols.view(n, 1, 1, size).expand(n, c, size, size))
+
+
 def saveargs(args):
     path = args.checkpoint_dir
     if os.path.isdir(path) == False:
@@ -184,6 +429,158 @@ def saveargs(args):
         for arg in vars(args):
             f.write(arg+' '+str(getattr(args,arg))+'\n')
 
+
+def get_current_list(var_name, current):
+    """Current levels (nA) to test in noisynet.py"""
+    if var_name == 'current':
+        return [1, 3, 5, 10, 20, 50, 100]
+    return [current]
+
+
+def get_var_list(var_name, current):
+    """Values of var_name to test in noisynet.py (some noise levels are scaled by the current)"""
+    if var_name == 'w_max1':
+        var_list = [0.05, 0.1, 0.3, 0.5, 1]
+        #var_list = [0, 2, 4, 8]
+        var_list = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1]
+    elif var_name == 'act_max':#'act_max' in var_name:
+        #var_list = [0.8, 1.2, 1.5, 2, 2.5, 3, 5, 10, 0]
+        var_list = [0, 0.2, 1, 5, 20]
+        var_list = [0.25, 1, 2, 4, 10, 0]
+    elif var_name == 'act_max1':#'act_max' in var_name:
+        #var_list = [0.8, 1.2, 1.5, 2, 2.5, 3, 5, 10, 0]
+        var_list = [0, 0.2, 1, 5, 20]
+        var_list = [0.5, 1, 1.5, 2, 2.5, 3, 4, 5]
+    elif var_name == 'act_max2':#'act_max' in var_name:
+        #var_list = [0.8, 1.2, 1.5, 2, 2.5, 3, 5, 10, 0]
+        var_list = [0, 0.2, 1, 5, 20]
+        var_list = [0.5, 1, 2, 3, 4, 5, 10]
+    elif var_name == 'act_max3':#'act_max' in var_name:
+        #var_list = [0.8, 1.2, 1.5, 2, 2.5, 3, 5, 10, 0]
+        var_list = [0, 0.2, 1, 5, 20]
+        var_list = [0.5, 1, 2, 3, 4, 5, 10]
+    elif var_name == 'LR':
+        #var_list = [0.0001, 0.0002, 0.0003, 0.0005, 0.001, 0.005, 0.01, 0.02, 0.03, 0.05, 0.1]
+        #var_list = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.003, 0.005, 0.01, 0.02]
+        var_list = [0.01, 0.015, 0.02, 0.025, 0.03, 0.035]
+        var_list = [0.001, 0.002, 0.005, 0.01, 0.02, 0.04]
+        var_list = [0.005, 0.01, 0.02, 0.03, 0.04, 0.05, 0.06, 0.08, 0.1]
+        var_list = [0.5, 0.6, 0.7, 0.8, 1, 1.2, 1.5, 2, 2.5, 3, 4, 5, 7, 10]
+        var_list = [0.0001, 0.0002, 0.0003, 0.0005, 0.001, 0.002, 0.003, 0.004, 0.006, 0.008, 0.01]
+    elif var_name == 'L2_act_max':
+        var_list = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.03, 0.05]
+    elif var_name == 'uniform_ind':
+        #var_list = [0.08, 0.09, 0.1, 0.11, 0.12, 0.13, 0.14, 0.15]
+        var_list = [x/current for x in [0.12, 0.14, 0.16]]
+    elif var_name == 'uniform_dep':
+        var_list = [0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1]  #0.5, 0.6, and 1.5-3.0
+    elif var_name == 'normal_ind':
+        #var_list = [0.03, 0.04, 0.05, 0.06, 0.07, 0.08, 0.09, 0.1]
+        var_list = [x/current for x in [0.05, 0.07, 0.09]]
+    elif var_name == 'normal_dep':
+        #var_list = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7]
+        var_list = [x/current for x in [0.3, 0.4, 0.5]]
+    elif var_name == 'L2_1':
+        var_list = [0.0, 0.0002, 0.0005, 0.001, 0.002, 0.003, 0.005]
+    elif var_name == 'L2':
+        var_list = [0.00005, 0.0001, 0.0002, 0.0003, 0.0005, 0.001]
+        var_list = [0, 0.0001, 0.0002, 0.0003, 0.0004, 0.0005, 0.0006, 0.0008, 0.001, 0.0012, 0.0015, 0.002]
+        var_list = [0, 0.00005, 0.0001, 0.0002, 0.0003, 0.0004, 0.0005, 0.0006, 0.0007, 0.0008, 0.001]
+        var_list = [0.0005, 0.001, 0.002, 0.003, 0.004, 0.005, 0.006, 0.008, 0.01, 0.02, 0.03, 0.05]
+        var_list = [0.5, 0.6, 0.7, 0.8, 1, 1.2, 1.5, 2, 2.5, 3, 4, 5, 7, 10]
+        var_list = [0, 0.02, 0.03, 0.05, 0.07, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4]
+        var_list = [0, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.03, 0.04, 0.05, 0.07, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4]
+    elif var_name == 'L1':
+        var_list = [0, 1e-7, 2e-7, 5e-7, 1e-6, 2e-6, 5e-6, 1e-5]#, 3e-5, 2e-5, 5e-5, 0.0001]
+        #var_list = [1e-5, 2e-5, 5e-5, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.03, 0.05, 0.07, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.7, 1]
+        var_list = [2e-6, 4e-6, 6e-6, 8e-6, 1e-5, 2e-5, 3e-5]
+    elif var_name == 'L2_2':
+        var_list = [0.0, 0.00001, 0.00002, 0.00003, 0.00005, 0.0001]#, 0.0002, 0.0003, 0.0005, 0.001]
+    elif var_name == 'L3':
+        #var_list = [0.1, 0.2, 0.5, 1, 2, 3, 5]  # currents 1,3,5,10,20,50,100:  30, 20, 10, 1, 0.2, 0.05, 0.01
+        #var_list = [x/args.test_current for x in [10, 20, 50]]
+        var_list = [0, 0.001, 0.005, 0.01, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 30, 50]
+        var_list = [0, 0.001, 0.002, 0.005, 0.01, 0.02, 0.03, 0.05, 0.1, 0.2, 0.5]
+        var_list = [0.0005, 0.001, 0.002, 0.003, 0.005, 0.007, 0.01, 0.015, 0.02]
+        #var_list = [0.02, 0.025, 0.03, 0.035, 0.04, 0.05, 0.06, 0.07, 0.08]
+        var_list = [0.001, 0.0025, 0.005, 0.0075, 0.01, 0.015, 0.02, 0.025, 0.03]
+        var_list = [0, 0.0005, 0.001, 0.002, 0.003, 0.004, 0.005, 0.006, 0.007, 0.008, 0.01]
+        var_list = [5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3]#0.0005, 0.001, 0.002, 0.003, 0.004, 0.005, 0.006, 0.007, 0.008, 0.01]
+        var_list = [0, 0.0005, 0.001, 0.002, 0.003, 0.005, 0.007, 0.01, 0.02, 0.03, 0.04, 0.06, 0.08, 0.1, 0.2, 0.3, 0.5, 1]
+    elif var_name == 'L3_new':
+        var_list = [0, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 1]#1, 2, 3, 5, 10, 20, 30]
+    elif var_name == 'L3_act':
+        #var_list = [500000, 1000000, 2000000, 4000000, 10000000, 20000000]
+        #var_list = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20]
+        var_list = [0.001, 0.005, 0.01, 0.05, 0.1, 0.2, 0.5, 1, 2]
+    elif var_name == 'L4':
+        var_list = [0.00002, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5]
+    elif var_name == 'momentum':
+        var_list = [0., 0.5, 0.7, 0.8, 0.85, 0.9, 0.95, 0.97, 0.99]
+    elif var_name == 'grad_clip':
+        #var_list = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2, 5, 0]
+        var_list = [0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2, 5, 0]
+        var_list = [0.005, 0.05, 0.5, 2, 0]
+    elif var_name == 'dropout':
+        var_list = [0, 0.05, 0.1, 0.15, 0.2, 0.25]
+        var_list = [0, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.5]
+    elif var_name == 'width':
+        var_list = [1, 2, 4]
+    elif var_name == 'noise':
+        var_list = [0, 0.02, 0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5]
+    elif var_name == 'n_w':
+        var_list = [0, 0.02, 0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5]
+        var_list = [0, 0.02, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5]
+    elif var_name == 'selected_weights':
+        var_list = [0, 1, 2, 3, 5, 10, 20, 30]
+        var_list = [2, 5, 10]
+    elif var_name == 'L2_w_max':
+        var_list = [0.1]    #0.1 works fine for current=10 and init_w_max=0.2, no L2, and no act_max: w_min=-0.16, w_max=0.18, Acc 78.72 (epoch 225), power 3.45, noise 0.04 (0.02, 0.03, 0.04, 0.08)
+    else:
+        var_list = [' ']
+
+    return var_list
+
+
+def parse_value(s):
+    """Command line value of a swept variable: int or float if it looks like one, otherwise the string itself"""
+    for t in [int, float]:
+        try:
+            return t(s)
+        except ValueError:
+            pass
+    return s
+
+
+def append_result(path, row):
+    """Append one json row to a results file shared by several processes (e.g. sweep.py workers). The file is locked
+    while writing where fcntl is available (POSIX), elsewhere the row is written with a single unlocked append"""
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+    dirname = os.path.dirname(path)
+    if dirname != '' and not os.path.isdir(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(row) + '\n')
+        f.flush()
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_results(path):
+    rows = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip() != '':
+                    rows.append(json.loads(line))
+    return rows
+
+
 def init_params(net):
     for m in net.modules():
         if isinstance(m, nn.Conv2d):
@@ -299,6 +696,104 @@ def init_model(model, args, s=0):
         nn.init.constant_(model.w_max1, args.w_max1)
 
 
+class BinomialCI(object):
+    """Running accuracy over all the predictions counted so far, with a Wilson score confidence interval of z standard
+    deviations (z=1.96: 95%). Used to stop evaluating once the accuracy is known well enough (--ci_tolerance)"""
+
+    def __init__(self, z=1.96):
+        self.z = z
+        self.correct = 0
+        self.total = 0
+
+    def update(self, correct, total):
+        self.correct += correct
+        self.total += total
+
+    def accuracy(self):
+        return self.correct * 100. / max(self.total, 1)
+
+    def interval(self):
+        """(low, high) in %"""
+        if self.total == 0:
+            return 0., 100.
+        n = self.total
+        p = self.correct / float(n)
+        z2 = self.z ** 2
+        center = (p + z2 / (2 * n)) / (1 + z2 / n)
+        half_width = self.z * math.sqrt(p * (1 - p) / n + z2 / (4 * n ** 2)) / (1 + z2 / n)
+        return 100. * max(center - half_width, 0.), 100. * min(center + half_width, 1.)
+
+    def width(self):
+        low, high = self.interval()
+        return high - low
+
+
+def evaluate(model, inputs, labels, batch_size=1000, pass_index=False, ci=None, tolerance=0., order=None, **kwargs):
+    """Accuracy (%) of model on all of inputs, including the last partial batch. Runs under inference_mode, counts the
+    correct predictions on the device and copies the count to the host once. kwargs are passed on to model, and with
+    pass_index also the batch index as i (noisynet.py Net). If model returns (draws, batch, classes) outputs (several weight
+    draws, main.WeightDistortion), the list of accuracies of all draws is returned.
+    With ci (a BinomialCI) and tolerance > 0, every batch is also counted there (one copy to the host per batch), and
+    evaluation stops as soon as the confidence interval is narrower than tolerance (%): the accuracy is then over the
+    batches evaluated so far. Without a tolerance the counts stay on the device until the end.
+    order (a tensor of indices, e.g. a random permutation) sets the order in which the samples are evaluated, so that an
+    early stop is over a random subset rather than over the first samples."""
+    if tolerance <= 0:
+        ci = None
+    correct = torch.zeros([], dtype=torch.long, device=labels.device)
+    evaluated = 0
+    with torch.inference_mode():
+        for b, start in enumerate(range(0, len(labels), batch_size)):
+            if pass_index:
+                kwargs['i'] = b
+            index = slice(start, start + batch_size) if order is None else order[start:start + batch_size]
+            batch_labels = labels[index]
+            output = model(inputs[index], **kwargs)
+            batch_correct = output.argmax(-1).eq(batch_labels).sum(-1)
+            correct = correct + batch_correct
+            evaluated += len(batch_labels)
+            if ci is not None:
+                ci.update(batch_correct.sum().item(), batch_correct.numel() * len(batch_labels))
+                if ci.width() < tolerance:
+                    break
+    if correct.dim() > 0:
+        return [c * 100. / evaluated for c in correct.tolist()]
+    return correct.item() * 100. / evaluated
+
+
+def tensor_hash(tensors):
+    """sha1 hex digest of the shapes, dtypes and contents of tensors"""
+    h = hashlib.sha1()
+    for t in tensors:
+        t = t.detach().cpu().contiguous()
+        h.update('{}{}'.format(list(t.shape), t.dtype).encode())
+        h.update(t.flatten().view(torch.uint8).numpy())
+    return h.hexdigest()
+
+
+def load_checkpoint(path, device, mmap=False):
+    """torch.load to device, or with mmap, memory mapped from the file (on CPU): tensors are only read from disk when they
+    are copied into a model, e.g. by load_matching_state"""
+    if mmap:
+        return torch.load(path, map_location='cpu', mmap=True)
+    return torch.load(path, map_location=device)
+
+
+def load_matching_state(model, saved_state, buffer_filter=None, debug=False):
+    """Copy into model all the parameters of saved_state which model has, and the buffers for which buffer_filter(name)
+    is True, in a single load_state_dict call. Returns the names which were copied."""
+    params = set(name for name, _ in model.named_parameters())
+    buffers = set(name for name, _ in model.named_buffers())
+    state = {}
+    for name, value in saved_state.items():
+        if name in params or (name in buffers and buffer_filter is not None and buffer_filter(name)):
+            state[name] = value
+        if debug:
+            print(name + ('\n\tmatched, copying...' if name in state else '\n\t\t\t************ Not copying'))
+    model.load_state_dict(state, strict=False)
+    return list(state)
+
+
 def print_model(model, args, full=False):
     print('\n\n****** Model Configuration ******\n\n')
     for arg in vars(args):